@@ -48,9 +48,43 @@ class Settings:
     AVATAR_DIR: str = 'avatar' #头像
     ARTICLE_MEDIA: str = 'article_media'
     CHAT_MEDIA:  str = 'chat_media'
+    GROUP_AVATAR_DIR: str = 'group_avatar'  # 群组合头像
+    CHAT_ARCHIVE_DIR: str = 'chat_archive'  # 聊天记录归档（按会话、按月的 jsonl.gz 文件）
 
     server_host = "http://localhost:8000"
 
+    # 群聊配置
+    GROUP_FANOUT_LIMIT: int = 200  # 超过该人数的群不再逐个成员写最近聊天，改为读时合并
+    UNREAD_COUNT_CAP: int = 99  # 按读游标统计未读数时的上限，前端显示为 99+
+    GROUP_CACHE_SIZE: int = 1024  # 进程内群信息缓存的群数量
+    GROUP_CACHE_LOCAL_TTL: int = 30  # 进程内群信息缓存时间（秒）
+    GROUP_CACHE_REDIS_TTL: int = 600  # Redis群信息缓存时间（秒）
+    GROUP_AVATAR_SIZE: int = 240  # 群组合头像边长（像素）
+    GROUP_BULK_CREATE_LIMIT: int = 100  # 批量建群接口一次最多创建的群数量
+    GROUP_BULK_CREATE_ENABLED: bool = False  # 是否开放批量建群接口，只在数据迁移、压测环境开启
+    GROUP_SYSTEM_MESSAGE_WINDOW: float = 0.5  # 群系统消息合并推送的时间窗口（秒）
+
+    # 聊天记录归档配置
+    CHAT_HOT_DAYS: int = 180  # MongoDB中保留最近多少天的聊天记录，更早的移到归档文件
+    CHAT_ARCHIVE_INTERVAL: int = 86400  # 归档任务执行间隔（秒）
+    CHAT_ARCHIVE_CACHE_MONTHS: int = 32  # 每个进程在内存中缓存的已解析归档月份文件数
+
+    # 朋友圈配置
+    MOMENT_TIMELINE_SIZE: int = 800  # 每个用户时间线保留的动态条数
+    MOMENT_TIMELINE_TTL: int = 7 * 86400  # 时间线不被读取多久后过期（秒），过期后读取时重建
+    MOMENT_FANOUT_LIMIT: int = 1000  # 好友数超过该值的作者不再写扩散，改为好友读取时合并
+    MOMENT_CONTACTS_TTL: int = 600  # 好友列表缓存时间（秒）
+    LIKE_HOT_THRESHOLD: int = 20  # 每秒点赞超过该次数的对象改为Redis缓冲计数
+    LIKE_FLUSH_INTERVAL: int = 2  # 缓冲的点赞数写入MongoDB的间隔（秒）
+    FEED_CACHE_TTL: int = 30  # 动态列表、详情响应缓存时间（秒），数据变化时提前失效
+    FEED_VERSION_TTL: int = 86400  # 响应缓存依赖的版本号保留时间（秒），需大于 FEED_CACHE_TTL
+    TRENDING_HALF_LIFE: int = 6 * 3600  # 热门排行中互动热度的半衰期（秒）
+    TRENDING_SIZE: int = 1000  # 热门排行保留的动态数
+    COMPACTION_GRACE_DAYS: int = 30  # 已删除的动态、评论、回复保留多少天后移入归档集合
+    COMPACTION_INTERVAL: int = 86400  # 归档整理的执行间隔（秒）
+    COMPACTION_BATCH_SIZE: int = 200  # 归档整理每批移动的文档数
+    COMPACTION_BATCH_PAUSE: float = 0.5  # 归档整理批次之间的暂停（秒）
+
     # 日志配置
     LOG_DIR: str = "logs"
     LOG_FILE: str = os.path.join(LOG_DIR, "app.log")
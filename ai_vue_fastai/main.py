@@ -13,6 +13,11 @@ from views.bigdata.person import router as router_bigdata
 from views.chat.single_chat import router as router_chat
 from views.chat.group import router as router_group
 from views.chat.group_chat import router as router_group_chat
+from views.chat.mux_chat import router as router_mux_chat
+# 启动时执行的迁移和后台整理任务，导入即注册
+import utils.article_dates  # noqa: F401
+import utils.compaction  # noqa: F401
+from utils.group_avatar import ImmutableStaticFiles
 import sys
 import io
 # 强制标准输出使用UTF-8
@@ -40,11 +45,13 @@ os.makedirs(settings.QRCODE_DIR, exist_ok=True)
 os.makedirs(settings.AVATAR_DIR, exist_ok=True)
 os.makedirs(settings.ARTICLE_MEDIA, exist_ok=True)
 os.makedirs(settings.CHAT_MEDIA, exist_ok=True)
+os.makedirs(settings.GROUP_AVATAR_DIR, exist_ok=True)
 # 配置静态文件服务
 app.mount("/"+settings.QRCODE_DIR, StaticFiles(directory=settings.QRCODE_DIR), name=settings.QRCODE_DIR)
 app.mount("/"+settings.AVATAR_DIR, StaticFiles(directory=settings.AVATAR_DIR), name=settings.AVATAR_DIR)
 app.mount("/"+settings.ARTICLE_MEDIA, StaticFiles(directory=settings.ARTICLE_MEDIA), name=settings.ARTICLE_MEDIA)
 app.mount("/"+settings.CHAT_MEDIA, StaticFiles(directory=settings.CHAT_MEDIA), name=settings.CHAT_MEDIA)
+app.mount("/"+settings.GROUP_AVATAR_DIR, ImmutableStaticFiles(directory=settings.GROUP_AVATAR_DIR), name=settings.GROUP_AVATAR_DIR)
 
 # 配置 CORS
 app.add_middleware(
@@ -63,6 +70,7 @@ app.include_router(router_comment,prefix="/article")
 app.include_router(router_chat, prefix='/ws/chat')
 app.include_router(router_group)
 app.include_router(router_group_chat, prefix='/ws/group/chat')
+app.include_router(router_mux_chat, prefix='/ws/mux')
 
 if __name__ == "__main__":
     import uvicorn
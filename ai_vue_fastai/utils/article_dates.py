@@ -0,0 +1,72 @@
+# encoding: UTF-8
+import asyncio
+from datetime import datetime
+from pymongo import UpdateOne
+from init import app
+from utils.mongodb import MotorDB
+from utils.log import log_info, log_error
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="article_db")
+
+# 早期以ISO字符串保存的时间字段，按集合列出
+STRING_DATE_FIELDS = {
+    "article": ["created_at", "updated_at"],
+    "comment": ["created_at", "updated_at"],
+    "reply": ["created_dt", "updated_at"],
+    "like": ["create_dt"],
+}
+
+# 每批迁移的文档数
+BACKFILL_BATCH_SIZE = 1000
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+    # 游标分页按 (时间, _id) 倒序，依赖以下索引
+    await mongo.article_db.create_index([("is_delete", 1), ("created_at", -1), ("_id", -1)])
+    await mongo.like_db.create_index([("user_id", 1), ("type", 1), ("create_dt", -1), ("_id", -1)])
+    app.state.article_dates_backfill = asyncio.create_task(backfill_article_dates())
+
+
+async def _backfill_field(collection_name: str, field: str) -> int:
+    """把一个字段的ISO字符串转为BSON日期，返回迁移数量；无法解析的值保留原样并记录日志"""
+    collection = getattr(mongo, f"{collection_name}_db")
+    total, last_id = 0, None
+    while True:
+        # 按 _id 向后翻页，保留原样的值不会被重复读到
+        query = {field: {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        docs = await collection.find_many(
+            query=query,
+            projection={"_id": 1, field: 1},
+            sort=[("_id", 1)],
+            limit=BACKFILL_BATCH_SIZE,
+        )
+        if not docs:
+            return total
+        last_id = docs[-1]["_id"]
+        requests = []
+        for doc in docs:
+            try:
+                value = datetime.fromisoformat(doc[field])
+            except ValueError:
+                log_error(f"无法解析的时间 {collection_name}.{field} _id={doc['_id']}: {doc[field]!r}")
+                continue
+            requests.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: value}}))
+        await collection.bulk_write(requests)
+        total += len(requests)
+
+
+async def backfill_article_dates():
+    """启动时把朋友圈相关集合中的字符串时间迁移为BSON日期，迁移完成后查询为空，开销可以忽略"""
+    for collection_name, fields in STRING_DATE_FIELDS.items():
+        for field in fields:
+            try:
+                count = await _backfill_field(collection_name, field)
+                if count:
+                    log_info(f"迁移时间字段 {collection_name}.{field} {count} 条")
+            except Exception as e:
+                log_error(f"迁移时间字段失败 {collection_name}.{field}: {str(e)}")
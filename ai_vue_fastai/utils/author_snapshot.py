@@ -0,0 +1,99 @@
+# encoding: UTF-8
+import asyncio
+from typing import Any, Dict, Optional
+from pymongo import UpdateMany
+from init import app
+from utils.mongodb import MotorDB
+from utils.database import get_db_session
+from utils.user_profile import get_user_profiles
+from utils.log import log_info, log_error
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="article_db")
+
+# 动态、评论、回复中保存的作者快照：集合 -> (作者ID字段, 用户名字段, 头像字段)
+SNAPSHOT_FIELDS = {
+    "article": ("user_id", "user.username", "user.photo"),
+    "comment": ("comment_user_id", "comment_user_name", "comment_user_photo"),
+    "reply": ("reply_user_id", "reply_user_name", "reply_user_photo"),
+}
+
+# 每批补齐快照的文档数
+BACKFILL_BATCH_SIZE = 1000
+
+UNKNOWN_AUTHOR = {"username": "未知用户", "photo": ""}
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+    # 资料变更时按作者批量更新快照
+    await mongo.comment_db.create_index([("comment_user_id", 1)])
+    await mongo.reply_db.create_index([("reply_user_id", 1)])
+    app.state.author_snapshot_backfill = asyncio.create_task(backfill_author_snapshots())
+
+
+def author_snapshot(user) -> Dict[str, Any]:
+    """写入动态、评论、回复时保存的作者快照"""
+    return {"username": user.username or "", "photo": user.photo or ""}
+
+
+def snapshot_of(moment: Dict[str, Any]) -> Dict[str, Any]:
+    """读取动态中的作者快照，读时不再查询MySQL"""
+    return moment.get("user") or dict(UNKNOWN_AUTHOR)
+
+
+async def propagate_author_profile(user_id: int, username: Optional[str], photo: Optional[str]):
+    """
+    用户修改资料或头像后，把新的用户名和头像批量写入其所有动态、评论、回复的快照
+    只更新快照已过期的文档，重复执行没有额外开销
+    """
+    username, photo = username or "", photo or ""
+    for collection_name, (id_field, name_field, photo_field) in SNAPSHOT_FIELDS.items():
+        try:
+            count = await getattr(mongo, f"{collection_name}_db").update_many(
+                {id_field: user_id, "$or": [{name_field: {"$ne": username}}, {photo_field: {"$ne": photo}}]},
+                {"$set": {name_field: username, photo_field: photo}}
+            )
+            if count:
+                log_info(f"更新作者快照 {collection_name} - 用户ID: {user_id}, {count} 条")
+        except Exception as e:
+            log_error(f"更新作者快照失败 {collection_name} - 用户ID: {user_id}: {str(e)}")
+
+
+async def _backfill_collection(collection_name: str) -> int:
+    """补齐早期评论、回复中缺少的头像快照，返回补齐的作者数"""
+    id_field, name_field, photo_field = SNAPSHOT_FIELDS[collection_name]
+    collection = getattr(mongo, f"{collection_name}_db")
+    total = 0
+    while True:
+        docs = await collection.find_many(
+            query={photo_field: {"$exists": False}},
+            projection={"_id": 0, id_field: 1},
+            limit=BACKFILL_BATCH_SIZE,
+        )
+        user_ids = {doc.get(id_field) for doc in docs}
+        if not docs:
+            return total
+        with get_db_session() as session:
+            profiles = get_user_profiles([user_id for user_id in user_ids if user_id is not None], session)
+        requests = []
+        for user_id in user_ids:
+            profile = profiles.get(user_id) or {}
+            fields = {photo_field: profile.get("photo") or ""}
+            if profile:
+                fields[name_field] = profile.get("username") or ""
+            requests.append(UpdateMany({id_field: user_id, photo_field: {"$exists": False}}, {"$set": fields}))
+        await collection.bulk_write(requests)
+        total += len(user_ids)
+
+
+async def backfill_author_snapshots():
+    """启动时补齐作者快照，补齐后查询为空，开销可以忽略"""
+    for collection_name in ("comment", "reply"):
+        try:
+            count = await _backfill_collection(collection_name)
+            if count:
+                log_info(f"补齐作者快照 {collection_name} {count} 位作者")
+        except Exception as e:
+            log_error(f"补齐作者快照失败 {collection_name}: {str(e)}")
@@ -0,0 +1,252 @@
+# encoding: UTF-8
+import asyncio
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from bson import ObjectId
+from init import app
+from config.settings import settings
+from utils.mongodb import MotorDB
+from utils.redis import redis_client
+from utils.sequence import conversation_key
+from utils.log import log_info, log_error
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="chat_db")
+
+# 单聊、群聊的热数据集合
+KIND_SINGLE = "single"
+KIND_GROUP = "group"
+
+# 每批归档的消息数
+ARCHIVE_BATCH_SIZE = 2000
+
+# 多进程部署时只有一个进程执行归档
+ARCHIVE_LOCK_KEY = "chat_archive_lock"
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+    os.makedirs(settings.CHAT_ARCHIVE_DIR, exist_ok=True)
+    app.state.chat_archive_task = asyncio.create_task(_archive_loop())
+
+
+def _hot_collection(kind: str):
+    return mongo.single_db if kind == KIND_SINGLE else mongo.group_chat_db
+
+
+def _archive_path(key: str, month: str) -> str:
+    """seq:group:group_xxx -> chat_archive/group/group_xxx/2024-01.jsonl.gz"""
+    _, kind, conv = key.split(":", 2)
+    return os.path.join(settings.CHAT_ARCHIVE_DIR, kind, conv.replace(":", "_"), f"{month}.jsonl.gz")
+
+
+def _write_lines(path: str, messages: List[Dict[str, Any]]):
+    """追加写入归档文件（gzip 支持多段拼接，追加后整体仍可读取）"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        for msg in messages:
+            f.write(json.dumps(msg, ensure_ascii=False, default=str) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# 已解析的归档月份文件，按 (路径, 修改时间, 大小) 缓存，文件被追加后自动失效
+_month_cache: "OrderedDict[Tuple[str, int, int], List[Dict[str, Any]]]" = OrderedDict()
+_month_cache_lock = threading.Lock()
+
+
+def _read_month(path: str) -> List[Dict[str, Any]]:
+    """读取一个月的归档消息，最近读取的月份缓存在内存中，不用每次解压解析整个文件"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return []
+    cache_key = (path, stat.st_mtime_ns, stat.st_size)
+    with _month_cache_lock:
+        if cache_key in _month_cache:
+            _month_cache.move_to_end(cache_key)
+            return _month_cache[cache_key]
+    messages = _read_lines(path)
+    with _month_cache_lock:
+        _month_cache[cache_key] = messages
+        while len(_month_cache) > settings.CHAT_ARCHIVE_CACHE_MONTHS:
+            _month_cache.popitem(last=False)
+    return messages
+
+
+def _read_lines(path: str) -> List[Dict[str, Any]]:
+    messages = []
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    messages.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+    except (EOFError, OSError, ValueError) as e:
+        # 归档任务正在追加时可能读到不完整的尾部，忽略已读到的部分之后的内容
+        log_error(f"读取归档文件不完整 {path}: {str(e)}")
+    return messages
+
+
+async def archive_kind(kind: str, cutoff: datetime) -> int:
+    """把 cutoff 之前的消息按会话、按月写入归档文件后从MongoDB删除，返回归档数量"""
+    collection = _hot_collection(kind)
+    cutoff_id = ObjectId.from_datetime(cutoff)
+    total = 0
+    while True:
+        batch = await collection.find_many(
+            query={"_id": {"$lt": cutoff_id}},
+            sort=[("_id", 1)],
+            limit=ARCHIVE_BATCH_SIZE,
+        )
+        if not batch:
+            return total
+
+        files: Dict[Tuple[str, str], List[Dict[str, Any]]] = defaultdict(list)
+        for msg in batch:
+            key = conversation_key(msg.get("from"), msg.get("to"))
+            month = msg["_id"].generation_time.strftime("%Y-%m")
+            files[(key, month)].append({**msg, "_id": str(msg["_id"])})
+
+        # 先写文件再删除，中途失败重跑时读取端按ID去重
+        for (key, month), messages in files.items():
+            await asyncio.to_thread(_write_lines, _archive_path(key, month), messages)
+        # 每个月份记录序号和ID范围，查询时跳过不在范围内的月份
+        updates: Dict[str, Dict[str, Any]] = defaultdict(lambda: {"$max": {"max_seq": 0}, "$min": {},
+                                                                  "$addToSet": {"months": {"$each": []}}})
+        for (key, month), messages in files.items():
+            seqs = [msg.get("seq") or 0 for msg in messages]
+            ids = [msg["_id"] for msg in messages]
+            update = updates[key]
+            update["$max"]["max_seq"] = max(update["$max"]["max_seq"], *seqs)
+            update["$max"][f"ranges.{month}.max_seq"] = max(seqs)
+            update["$max"][f"ranges.{month}.max_id"] = max(ids)
+            update["$min"][f"ranges.{month}.min_seq"] = min(seqs)
+            update["$min"][f"ranges.{month}.min_id"] = min(ids)
+            update["$addToSet"]["months"]["$each"].append(month)
+        for key, update in updates.items():
+            await mongo.chat_archive_meta_db.update_one({"_id": key}, update, upsert=True)
+        await collection.delete_many({"_id": {"$in": [msg["_id"] for msg in batch]}})
+        total += len(batch)
+
+
+async def archive_old_messages() -> int:
+    """归档超过 CHAT_HOT_DAYS 天的单聊和群聊消息，热集合和索引只保留最近的数据"""
+    if not redis_client.set(ARCHIVE_LOCK_KEY, "1", nx=True, ex=settings.CHAT_ARCHIVE_INTERVAL):
+        return 0
+    cutoff = datetime.utcnow() - timedelta(days=settings.CHAT_HOT_DAYS)
+    total = 0
+    for kind in (KIND_SINGLE, KIND_GROUP):
+        count = await archive_kind(kind, cutoff)
+        log_info(f"归档{kind}聊天记录 {count} 条，截止 {cutoff.isoformat()}")
+        total += count
+    return total
+
+
+async def _archive_loop():
+    while True:
+        try:
+            await archive_old_messages()
+        except Exception as e:
+            log_error(f"聊天记录归档失败: {str(e)}")
+        await asyncio.sleep(settings.CHAT_ARCHIVE_INTERVAL)
+
+
+async def archived_max_seq(key: str) -> int:
+    """已归档消息的最大序号，Redis序号丢失时用于保证序号不回退"""
+    meta = await mongo.chat_archive_meta_db.find_one({"_id": key})
+    return (meta or {}).get("max_seq", 0)
+
+
+def _scan(key: str, months: List[str], match: Callable[[Dict[str, Any]], bool],
+          sort_field: str, newest_first: bool, limit: int) -> List[Dict[str, Any]]:
+    """按月份顺序读取归档文件（倒序查询从最新的月份开始），凑满 limit 条后不再读取更早/更晚的月份"""
+    result: List[Dict[str, Any]] = []
+    seen = set()
+    for month in (reversed(months) if newest_first else months):
+        messages = [msg for msg in _read_month(_archive_path(key, month))
+                    if msg.get("is_delete", 0) == 0 and match(msg)]
+        messages.sort(key=lambda msg: (msg.get(sort_field) or 0, msg["_id"]), reverse=newest_first)
+        for msg in messages:
+            if msg["_id"] in seen:
+                continue
+            seen.add(msg["_id"])
+            # 缓存中的消息是共享的，返回副本
+            result.append(dict(msg))
+            if len(result) >= limit:
+                return result
+    return result
+
+
+async def fill_from_archive(hot: List[Dict[str, Any]], user_id: int, target_id, limit: int,
+                            sort: List[tuple], before_time: Optional[datetime] = None,
+                            after_seq: Optional[int] = None,
+                            before_seq: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    历史消息接口的归档补充：热数据不够一页时，从归档文件中补齐更早的消息
+    hot 为按 sort 查询到的热数据（_id 仍为 ObjectId），返回顺序与 sort 一致
+    """
+    sort_field, direction = sort[0]
+    newest_first = direction == -1
+    # 倒序且已满一页，或正序且紧接着 after_seq，说明不涉及归档范围
+    if newest_first and len(hot) >= limit:
+        return hot
+    if not newest_first and hot and after_seq is not None and hot[0].get("seq") == after_seq + 1:
+        return hot
+
+    key = conversation_key(user_id, target_id)
+    meta = await mongo.chat_archive_meta_db.find_one({"_id": key})
+    if not meta or not meta.get("months"):
+        return hot
+    months = sorted(meta["months"])
+
+    # 归档的消息都早于热数据，以热数据中最早的一条为边界
+    use_seq = sort_field == "seq"
+    oldest = (hot[-1] if newest_first else hot[0]) if hot else None
+    if use_seq:
+        bounds = [before_seq] if before_seq else []
+        if oldest and oldest.get("seq"):
+            bounds.append(oldest["seq"])
+    else:
+        bounds = [str(ObjectId.from_datetime(before_time))] if before_time else []
+        if oldest:
+            bounds.append(str(oldest["_id"]))
+    upper = min(bounds) if bounds else None
+
+    # 有范围记录的月份先按范围过滤，整月都不满足条件的文件不读取
+    ranges = meta.get("ranges") or {}
+
+    def month_in_range(month: str) -> bool:
+        month_range = ranges.get(month)
+        if not month_range:
+            return True
+        if use_seq:
+            if upper is not None and month_range.get("min_seq", 0) >= upper:
+                return False
+            return after_seq is None or month_range.get("max_seq", 0) > after_seq
+        return upper is None or month_range.get("min_id", "") < upper
+
+    months = [month for month in months if month_in_range(month)]
+    if not months:
+        return hot
+
+    def match(msg: Dict[str, Any]) -> bool:
+        if use_seq:
+            seq = msg.get("seq") or 0
+            if after_seq is not None and seq <= after_seq:
+                return False
+            return upper is None or seq < upper
+        return upper is None or msg["_id"] < upper
+
+    archived = await asyncio.to_thread(_scan, key, months, match, "seq" if use_seq else "_id",
+                                       newest_first, limit - len(hot) if newest_first else limit)
+    if newest_first:
+        return hot + archived
+    return (archived + hot)[:limit]
@@ -0,0 +1,165 @@
+# encoding: UTF-8
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+from bson import ObjectId
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+from init import app
+from config.settings import settings
+from utils.mongodb import MotorDB
+from utils.redis import redis_client
+from utils.log import log_info, log_error
+from utils.feed_cache import version_key, bump_versions
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="article_db")
+
+# 软删除的动态、评论、回复以及取消的点赞记录超过保留期后移到 <集合>_archive，
+# 热集合中只保留有效数据。先归档子记录再归档父记录，中途失败时下次从父记录重新开始，
+# 归档按 _id 覆盖写入，重复执行结果一致。
+ARCHIVE_SUFFIX = "_archive"
+
+# 多个进程中只有一个执行当次整理
+COMPACTION_LOCK_KEY = "compaction:lock"
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+    # 只索引已删除的文档，索引很小，不影响正常读写
+    for collection_name in ("article", "comment", "reply"):
+        await getattr(mongo, f"{collection_name}_db").create_index(
+            [("is_delete", 1), ("updated_at", 1)], partialFilterExpression={"is_delete": -1}
+        )
+    await mongo.like_db.create_index([("is_like", 1), ("updated_at", 1)], partialFilterExpression={"is_like": 0})
+    app.state.compaction_task = asyncio.create_task(_compaction_loop())
+
+
+async def _move(collection_name: str, docs: List[Dict[str, Any]]) -> int:
+    """把一批文档写入归档集合后从原集合删除，批次之间暂停以限制对线上的影响"""
+    if not docs:
+        return 0
+    now = datetime.now()
+    await getattr(mongo, f"{collection_name}{ARCHIVE_SUFFIX}_db").bulk_write(
+        [ReplaceOne({"_id": doc["_id"]}, {**doc, "archived_at": now}, upsert=True) for doc in docs]
+    )
+    await getattr(mongo, f"{collection_name}_db").bulk_write(
+        [DeleteMany({"_id": {"$in": [doc["_id"] for doc in docs]}})]
+    )
+    await asyncio.sleep(settings.COMPACTION_BATCH_PAUSE)
+    return len(docs)
+
+
+async def _batches(collection_name: str, query: Dict[str, Any]):
+    """逐批取出匹配的文档；每批处理完后已移出原集合，下一次查询自然取到后续文档"""
+    collection = getattr(mongo, f"{collection_name}_db")
+    while True:
+        docs = await collection.find_many(query=query, limit=settings.COMPACTION_BATCH_SIZE)
+        if not docs:
+            return
+        yield docs
+
+
+async def _archive_likes(target_type: str, target_ids: List[str]) -> int:
+    total = 0
+    async for docs in _batches("like", {"type": target_type, "target_id": {"$in": target_ids}}):
+        total += await _move("like", docs)
+    return total
+
+
+async def _archive_replies(query: Dict[str, Any]) -> Dict[str, int]:
+    counts = {"reply": 0, "like": 0}
+    async for docs in _batches("reply", query):
+        counts["like"] += await _archive_likes("reply", [str(doc["_id"]) for doc in docs])
+        counts["reply"] += await _move("reply", docs)
+    return counts
+
+
+async def _archive_comments(query: Dict[str, Any], recount: bool = False) -> Dict[str, int]:
+    """
+    归档评论及其回复、点赞
+    recount 为 True 时（单独删除的评论）归档后按剩余评论重算所属动态的评论数
+    """
+    counts = {"comment": 0, "reply": 0, "like": 0}
+    async for docs in _batches("comment", query):
+        comment_ids = [str(doc["_id"]) for doc in docs]
+        for name, count in (await _archive_replies({"comment_id": {"$in": comment_ids}})).items():
+            counts[name] += count
+        counts["like"] += await _archive_likes("comment", comment_ids)
+        counts["comment"] += await _move("comment", docs)
+        if recount:
+            await _recount_comments({doc.get("moment_id") for doc in docs})
+    return counts
+
+
+async def _recount_comments(moment_ids):
+    """动态的评论数与热集合中剩余的评论保持一致"""
+    moment_ids = [moment_id for moment_id in moment_ids if ObjectId.is_valid(moment_id)]
+    if not moment_ids:
+        return
+    counts = await mongo.comment_db.aggregate([
+        {"$match": {"moment_id": {"$in": moment_ids}, "is_delete": {"$ne": -1}}},
+        {"$group": {"_id": "$moment_id", "count": {"$sum": 1}}},
+    ])
+    count_map = {group["_id"]: group["count"] for group in counts}
+    await mongo.article_db.bulk_write([
+        UpdateOne({"_id": ObjectId(moment_id)}, {"$set": {"stats.comments": count_map.get(moment_id, 0)}})
+        for moment_id in moment_ids
+    ])
+    bump_versions(*[version_key("moment", moment_id) for moment_id in moment_ids])
+
+
+async def _archive_moments(query: Dict[str, Any]) -> Dict[str, int]:
+    counts = {"article": 0, "comment": 0, "reply": 0, "like": 0}
+    async for docs in _batches("article", query):
+        moment_ids = [str(doc["_id"]) for doc in docs]
+        for name, count in (await _archive_comments({"moment_id": {"$in": moment_ids}})).items():
+            counts[name] += count
+        counts["like"] += await _archive_likes("moment", moment_ids)
+        counts["article"] += await _move("article", docs)
+    return counts
+
+
+async def run_compaction() -> Dict[str, int]:
+    """
+    归档超过保留期（COMPACTION_GRACE_DAYS，从删除时间 updated_at 算起）的数据：
+    已删除的动态连同其评论、回复、点赞；已删除的评论连同其回复、点赞；已删除的回复连同其点赞；
+    已取消的点赞记录。返回各集合归档的文档数
+    """
+    cutoff = datetime.now() - timedelta(days=settings.COMPACTION_GRACE_DAYS)
+    deleted = {"is_delete": -1, "updated_at": {"$lt": cutoff}}
+    totals = {"article": 0, "comment": 0, "reply": 0, "like": 0}
+    for counts in (
+        await _archive_moments(deleted),
+        await _archive_comments(deleted, recount=True),
+        await _archive_replies(deleted),
+    ):
+        for name, count in counts.items():
+            totals[name] += count
+    async for docs in _batches("like", {"is_like": 0, "updated_at": {"$lt": cutoff}}):
+        totals["like"] += await _move("like", docs)
+    return totals
+
+
+async def _compaction_loop():
+    while True:
+        await asyncio.sleep(settings.COMPACTION_INTERVAL)
+        try:
+            # 锁在一个周期后过期，多进程部署时每个周期只执行一次
+            if not redis_client.set(COMPACTION_LOCK_KEY, 1, nx=True, ex=settings.COMPACTION_INTERVAL):
+                continue
+            totals = await run_compaction()
+            log_info(f"归档已删除数据: {totals}")
+        except Exception as e:
+            log_error(f"归档已删除数据失败: {str(e)}")
+
+
+async def _run_offline():
+    await mongo.connect()
+    totals = await run_compaction()
+    log_info(f"归档已删除数据: {totals}")
+
+
+if __name__ == "__main__":
+    # 离线执行：python -m utils.compaction
+    asyncio.run(_run_offline())
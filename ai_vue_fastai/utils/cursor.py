@@ -0,0 +1,56 @@
+# encoding: UTF-8
+import base64
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+from bson import ObjectId
+from fastapi import HTTPException
+
+# BSON日期精度为毫秒，游标和时间线分数都按毫秒计
+_EPOCH = datetime(1970, 1, 1)
+_MILLISECOND = timedelta(milliseconds=1)
+
+
+def to_millis(value: Any) -> int:
+    """时间转为毫秒数（兼容尚未迁移的ISO字符串）"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if not isinstance(value, datetime):
+        return 0
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return (value - _EPOCH) // _MILLISECOND
+
+
+def from_millis(millis: int) -> datetime:
+    return _EPOCH + timedelta(milliseconds=millis)
+
+
+def encode_cursor(value: Any, object_id: Any) -> str:
+    """把排序字段和 _id 编码为不透明游标"""
+    raw = f"{to_millis(value)}:{object_id}".encode("ascii")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, ObjectId]:
+    """解析游标，返回 (毫秒数, _id)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        millis, object_id = raw.split(":", 1)
+        return int(millis), ObjectId(object_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="无效的游标")
+
+
+def cursor_query(field: str, cursor: Optional[str]) -> Dict[str, Any]:
+    """
+    倒序分页的查询条件：(field, _id) 严格小于游标
+    配合 (..., field -1, _id -1) 索引，下一页只需一次查询
+    """
+    if not cursor:
+        return {}
+    millis, object_id = decode_cursor(cursor)
+    value = from_millis(millis)
+    return {"$or": [
+        {field: {"$lt": value}},
+        {field: value, "_id": {"$lt": object_id}},
+    ]}
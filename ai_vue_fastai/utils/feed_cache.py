@@ -0,0 +1,90 @@
+# encoding: UTF-8
+import hashlib
+import json
+from typing import Any, Dict, Iterable, Optional
+import redis
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from config.settings import settings
+from utils.redis import redis_client
+from utils.log import log_error
+
+# 朋友圈列表、详情的响应缓存
+# 每条缓存记录依赖若干版本号（时间线、动态、评论、回复），发布、删除、点赞、评论时递增对应版本号；
+# 读取时一次 MGET 校验版本号，未变化则直接返回缓存的响应体，不查询MongoDB。
+# 响应带强 ETag，客户端带 If-None-Match 且未变化时返回 304。
+
+
+def version_key(kind: str, target_id: Any) -> str:
+    """kind 为 timeline / moment / comment / reply"""
+    return f"ver:{kind}:{target_id}"
+
+
+def bump_versions(*keys: str):
+    """数据变化后递增版本号，依赖这些版本号的缓存随之失效"""
+    if not keys:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.incr(key)
+            pipe.expire(key, settings.FEED_VERSION_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        log_error(f"更新缓存版本号失败: {str(e)}")
+
+
+def _cache_key(name: str) -> str:
+    return f"feed_cache:{name}"
+
+
+def get_cached(name: str) -> Optional[Dict[str, Any]]:
+    """读取缓存，依赖的版本号有任何变化时视为未命中"""
+    try:
+        raw = redis_client.get(_cache_key(name))
+        if not raw:
+            return None
+        entry = json.loads(raw)
+        deps = entry.get("deps") or {}
+        if deps and redis_client.mget(list(deps)) != list(deps.values()):
+            return None
+        return entry
+    except (redis.RedisError, ValueError) as e:
+        log_error(f"读取响应缓存失败 {name}: {str(e)}")
+        return None
+
+
+def snapshot_versions(keys: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    读取依赖版本号的当前值，需在读取对应数据之前调用：
+    生成响应期间发生的变化会递增版本号，缓存在下次读取时即失效
+    """
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return {}
+    try:
+        return dict(zip(keys, redis_client.mget(keys)))
+    except redis.RedisError as e:
+        log_error(f"读取缓存版本号失败: {str(e)}")
+        # 记录一个不会匹配的值，这条缓存下次读取时视为未命中
+        return {key: "-" for key in keys}
+
+
+def set_cached(name: str, content: Any, versions: Dict[str, Optional[str]]) -> Dict[str, Any]:
+    """缓存响应体和生成前读取的依赖版本号（snapshot_versions 的返回值），返回缓存记录"""
+    body = json.dumps(jsonable_encoder(content), ensure_ascii=False, separators=(",", ":"))
+    entry = {"etag": f'"{hashlib.sha1(body.encode("utf-8")).hexdigest()}"', "body": body, "deps": dict(versions)}
+    try:
+        redis_client.set(_cache_key(name), json.dumps(entry, ensure_ascii=False), ex=settings.FEED_CACHE_TTL)
+    except redis.RedisError as e:
+        log_error(f"写入响应缓存失败 {name}: {str(e)}")
+    return entry
+
+
+def etag_response(request: Request, entry: Dict[str, Any]) -> Response:
+    """If-None-Match 与 ETag 一致时返回 304，否则返回缓存的响应体"""
+    headers = {"ETag": entry["etag"], "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match") or ""
+    if entry["etag"] in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
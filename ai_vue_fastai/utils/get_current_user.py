@@ -74,5 +74,35 @@ def get_current_user_id(current_user: TokenData = Depends(get_current_user)):
     """
     return current_user.id
 
+
+# 未携带token时不报错，用于登录与未登录都可访问的接口
+optional_oauth2_scheme = HTTPBearer(auto_error=False)
+
+
+async def get_optional_user_id(
+        credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_oauth2_scheme)) -> Optional[int]:
+    """
+    获取当前用户ID，未登录时返回 None；携带了无效token时仍返回401
+    """
+    if not credentials:
+        return None
+    current_user = await get_current_user(credentials)
+    return current_user.id if current_user else None
+
+
+async def get_websocket_user_id(token: Optional[str]) -> Optional[int]:
+    """
+    WebSocket握手无法携带Authorization头，token通过查询参数传入，解析方式与 get_current_user_id 相同
+    token缺失或无效时返回 None
+    """
+    if not token:
+        return None
+    try:
+        current_user = await get_current_user(HTTPAuthorizationCredentials(scheme="Bearer", credentials=token))
+    except Exception as e:
+        log_error(f"WebSocket认证失败: {str(e)}")
+        return None
+    return current_user.id if current_user else None
+
 #  - 创建token - 使用的SECRET_KEY:abc12#@$%^&1
 #  创建token - 使用的ALGORITHM:HS256
\ No newline at end of file
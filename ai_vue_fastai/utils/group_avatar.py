@@ -0,0 +1,140 @@
+# encoding: UTF-8
+import asyncio
+import hashlib
+import os
+from typing import Any, Dict, List, Optional, Tuple
+from PIL import Image, ImageOps
+from fastapi.staticfiles import StaticFiles
+from sqlmodel import Session
+from config.settings import settings
+from utils.mongodb import MotorDB
+from utils.group_cache import group_cache
+from utils.database import engine
+from utils.group_member import list_member_ids, get_user_group_ids
+from utils.user_profile import get_user_profiles
+from utils.recent_chat import update_group_summaries
+from utils.log import log_info, log_error
+from init import app
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="chat_db")
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+
+# 组合头像最多拼接的成员数
+AVATAR_TILE_COUNT = 9
+# 头像之间的间隔和背景色
+AVATAR_GAP = 4
+AVATAR_BACKGROUND = (221, 221, 221)
+# 没有头像或头像读取失败的成员
+AVATAR_PLACEHOLDER = (180, 180, 180)
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """文件名是内容哈希，内容不会变化，允许浏览器长期缓存"""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+def _grid_size(count: int) -> int:
+    """1人一格，2~4人2x2，5~9人3x3"""
+    if count <= 1:
+        return 1
+    return 2 if count <= 4 else 3
+
+
+def _load_tile(photo: str, size: int) -> Image.Image:
+    """读取本地保存的头像（/avatar/xxx.png），失败时用占位色块"""
+    path = photo.lstrip("/") if photo else ""
+    if path.startswith(settings.AVATAR_DIR + "/") and os.path.isfile(path):
+        try:
+            with Image.open(path) as image:
+                return ImageOps.fit(image.convert("RGB"), (size, size))
+        except OSError as e:
+            log_error(f"读取头像失败 {photo}: {str(e)}")
+    return Image.new("RGB", (size, size), AVATAR_PLACEHOLDER)
+
+
+def _render(photos: List[str], save_path: str):
+    """把成员头像拼成一张九宫格缩略图"""
+    canvas_size = settings.GROUP_AVATAR_SIZE
+    grid = _grid_size(len(photos))
+    tile_size = (canvas_size - AVATAR_GAP * (grid + 1)) // grid
+    canvas = Image.new("RGB", (canvas_size, canvas_size), AVATAR_BACKGROUND)
+
+    rows = [photos[i:i + grid] for i in range(0, len(photos), grid)]
+    # 整体垂直居中，人数不满一行时该行水平居中
+    top = (canvas_size - len(rows) * (tile_size + AVATAR_GAP) + AVATAR_GAP) // 2
+    for row_index, row in enumerate(rows):
+        left = (canvas_size - len(row) * (tile_size + AVATAR_GAP) + AVATAR_GAP) // 2
+        y = top + row_index * (tile_size + AVATAR_GAP)
+        for col_index, photo in enumerate(row):
+            canvas.paste(_load_tile(photo, tile_size), (left + col_index * (tile_size + AVATAR_GAP), y))
+
+    # 先写临时文件再改名，并发生成同一个头像时不会读到半个文件
+    tmp_path = f"{save_path}.{os.getpid()}.tmp"
+    canvas.save(tmp_path, "PNG", optimize=True)
+    os.replace(tmp_path, save_path)
+
+
+async def get_avatar_members(group: Dict[str, Any], session: Session) -> Tuple[List[int], List[str]]:
+    """组合头像使用的成员：群主在前，按入群时间取前9人；返回成员ID和头像"""
+    group_id = group["group_id"]
+    creator_id = group.get("creator_id")
+    member_ids = await list_member_ids(group_id, limit=AVATAR_TILE_COUNT)
+    if creator_id in member_ids:
+        member_ids.remove(creator_id)
+        member_ids.insert(0, creator_id)
+    profiles = get_user_profiles(member_ids, session)
+    photos = [(profiles.get(user_id) or {}).get("photo") or "" for user_id in member_ids]
+    return member_ids, photos
+
+
+async def ensure_group_avatar(group: Dict[str, Any], session: Session) -> Tuple[str, List[str]]:
+    """
+    返回群组合头像地址和前9个成员的头像，并保存到群文档（group_avatar、avatar_members）
+    文件名是成员和头像的哈希，前9个成员或他们的头像变化后才重新生成
+    """
+    group_id = group["group_id"]
+    member_ids, photos = await get_avatar_members(group, session)
+    digest = hashlib.sha1("|".join(f"{user_id}:{photo}" for user_id, photo in zip(member_ids, photos))
+                          .encode("utf-8")).hexdigest()[:20]
+    filename = f"{digest}.png"
+    save_path = os.path.join(settings.GROUP_AVATAR_DIR, filename)
+    avatar_url = f"/{settings.GROUP_AVATAR_DIR}/{filename}"
+
+    if not os.path.exists(save_path):
+        await asyncio.to_thread(_render, photos, save_path)
+        log_info(f"生成群组合头像 - 群ID: {group_id}, 文件: {filename}")
+
+    if group.get("group_avatar") != avatar_url or group.get("avatar_members") != photos:
+        await mongo.group_db.update_one({"group_id": group_id},
+                                        {"$set": {"group_avatar": avatar_url, "avatar_members": photos}})
+        await update_group_summaries(group_id, {"target_photo": avatar_url})
+        group_cache.invalidate(group_id)
+    return avatar_url, photos
+
+
+async def refresh_group_avatar(group_id: str, session: Session) -> Optional[str]:
+    """建群、加人、移除成员、退群后调用，重新生成组合头像；失败只记录日志，不影响成员变更"""
+    try:
+        group = await group_cache.get(group_id)
+        if not group or group.get("delete") == -1:
+            return None
+        avatar_url, _ = await ensure_group_avatar(group, session)
+        return avatar_url
+    except Exception as e:
+        log_error(f"生成群组合头像失败 - 群ID: {group_id}: {str(e)}")
+        return None
+
+
+async def refresh_user_group_avatars(user_id: int):
+    """用户更换头像后在后台执行：该用户所在群的组合头像按新头像重新生成（不在前9人中的群不会变化）"""
+    with Session(engine) as session:
+        for group_id in await get_user_group_ids(user_id):
+            await refresh_group_avatar(group_id, session)
@@ -0,0 +1,125 @@
+# encoding: UTF-8
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+import redis
+from init import app
+from config.settings import settings
+from utils.mongodb import MotorDB
+from utils.redis import redis_client
+from utils.log import log_error
+from utils import group_member
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="chat_db")
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+
+# 缓存的群字段，不包含 _id；成员单独保存在 group_member 及其Redis集合中
+GROUP_PROJECTION = {
+    "_id": 0, "group_id": 1, "name": 1, "creator_id": 1, "members_count": 1,
+    "photo": 1, "group_avatar": 1, "avatar_members": 1, "description": 1, "delete": 1, "created_at": 1, "fanout_on_read": 1,
+}
+
+
+def _group_key(group_id: str) -> str:
+    return f"group_meta:{group_id}"
+
+
+def _dumps(group: Dict[str, Any]) -> str:
+    return json.dumps({k: v.isoformat() if isinstance(v, datetime) else v for k, v in group.items()})
+
+
+def _loads(data: str) -> Dict[str, Any]:
+    group = json.loads(data)
+    if isinstance(group.get("created_at"), str):
+        group["created_at"] = datetime.fromisoformat(group["created_at"])
+    return group
+
+
+class GroupCache:
+    """
+    群信息两级缓存：进程内LRU + Redis
+    群名称、群主、人数等在修改群的接口里失效，消息和成员校验不再每次查Mongo
+    """
+
+    def __init__(self, max_size: int, local_ttl: int, redis_ttl: int):
+        self.max_size = max_size
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        # group_id -> (过期时间, 群信息)
+        self._local: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def _put_local(self, group_id: str, group: Dict[str, Any]):
+        self._local[group_id] = (time.monotonic() + self.local_ttl, group)
+        self._local.move_to_end(group_id)
+        while len(self._local) > self.max_size:
+            self._local.popitem(last=False)
+
+    def _get_local(self, group_id: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        entry = self._local.get(group_id)
+        if not entry:
+            return None
+        if entry[0] < time.monotonic():
+            self._local.pop(group_id, None)
+            return None
+        self._local.move_to_end(group_id)
+        return entry
+
+    async def _load(self, group_id: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        entry = self._get_local(group_id)
+        if entry:
+            return entry
+
+        group = None
+        try:
+            cached = redis_client.get(_group_key(group_id))
+            if cached:
+                group = _loads(cached)
+        except (redis.RedisError, ValueError) as e:
+            log_error(f"读取群缓存失败 {group_id}: {str(e)}")
+
+        if group is None:
+            group = await mongo.group_db.find_one({"group_id": group_id}, GROUP_PROJECTION)
+            if not group:
+                return None
+            try:
+                redis_client.set(_group_key(group_id), _dumps(group), ex=self.redis_ttl)
+            except redis.RedisError as e:
+                log_error(f"写入群缓存失败 {group_id}: {str(e)}")
+
+        self._put_local(group_id, group)
+        return self._local[group_id]
+
+    async def get(self, group_id: str) -> Optional[Dict[str, Any]]:
+        """获取群信息（只读，不要修改返回的字典）"""
+        entry = await self._load(group_id)
+        return entry[1] if entry else None
+
+    async def is_member(self, group_id: str, user_id: int) -> bool:
+        """成员校验走 group_member 的Redis集合"""
+        entry = await self._load(group_id)
+        return bool(entry) and await group_member.is_member(group_id, user_id)
+
+    def invalidate_local(self, group_id: str):
+        """只清除本进程的缓存（其他进程发来的群变更事件）"""
+        self._local.pop(group_id, None)
+
+    def invalidate(self, group_id: str):
+        """群信息变更后调用"""
+        self.invalidate_local(group_id)
+        try:
+            redis_client.delete(_group_key(group_id))
+        except redis.RedisError as e:
+            log_error(f"删除群缓存失败 {group_id}: {str(e)}")
+
+
+group_cache = GroupCache(
+    max_size=settings.GROUP_CACHE_SIZE,
+    local_ttl=settings.GROUP_CACHE_LOCAL_TTL,
+    redis_ttl=settings.GROUP_CACHE_REDIS_TTL,
+)
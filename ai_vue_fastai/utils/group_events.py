@@ -0,0 +1,147 @@
+# encoding: UTF-8
+import asyncio
+import json
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+import redis
+import redis.asyncio as aioredis
+from init import app
+from config.settings import settings
+from utils.redis import redis_client
+from utils.group_cache import group_cache
+from utils.group_member import get_member_ids
+from utils.log import log_info, log_error
+
+# 群变更事件频道，所有进程订阅
+GROUP_EVENT_CHANNEL = "group_events"
+
+# 本进程标识，收到自己发布的事件时跳过（发布时已在本地处理过）
+_process_id = uuid.uuid4().hex
+
+# 事件类型
+MEMBERS_ADDED = "members_added"
+MEMBERS_REMOVED = "members_removed"
+GROUP_RENAMED = "renamed"
+GROUP_DISMISSED = "dismissed"
+SYSTEM_MESSAGES = "system_messages"
+
+# 会改变群信息的事件，收到后清除本进程的群缓存
+_GROUP_CHANGE_EVENTS = (MEMBERS_ADDED, MEMBERS_REMOVED, GROUP_RENAMED, GROUP_DISMISSED)
+
+
+class LiveGroupMembers:
+    """
+    本进程内有在线连接的群的成员集合
+    连接建立时登记，群变更事件到达时增量更新，广播时直接读取，不用每条消息重新查群
+    """
+
+    def __init__(self):
+        self._members: Dict[str, Set[int]] = {}
+        self._refs: Dict[str, int] = {}
+
+    def track(self, group_id: str, members: Iterable[int]):
+        """有连接进入群聊时登记（引用计数）"""
+        if group_id not in self._members:
+            self._members[group_id] = set(members)
+        self._refs[group_id] = self._refs.get(group_id, 0) + 1
+
+    def release(self, group_id: str):
+        """连接离开群聊时释放，没有连接后不再维护"""
+        refs = self._refs.get(group_id, 0) - 1
+        if refs > 0:
+            self._refs[group_id] = refs
+        else:
+            self._refs.pop(group_id, None)
+            self._members.pop(group_id, None)
+
+    def members(self, group_id: str) -> Optional[Set[int]]:
+        return self._members.get(group_id)
+
+    def is_member(self, group_id: str, user_id: int) -> bool:
+        members = self._members.get(group_id)
+        return members is not None and user_id in members
+
+    def apply(self, event: Dict[str, Any]):
+        members = self._members.get(event.get("group_id"))
+        if members is None:
+            return
+        if event["type"] == MEMBERS_ADDED:
+            members.update(event.get("user_ids") or [])
+        elif event["type"] == MEMBERS_REMOVED:
+            members.difference_update(event.get("user_ids") or [])
+        elif event["type"] == GROUP_DISMISSED:
+            members.clear()
+
+
+live_members = LiveGroupMembers()
+
+
+async def track_live_group(group_id: str):
+    """有连接进入群聊时登记，首次登记时从成员存储加载成员集合"""
+    members = () if live_members.members(group_id) is not None else await get_member_ids(group_id)
+    live_members.track(group_id, members)
+
+# 其他模块注册的事件处理函数
+_handlers: List[Callable[[Dict[str, Any]], Awaitable[None]]] = []
+
+
+def on_group_event(handler: Callable[[Dict[str, Any]], Awaitable[None]]):
+    """注册群变更事件处理函数（装饰器）"""
+    _handlers.append(handler)
+    return handler
+
+
+async def _apply(event: Dict[str, Any]):
+    if event["type"] in _GROUP_CHANGE_EVENTS:
+        group_cache.invalidate_local(event["group_id"])
+    live_members.apply(event)
+    for handler in _handlers:
+        try:
+            await handler(event)
+        except Exception as e:
+            log_error(f"处理群事件失败 {event}: {str(e)}")
+
+
+async def publish_group_event(event_type: str, group_id: str, **data):
+    """群接口修改群信息后调用：本进程立即生效，再通过Redis通知其他进程"""
+    event = {"type": event_type, "group_id": group_id, **data}
+    await _apply(event)
+    try:
+        redis_client.publish(GROUP_EVENT_CHANNEL, json.dumps({**event, "origin": _process_id}, default=str))
+    except redis.RedisError as e:
+        log_error(f"发布群事件失败: {str(e)}")
+
+
+async def _listen_group_events():
+    """订阅群变更事件，连接断开后自动重连"""
+    while True:
+        client = aioredis.Redis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_DB,
+            password=settings.REDIS_PASSWORD,
+            decode_responses=True,
+        )
+        try:
+            pubsub = client.pubsub()
+            await pubsub.subscribe(GROUP_EVENT_CHANNEL)
+            log_info("已订阅群变更事件")
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                event = json.loads(message["data"])
+                if event.pop("origin", None) == _process_id:
+                    continue
+                await _apply(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_error(f"群事件订阅异常，稍后重连: {str(e)}")
+            await asyncio.sleep(1)
+        finally:
+            await client.close()
+
+
+@app.on_event("startup")
+async def start_group_event_listener():
+    app.state.group_event_listener = asyncio.create_task(_listen_group_events())
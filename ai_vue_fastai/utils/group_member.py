@@ -0,0 +1,248 @@
+# encoding: UTF-8
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import redis
+from pymongo import UpdateOne
+from init import app
+from config.settings import settings
+from utils.mongodb import MotorDB
+from utils.redis import redis_client
+from utils.log import log_info, log_error
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="chat_db")
+
+# 成员角色
+ROLE_OWNER = "owner"
+ROLE_MEMBER = "member"
+
+# 只在集合已缓存时追加成员，未缓存时等下次读取整体加载，避免缓存出一个不完整的集合
+_add_if_cached = redis_client.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('SADD', KEYS[1], unpack(ARGV))
+end
+return 0
+""")
+
+# 成员集合的版本号在移除成员时递增；从MongoDB加载的成员只在版本号未变时写入缓存，
+# 避免加载期间被移除的成员又被写回集合
+_cache_if_unchanged = redis_client.register_script("""
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('SADD', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+    # 按群查成员、按用户查加入的群都走索引
+    await mongo.group_member_db.create_index([("group_id", 1), ("user_id", 1)], unique=True)
+    await mongo.group_member_db.create_index([("user_id", 1), ("joined_at", -1)])
+    # 旧群的成员迁移在启动时完成，读取路径只查 group_member，不再逐次回退读取群文档
+    await backfill_group_members()
+
+
+def _members_key(group_id: str) -> str:
+    return f"group_members:{group_id}"
+
+
+def _version_key(group_id: str) -> str:
+    return f"group_members_ver:{group_id}"
+
+
+def _dedupe(user_ids: Iterable[int]) -> List[int]:
+    return list(dict.fromkeys(int(user_id) for user_id in user_ids))
+
+
+async def add_members(group_id: str, user_ids: Iterable[int], role: str = ROLE_MEMBER) -> List[int]:
+    """
+    添加群成员，已在群中的用户不会重复添加
+    返回本次新加入的用户ID
+    """
+    user_ids = _dedupe(user_ids)
+    if not user_ids:
+        return []
+
+    existing = await mongo.group_member_db.find_many(
+        query={"group_id": group_id, "user_id": {"$in": user_ids}},
+        projection={"_id": 0, "user_id": 1},
+    )
+    existing_ids = {doc["user_id"] for doc in existing}
+    added = [user_id for user_id in user_ids if user_id not in existing_ids]
+    if not added:
+        return []
+
+    now = datetime.utcnow()
+    # upsert 保证并发添加同一成员时也只有一条记录
+    await mongo.group_member_db.bulk_write([
+        UpdateOne(
+            {"group_id": group_id, "user_id": user_id},
+            {"$setOnInsert": {"group_id": group_id, "user_id": user_id, "role": role, "joined_at": now}},
+            upsert=True,
+        )
+        for user_id in added
+    ])
+
+    try:
+        _add_if_cached(keys=[_members_key(group_id)], args=added)
+    except redis.RedisError as e:
+        log_error(f"更新群成员缓存失败 {group_id}: {str(e)}")
+    return added
+
+
+async def init_members(groups: Iterable[Tuple[str, int, List[int]]]) -> int:
+    """
+    新建群时写入成员：所有群的成员一次 bulk_write
+    groups 为 (群ID, 群主ID, 成员ID列表)，使用 upsert，失败重试时不会重复写入
+    """
+    now = datetime.utcnow()
+    requests = []
+    for group_id, creator_id, user_ids in groups:
+        for user_id in _dedupe(user_ids):
+            role = ROLE_OWNER if user_id == creator_id else ROLE_MEMBER
+            requests.append(UpdateOne(
+                {"group_id": group_id, "user_id": user_id},
+                # 群主先入群，成员列表和组合头像按入群时间排序时排在第一位
+                {"$setOnInsert": {"group_id": group_id, "user_id": user_id, "role": role,
+                                  "joined_at": now if role == ROLE_MEMBER else now - timedelta(milliseconds=1)}},
+                upsert=True,
+            ))
+    return await mongo.group_member_db.bulk_write(requests)
+
+
+async def remove_members(group_id: str, user_ids: Iterable[int]) -> int:
+    """移除群成员，返回实际移除的数量"""
+    user_ids = _dedupe(user_ids)
+    if not user_ids:
+        return 0
+    removed = await mongo.group_member_db.delete_many({"group_id": group_id, "user_id": {"$in": user_ids}})
+    try:
+        pipe = redis_client.pipeline()
+        pipe.incr(_version_key(group_id))
+        pipe.expire(_version_key(group_id), settings.GROUP_CACHE_REDIS_TTL)
+        pipe.srem(_members_key(group_id), *user_ids)
+        pipe.execute()
+    except redis.RedisError as e:
+        log_error(f"更新群成员缓存失败 {group_id}: {str(e)}")
+    return removed
+
+
+async def _migrate_legacy_members(group_id: str) -> List[int]:
+    """旧数据的成员保存在群文档的 members 数组中，迁移到 group_member 后删除该数组"""
+    group = await mongo.group_db.find_one({"group_id": group_id}, {"_id": 0, "creator_id": 1, "members": 1})
+    if not group or not group.get("members"):
+        return []
+    creator_id = group.get("creator_id")
+    members = [user_id for user_id in _dedupe(group["members"]) if user_id != creator_id]
+    if creator_id is not None:
+        await add_members(group_id, [creator_id], role=ROLE_OWNER)
+    await add_members(group_id, members)
+    # 旧数组中的重复成员会让 members_count 偏大，按实际成员数重置
+    members_count = await mongo.group_member_db.count_documents({"group_id": group_id})
+    await mongo.group_db.update_one({"group_id": group_id},
+                                    {"$unset": {"members": ""}, "$set": {"members_count": members_count}})
+    log_info(f"群 {group_id} 成员迁移到 group_member，共 {len(members) + 1} 人")
+    return ([creator_id] if creator_id is not None else []) + members
+
+
+async def backfill_group_members():
+    """启动时迁移仍在群文档中保存成员数组的旧群，迁移完成后查询为空，开销可以忽略"""
+    try:
+        legacy_groups = await mongo.group_db.find_many(
+            query={"members": {"$exists": True}},
+            projection={"_id": 0, "group_id": 1},
+        )
+        for group in legacy_groups:
+            await _migrate_legacy_members(group["group_id"])
+    except Exception as e:
+        log_error(f"迁移群成员失败: {str(e)}")
+
+
+async def get_member_ids(group_id: str) -> Set[int]:
+    """获取群成员ID集合，优先读Redis集合，未命中时从 group_member 加载并缓存"""
+    key = _members_key(group_id)
+    version = "0"
+    try:
+        pipe = redis_client.pipeline()
+        pipe.smembers(key)
+        pipe.get(_version_key(group_id))
+        cached, version = pipe.execute()
+        if cached:
+            return {int(user_id) for user_id in cached}
+        version = version or "0"
+    except redis.RedisError as e:
+        log_error(f"读取群成员缓存失败 {group_id}: {str(e)}")
+
+    docs = await mongo.group_member_db.find_many(
+        query={"group_id": group_id},
+        projection={"_id": 0, "user_id": 1},
+    )
+    member_ids = [doc["user_id"] for doc in docs]
+    if member_ids:
+        try:
+            _cache_if_unchanged(keys=[key, _version_key(group_id)],
+                                args=[version, settings.GROUP_CACHE_REDIS_TTL, *member_ids])
+        except redis.RedisError as e:
+            log_error(f"写入群成员缓存失败 {group_id}: {str(e)}")
+    return set(member_ids)
+
+
+async def is_member(group_id: str, user_id: int) -> bool:
+    """成员校验：集合已缓存时一次 SISMEMBER"""
+    key = _members_key(group_id)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.exists(key)
+        pipe.sismember(key, int(user_id))
+        exists, found = pipe.execute()
+        if exists:
+            return bool(found)
+    except redis.RedisError as e:
+        log_error(f"读取群成员缓存失败 {group_id}: {str(e)}")
+    return int(user_id) in await get_member_ids(group_id)
+
+
+async def list_member_ids(group_id: str, limit: int = 0) -> List[int]:
+    """按入群时间排序的成员ID（群主最先入群，排在第一位）"""
+    docs = await mongo.group_member_db.find_many(
+        query={"group_id": group_id},
+        projection={"_id": 0, "user_id": 1},
+        sort=[("joined_at", 1), ("user_id", 1)],
+        limit=limit,
+    )
+    return [doc["user_id"] for doc in docs]
+
+
+async def page_member_ids(group_id: str, after: Optional[int] = None, limit: int = 100,
+                          exclude: Optional[int] = None) -> List[int]:
+    """按用户ID分页的成员ID，走 (group_id, user_id) 索引，after 为上一页最后一个用户ID"""
+    user_query: Dict[str, int] = {}
+    if after is not None:
+        user_query["$gt"] = after
+    if exclude is not None:
+        user_query["$ne"] = exclude
+    query = {"group_id": group_id}
+    if user_query:
+        query["user_id"] = user_query
+    docs = await mongo.group_member_db.find_many(
+        query=query,
+        projection={"_id": 0, "user_id": 1},
+        sort=[("user_id", 1)],
+        limit=limit,
+    )
+    return [doc["user_id"] for doc in docs]
+
+
+async def get_user_group_ids(user_id: int) -> List[str]:
+    """用户加入的群ID，按入群时间倒序，走 (user_id, joined_at) 索引"""
+    docs = await mongo.group_member_db.find_many(
+        query={"user_id": user_id},
+        projection={"_id": 0, "group_id": 1},
+        sort=[("joined_at", -1)],
+    )
+    return [doc["group_id"] for doc in docs]
@@ -0,0 +1,90 @@
+# encoding: UTF-8
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+import redis
+from init import app
+from config.settings import settings
+from utils.mongodb import MotorDB
+from utils.redis import redis_client
+from utils.group_member import get_user_group_ids
+from utils.log import log_error
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="chat_db")
+
+# 空集合无法保存在Redis中，用占位成员表示“已缓存且没有人免打扰”
+_EMPTY_MARK = "-"
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+    # 按用户批量查免打扰、按群查免打扰成员都走索引
+    await mongo.group_mute_db.create_index([("user_id", 1), ("group_id", 1)])
+    await mongo.group_mute_db.create_index([("group_id", 1), ("muted", 1)])
+
+
+def _muted_key(group_id: str) -> str:
+    return f"group_muted:{group_id}"
+
+
+async def get_mute_flags(user_id: int, group_ids: Optional[List[str]] = None) -> Dict[str, bool]:
+    """
+    用户在多个群的免打扰状态，一次查询
+    不传 group_ids 时返回用户加入的所有群；没有记录的群默认未开启免打扰
+    """
+    if group_ids is None:
+        group_ids = await get_user_group_ids(user_id)
+    if not group_ids:
+        return {}
+    docs = await mongo.group_mute_db.find_many(
+        query={"user_id": user_id, "group_id": {"$in": group_ids}},
+        projection={"_id": 0, "group_id": 1, "muted": 1},
+    )
+    flags = {group_id: False for group_id in group_ids}
+    for doc in docs:
+        flags[doc["group_id"]] = bool(doc.get("muted"))
+    return flags
+
+
+async def set_mute(user_id: int, group_id: str, muted: bool):
+    """设置免打扰状态，并清除该群的免打扰成员缓存"""
+    await mongo.group_mute_db.update_one(
+        {"user_id": user_id, "group_id": group_id},
+        {"$set": {
+            "user_id": user_id,
+            "group_id": group_id,
+            "muted": muted,
+            "create_dt": datetime.utcnow()
+        }},
+        upsert=True
+    )
+    try:
+        redis_client.delete(_muted_key(group_id))
+    except redis.RedisError as e:
+        log_error(f"清除免打扰缓存失败 {group_id}: {str(e)}")
+
+
+async def get_muted_members(group_id: str) -> Set[int]:
+    """群内开启免打扰的成员，广播消息时跳过他们的未读数累加"""
+    key = _muted_key(group_id)
+    try:
+        cached = redis_client.smembers(key)
+        if cached:
+            return {int(user_id) for user_id in cached if user_id != _EMPTY_MARK}
+    except redis.RedisError as e:
+        log_error(f"读取免打扰缓存失败 {group_id}: {str(e)}")
+
+    docs = await mongo.group_mute_db.find_many(
+        query={"group_id": group_id, "muted": True},
+        projection={"_id": 0, "user_id": 1},
+    )
+    muted = {doc["user_id"] for doc in docs}
+    try:
+        pipe = redis_client.pipeline()
+        pipe.sadd(key, *(muted or [_EMPTY_MARK]))
+        pipe.expire(key, settings.GROUP_CACHE_REDIS_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        log_error(f"写入免打扰缓存失败 {group_id}: {str(e)}")
+    return muted
@@ -0,0 +1,294 @@
+# encoding: UTF-8
+import asyncio
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import redis
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo import DeleteMany, UpdateMany, UpdateOne
+from init import app
+from config.settings import settings
+from utils.mongodb import MotorDB
+from utils.redis import redis_client
+from utils.log import log_info, log_error
+from utils.feed_cache import version_key, bump_versions
+from utils.trending import record_event
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="article_db")
+
+# 点赞对象类型 -> (所在集合, 点赞记录中的旧字段名)
+LIKE_TARGETS = {
+    "moment": ("article", "moment_id"),
+    "comment": ("comment", "comment_id"),
+    "reply": ("reply", "reply_id"),
+}
+
+# 热点对象的点赞数增量先累加在这个哈希中，字段为 "类型:对象ID"
+PENDING_KEY = "like_pending"
+# 并发点赞或重复提交时 upsert 可能撞上唯一索引，重试一次即转为更新
+LIKE_RETRIES = 2
+
+# 原子地取出并清空待写入的增量，多进程同时刷写时每个增量只会被一个进程取走
+_take_pending = redis_client.register_script("""
+local pending = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return pending
+""")
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+    app.state.like_flush_task = asyncio.create_task(_setup_and_flush())
+
+
+def _target(target_type: str) -> Tuple[str, str]:
+    if target_type not in LIKE_TARGETS:
+        raise HTTPException(status_code=400, detail=f"不支持的点赞类型: {target_type}")
+    return LIKE_TARGETS[target_type]
+
+
+def _collection(target_type: str):
+    return getattr(mongo, f"{_target(target_type)[0]}_db")
+
+
+async def backfill_like_keys():
+    """
+    旧点赞记录只有 moment_id/comment_id/reply_id，且每次点赞都插入一条
+    补齐 target_id 并按 (类型, 对象, 用户) 去重，保留最新的一条，之后才能建唯一索引
+    """
+    await mongo.like_db.bulk_write([
+        UpdateMany({"type": target_type, "target_id": {"$exists": False}, field: {"$exists": True}},
+                   [{"$set": {"target_id": f"${field}"}}])
+        for target_type, (_, field) in LIKE_TARGETS.items()
+    ])
+    duplicates = await mongo.like_db.aggregate([
+        {"$sort": {"_id": -1}},
+        {"$group": {"_id": {"type": "$type", "target_id": "$target_id", "user_id": "$user_id"},
+                    "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ])
+    if duplicates:
+        await mongo.like_db.bulk_write([DeleteMany({"_id": {"$in": group["ids"][1:]}}) for group in duplicates])
+        log_info(f"点赞记录去重 {len(duplicates)} 组")
+        # 重复记录曾被重复计入点赞数，按去重后的记录重算
+        targets: Dict[str, Set[str]] = {}
+        for group in duplicates:
+            targets.setdefault(group["_id"]["type"], set()).add(group["_id"]["target_id"])
+        for target_type, target_ids in targets.items():
+            await _recount_likes(target_type, [target_id for target_id in target_ids if ObjectId.is_valid(target_id)])
+    # 点赞用户只保存在点赞记录中，去掉动态、评论、回复里内嵌的 like_users 数组
+    for collection_name, _ in LIKE_TARGETS.values():
+        await getattr(mongo, f"{collection_name}_db").bulk_write([
+            UpdateMany({"like_users": {"$exists": True}}, {"$unset": {"like_users": ""}})
+        ])
+
+
+async def _recount_likes(target_type: str, target_ids: List[str]):
+    """按点赞记录重算对象的点赞数"""
+    if target_type not in LIKE_TARGETS or not target_ids:
+        return
+    counts = await mongo.like_db.aggregate([
+        {"$match": {"type": target_type, "target_id": {"$in": target_ids}, "is_like": 1}},
+        {"$group": {"_id": "$target_id", "count": {"$sum": 1}}},
+    ])
+    count_map = {group["_id"]: group["count"] for group in counts}
+    await _collection(target_type).bulk_write([
+        UpdateOne({"_id": ObjectId(target_id)}, {"$set": {"stats.likes": count_map.get(target_id, 0)}})
+        for target_id in target_ids
+    ])
+    bump_versions(*[version_key(target_type, target_id) for target_id in target_ids])
+
+
+async def _setup_and_flush():
+    try:
+        await backfill_like_keys()
+        await mongo.like_db.create_index([("type", 1), ("target_id", 1), ("user_id", 1)], unique=True)
+    except Exception as e:
+        log_error(f"点赞记录迁移失败: {str(e)}")
+    while True:
+        await asyncio.sleep(settings.LIKE_FLUSH_INTERVAL)
+        try:
+            await flush_pending_likes()
+        except Exception as e:
+            log_error(f"点赞数刷写失败: {str(e)}")
+
+
+async def _set_like(target_type: str, target_id: str, user_id: int,
+                    is_like: bool) -> Tuple[bool, Optional[datetime]]:
+    """
+    写入点赞记录，返回 (点赞状态是否发生了变化, 之前的点赞时间)
+    重复点赞、重复取消时状态未变化；之前的点赞时间用于取消点赞时撤销当时计入的热度
+    """
+    field = _target(target_type)[1]
+    now = datetime.now()
+    update = {
+        "$set": {"is_like": 1 if is_like else 0, "updated_at": now},
+        "$setOnInsert": {"type": target_type, "target_id": target_id, "user_id": user_id, field: target_id},
+    }
+    if is_like:
+        # 重新点赞时刷新点赞时间，“我喜欢的”按最近点赞排序
+        update["$set"]["create_dt"] = now
+    else:
+        update["$setOnInsert"]["create_dt"] = now
+
+    for attempt in range(1, LIKE_RETRIES + 1):
+        try:
+            previous = await mongo.like_db.find_one_and_update(
+                {"type": target_type, "target_id": target_id, "user_id": user_id},
+                update, upsert=True, return_new=False, projection={"_id": 0, "is_like": 1, "create_dt": 1}
+            )
+            previous = previous or {}
+            return bool(previous.get("is_like")) != is_like, previous.get("create_dt")
+        except HTTPException:
+            if attempt == LIKE_RETRIES:
+                raise
+    return False, None
+
+
+def _is_hot(target_type: str, target_id: str) -> bool:
+    """每秒点赞次数超过 LIKE_HOT_THRESHOLD 的对象改为缓冲计数（固定1秒窗口，窗口内第一次点赞时开始计时）"""
+    key = f"like_rate:{target_type}:{target_id}"
+    try:
+        pipe = redis_client.pipeline()
+        pipe.set(key, 0, nx=True, ex=1)
+        pipe.incr(key)
+        return pipe.execute()[1] > settings.LIKE_HOT_THRESHOLD
+    except redis.RedisError as e:
+        log_error(f"统计点赞频率失败: {str(e)}")
+        return False
+
+
+def _pending_delta(target_type: str, target_id: str) -> int:
+    try:
+        return int(redis_client.hget(PENDING_KEY, f"{target_type}:{target_id}") or 0)
+    except redis.RedisError:
+        return 0
+
+
+async def owning_moment_versions(targets: Iterable[Tuple[str, str]]) -> List[str]:
+    """
+    评论、回复所属动态的版本号键，动态详情的缓存只依赖动态的版本号
+    targets 为 (类型, 对象ID)，回复先查所属评论、再查评论所属动态，各一次批量查询
+    """
+    moment_ids = {target_id for target_type, target_id in targets if target_type == "moment"}
+    comment_ids = {target_id for target_type, target_id in targets if target_type == "comment"}
+    reply_ids = [ObjectId(target_id) for target_type, target_id in targets
+                 if target_type == "reply" and ObjectId.is_valid(target_id)]
+    if reply_ids:
+        replies = await mongo.reply_db.find_many(query={"_id": {"$in": reply_ids}},
+                                                 projection={"_id": 0, "comment_id": 1})
+        comment_ids.update(reply["comment_id"] for reply in replies if reply.get("comment_id"))
+    comment_oids = [ObjectId(comment_id) for comment_id in comment_ids if ObjectId.is_valid(comment_id)]
+    if comment_oids:
+        comments = await mongo.comment_db.find_many(query={"_id": {"$in": comment_oids}},
+                                                    projection={"_id": 0, "moment_id": 1})
+        moment_ids.update(comment["moment_id"] for comment in comments if comment.get("moment_id"))
+    return [version_key("moment", moment_id) for moment_id in moment_ids]
+
+
+async def toggle_like(target_type: str, target_id: str, user_id: int, is_like: bool) -> int:
+    """
+    点赞/取消点赞，幂等：只有状态真正变化时才调整点赞数
+    普通对象一次 find_one_and_update 原子更新并返回点赞数；热点对象的增量缓冲在Redis中定期刷写
+    返回最新的点赞数
+    """
+    if not ObjectId.is_valid(target_id):
+        raise HTTPException(status_code=400, detail="无效的ID")
+    # 先校验对象存在且未删除，再写点赞记录
+    target = await _collection(target_type).find_one({"_id": ObjectId(target_id), "is_delete": {"$ne": -1}},
+                                                     projection={"_id": 1})
+    if not target:
+        raise HTTPException(status_code=404, detail="点赞对象不存在")
+    changed, liked_at = await _set_like(target_type, target_id, user_id, is_like)
+    likes_count = await _apply_delta(target_type, target_id, (1 if is_like else -1) if changed else 0)
+    if changed:
+        # 点赞状态和点赞数已写入，包含该对象的缓存页面失效；评论、回复的点赞同时使所属动态的详情失效
+        parents = await owning_moment_versions([(target_type, target_id)]) if target_type != "moment" else []
+        bump_versions(version_key(target_type, target_id), *parents)
+        if target_type == "moment":
+            # 取消点赞时按点赞时的时间撤销热度
+            record_event(target_id, "like", 1 if is_like else -1,
+                         occurred_at=None if is_like or not isinstance(liked_at, datetime) else liked_at)
+    return likes_count
+
+
+async def _apply_delta(target_type: str, target_id: str, delta: int) -> int:
+    """调整点赞数并返回最新值，热点对象的增量先缓冲在Redis中"""
+    collection = _collection(target_type)
+    object_id = ObjectId(target_id)
+    if delta and not _is_hot(target_type, target_id):
+        update = {"$inc": {"stats.likes": delta}, "$set": {"updated_at": datetime.now()}}
+        target = await collection.find_one_and_update({"_id": object_id}, update,
+                                                      projection={"_id": 0, "stats.likes": 1})
+        if not target:
+            raise HTTPException(status_code=404, detail="点赞对象不存在")
+        return (target.get("stats") or {}).get("likes", 0) + _pending_delta(target_type, target_id)
+
+    if delta:
+        try:
+            redis_client.hincrby(PENDING_KEY, f"{target_type}:{target_id}", delta)
+        except redis.RedisError as e:
+            log_error(f"缓冲点赞数失败，直接写入: {str(e)}")
+            await collection.update_one({"_id": object_id}, {"$inc": {"stats.likes": delta}})
+
+    target = await collection.find_one({"_id": object_id}, projection={"_id": 0, "stats.likes": 1})
+    if not target:
+        raise HTTPException(status_code=404, detail="点赞对象不存在")
+    return (target.get("stats") or {}).get("likes", 0) + _pending_delta(target_type, target_id)
+
+
+async def get_liked(user_id: Optional[int], targets: Dict[str, Iterable[str]]) -> Set[Tuple[str, str]]:
+    """
+    当前用户点赞过哪些对象，一页数据一次查询
+    targets 形如 {"moment": [动态ID, ...]}，返回点赞过的 (类型, 对象ID)
+    """
+    conditions = [{"type": target_type, "target_id": {"$in": list(ids)}}
+                  for target_type, ids in targets.items() if ids]
+    if user_id is None or not conditions:
+        return set()
+    likes = await mongo.like_db.find_many(
+        query={"user_id": user_id, "is_like": 1, "$or": conditions},
+        projection={"_id": 0, "type": 1, "target_id": 1},
+    )
+    return {(like["type"], like["target_id"]) for like in likes}
+
+
+async def flush_pending_likes() -> int:
+    """把缓冲的点赞数增量按集合批量写入MongoDB，返回写入的对象数"""
+    try:
+        raw = _take_pending(keys=[PENDING_KEY])
+    except redis.RedisError as e:
+        log_error(f"读取缓冲点赞数失败: {str(e)}")
+        return 0
+    deltas: Dict[str, List[Tuple[str, int]]] = {}
+    for field, delta in zip(raw[::2], raw[1::2]):
+        target_type, target_id = field.split(":", 1)
+        if int(delta) and target_type in LIKE_TARGETS and ObjectId.is_valid(target_id):
+            deltas.setdefault(target_type, []).append((target_id, int(delta)))
+
+    # 逐个对象写入：批量写部分失败时无法区分哪些增量已生效，放回全部会重复计数
+    items = [(target_type, target_id, delta) for target_type, pairs in deltas.items() for target_id, delta in pairs]
+    results = await asyncio.gather(*[
+        _collection(target_type).update_one({"_id": ObjectId(target_id)}, {"$inc": {"stats.likes": delta}})
+        for target_type, target_id, delta in items
+    ], return_exceptions=True)
+
+    failed = [(item, result) for item, result in zip(items, results) if isinstance(result, Exception)]
+    if failed:
+        # 只把写入失败的增量放回，下次再刷写
+        log_error(f"刷写点赞数失败 {len(failed)} 个: {failed[0][1]}")
+        try:
+            pipe = redis_client.pipeline()
+            for (target_type, target_id, delta), _ in failed:
+                pipe.hincrby(PENDING_KEY, f"{target_type}:{target_id}", delta)
+            pipe.execute()
+        except redis.RedisError as e:
+            log_error(f"放回缓冲点赞数失败: {str(e)}")
+    # 失败的增量放回后再查所属动态，查询出错时不影响放回
+    flushed = [(target_type, target_id) for (target_type, target_id, _), result in zip(items, results)
+               if not isinstance(result, Exception)]
+    parents = await owning_moment_versions([item for item in flushed if item[0] != "moment"])
+    bump_versions(*[version_key(target_type, target_id) for target_type, target_id in flushed], *parents)
+    return len(items) - len(failed)
@@ -0,0 +1,115 @@
+# encoding: UTF-8
+from typing import Any, Dict, List, Optional, Set, Tuple
+from bson import ObjectId
+from fastapi import HTTPException
+from init import app
+from utils.mongodb import MotorDB
+from utils.like_service import get_liked
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="article_db")
+
+# 动态详情中每条评论默认附带的回复数，更多回复通过回复分页接口加载
+REPLY_PREVIEW_COUNT = 3
+# 评论和回复统一的“未删除”条件（is_delete 为 -1 表示已删除）
+NOT_DELETED = {"$ne": -1}
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+    # 评论按动态、回复按评论做游标分页
+    await mongo.comment_db.create_index([("moment_id", 1), ("_id", 1)])
+    await mongo.reply_db.create_index([("comment_id", 1), ("is_delete", 1), ("_id", 1)])
+
+
+def _after_id(after: Optional[str]) -> Optional[ObjectId]:
+    """游标为上一页最后一条记录的ID"""
+    if not after:
+        return None
+    if not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail="无效的游标")
+    return ObjectId(after)
+
+
+def _format_reply(reply: Dict[str, Any], liked: Set[Tuple[str, str]]) -> Dict[str, Any]:
+    reply["_id"] = str(reply["_id"])
+    reply["is_liked"] = ("reply", reply["_id"]) in liked
+    return reply
+
+
+async def _reply_previews(comment_ids: List[str], limit: int) -> Dict[str, Dict[str, Any]]:
+    """
+    一次聚合取出一页评论下的回复：每条评论前 limit 条回复和回复总数
+    以评论ID为起点 $lookup，每条评论最多读取 limit 条回复，
+    总数用只投影 _id 的 $count 统计，回复很多的评论也不会把所有回复装进内存；
+    $lookup 使用 let + $expr 的写法，兼容 MongoDB 5.0 以下的版本
+    """
+    if not comment_ids:
+        return {}
+    reply_match = {"$expr": {"$eq": ["$comment_id", "$$comment_id"]}, "is_delete": NOT_DELETED}
+    groups = await mongo.comment_db.aggregate([
+        {"$match": {"_id": {"$in": [ObjectId(comment_id) for comment_id in comment_ids]}}},
+        {"$project": {"_id": {"$toString": "$_id"}}},
+        {"$lookup": {
+            "from": "reply", "let": {"comment_id": "$_id"},
+            "pipeline": [{"$match": reply_match}, {"$sort": {"_id": 1}}, {"$limit": limit}],
+            "as": "replies",
+        }},
+        {"$lookup": {
+            "from": "reply", "let": {"comment_id": "$_id"},
+            "pipeline": [{"$match": reply_match}, {"$project": {"_id": 1}}, {"$count": "count"}],
+            "as": "total",
+        }},
+        {"$project": {"replies": 1, "count": {"$ifNull": [{"$arrayElemAt": ["$total.count", 0]}, 0]}}},
+    ])
+    return {group["_id"]: group for group in groups}
+
+
+async def load_comments(moment_id: str, after: Optional[str] = None, limit: int = 20,
+                        reply_limit: int = REPLY_PREVIEW_COUNT,
+                        viewer_id: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    动态详情的一页评论：评论一次查询，回复一次聚合，点赞状态一次批量获取
+    评论人、回复人的名称和头像使用写入时的快照，资料变更时由后台任务同步
+    返回 (评论列表, 下一页游标)，没有更多评论时游标为 None
+    """
+    query: Dict[str, Any] = {"moment_id": moment_id, "is_delete": NOT_DELETED}
+    after_id = _after_id(after)
+    if after_id:
+        query["_id"] = {"$gt": after_id}
+    comments = await mongo.comment_db.find_many(query=query, sort=[("_id", 1)], limit=limit + 1)
+    has_more = len(comments) > limit
+    comments = comments[:limit]
+
+    comment_ids = [str(comment["_id"]) for comment in comments]
+    previews = await _reply_previews(comment_ids, reply_limit)
+    liked = await get_liked(viewer_id, {
+        "comment": comment_ids,
+        "reply": [str(reply["_id"]) for preview in previews.values() for reply in preview["replies"]],
+    })
+
+    for comment, comment_id in zip(comments, comment_ids):
+        comment["_id"] = comment_id
+        comment["comment_id"] = comment_id
+        comment["is_liked"] = ("comment", comment_id) in liked
+        preview = previews.get(comment_id) or {"count": 0, "replies": []}
+        comment["reply"] = [_format_reply(reply, liked) for reply in preview["replies"]]
+        comment["reply_count"] = preview["count"]
+        comment["reply_cursor"] = comment["reply"][-1]["_id"] if preview["count"] > len(comment["reply"]) else None
+    return comments, (comment_ids[-1] if has_more else None)
+
+
+async def load_replies(comment_id: str, after: Optional[str] = None, limit: int = 20,
+                       viewer_id: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """一条评论下的一页回复，返回 (回复列表, 下一页游标)"""
+    query: Dict[str, Any] = {"comment_id": comment_id, "is_delete": NOT_DELETED}
+    after_id = _after_id(after)
+    if after_id:
+        query["_id"] = {"$gt": after_id}
+    replies = await mongo.reply_db.find_many(query=query, sort=[("_id", 1)], limit=limit + 1)
+    has_more = len(replies) > limit
+    replies = replies[:limit]
+    liked = await get_liked(viewer_id, {"reply": [str(reply["_id"]) for reply in replies]})
+    replies = [_format_reply(reply, liked) for reply in replies]
+    return replies, (replies[-1]["_id"] if has_more else None)
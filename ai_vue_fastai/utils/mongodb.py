@@ -1,6 +1,7 @@
 # motor_db.py
 from typing import Any, Dict, List, Optional,Mapping
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 from pymongo.errors import PyMongoError
 from bson import ObjectId
 from fastapi import HTTPException
@@ -46,6 +47,17 @@ class CollectionWrapper:
             limit=limit
         )
 
+    async def count_documents(self, query: Dict[str, Any] = None, limit: int = 0) -> int:
+        """统计文档数量，limit 大于0时最多统计 limit 条"""
+        query = query or {}
+        if not isinstance(query, Mapping):
+            raise TypeError("query must be a mapping type (e.g. dict)")
+        return await self.db._count_documents(self.collection_name, query, limit=limit)
+
+    async def create_index(self, keys: List[tuple], **kwargs) -> str:
+        """创建索引（已存在时不会重复创建）"""
+        return await self.db._create_index(self.collection_name, keys, **kwargs)
+
     async def update_one(self, filter: Dict[str, Any], update: Dict[str, Any], upsert: bool = False, **kwargs) -> bool:
         """更新单个文档，支持upsert操作"""
         if not isinstance(filter, Mapping) or not isinstance(update, Mapping):
@@ -58,6 +70,40 @@ class CollectionWrapper:
             raise TypeError("filter must be a mapping type (e.g. dict)")
         return await self.db._delete_one(self.collection_name, filter)
 
+    async def delete_many(self, filter: Dict[str, Any]) -> int:
+        """删除多个文档，返回删除的数量"""
+        if not isinstance(filter, Mapping):
+            raise TypeError("filter must be a mapping type (e.g. dict)")
+        return await self.db._delete_many(self.collection_name, filter)
+
+    async def update_many(self, filter: Dict[str, Any], update: Dict[str, Any], upsert: bool = False) -> int:
+        """更新多个文档，返回修改的数量"""
+        if not isinstance(filter, Mapping) or not isinstance(update, Mapping):
+            raise TypeError("filter and update must be mapping types (e.g. dict)")
+        return await self.db._update_many(self.collection_name, filter, update, upsert=upsert)
+
+    async def find_one_and_update(self, filter: Dict[str, Any], update: Dict[str, Any],
+                                  upsert: bool = False, return_new: bool = True,
+                                  projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """原子更新并返回文档，默认返回更新后的文档"""
+        if not isinstance(filter, Mapping) or not isinstance(update, Mapping):
+            raise TypeError("filter and update must be mapping types (e.g. dict)")
+        return await self.db._find_one_and_update(self.collection_name, filter, update,
+                                                  upsert=upsert, return_new=return_new,
+                                                  projection=projection)
+
+    async def bulk_write(self, requests: List[Any], ordered: bool = False) -> int:
+        """批量写操作，多条更新一次往返提交"""
+        if not requests:
+            return 0
+        return await self.db._bulk_write(self.collection_name, requests, ordered=ordered)
+
+    async def aggregate(self, pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """聚合查询"""
+        if not isinstance(pipeline, list):
+            raise TypeError("pipeline must be a list of stages")
+        return await self.db._aggregate(self.collection_name, pipeline)
+
 
 class MotorDB:
     def __init__(self, host: str = "localhost", port: int = 27017,
@@ -134,6 +180,21 @@ class MotorDB:
         except TypeError as e:
             raise HTTPException(400, f"参数类型错误: {str(e)}")
 
+    async def _count_documents(self, collection_name: str, query: Dict[str, Any], limit: int = 0) -> int:
+        """实际统计操作"""
+        try:
+            kwargs = {"limit": limit} if limit else {}
+            return await self._db[collection_name].count_documents(query, **kwargs)
+        except PyMongoError as e:
+            raise HTTPException(500, f"统计文档失败: {str(e)}")
+
+    async def _create_index(self, collection_name: str, keys: List[tuple], **kwargs) -> str:
+        """实际创建索引操作"""
+        try:
+            return await self._db[collection_name].create_index(keys, **kwargs)
+        except PyMongoError as e:
+            raise HTTPException(500, f"创建索引失败: {str(e)}")
+
     async def _update_one(self, collection_name: str, filter: Dict[str, Any], update: Dict[str, Any], upsert: bool = False, **kwargs) -> bool:
         """更新单个文档，支持 upsert 操作"""
         if not isinstance(filter, Mapping) or not isinstance(update, Mapping):
@@ -154,3 +215,50 @@ class MotorDB:
             return result.deleted_count > 0
         except PyMongoError as e:
             raise HTTPException(500, f"删除文档失败: {str(e)}")
+
+    async def _delete_many(self, collection_name: str, filter: Dict[str, Any]) -> int:
+        """实际删除多个文档操作"""
+        try:
+            result = await self._db[collection_name].delete_many(filter)
+            return result.deleted_count
+        except PyMongoError as e:
+            raise HTTPException(500, f"删除文档失败: {str(e)}")
+
+    async def _bulk_write(self, collection_name: str, requests: List[Any], ordered: bool = False) -> int:
+        """实际批量写操作"""
+        try:
+            result = await self._db[collection_name].bulk_write(requests, ordered=ordered)
+            return result.modified_count + result.upserted_count
+        except PyMongoError as e:
+            raise HTTPException(500, f"批量写入失败: {str(e)}")
+
+    async def _update_many(self, collection_name: str, filter: Dict[str, Any], update: Dict[str, Any],
+                           upsert: bool = False) -> int:
+        """实际更新多个文档操作"""
+        try:
+            result = await self._db[collection_name].update_many(filter, update, upsert=upsert)
+            return result.modified_count
+        except PyMongoError as e:
+            raise HTTPException(500, f"更新文档失败: {str(e)}")
+
+    async def _find_one_and_update(self, collection_name: str, filter: Dict[str, Any], update: Dict[str, Any],
+                                   upsert: bool = False, return_new: bool = True,
+                                   projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """实际原子更新并返回文档操作"""
+        try:
+            return await self._db[collection_name].find_one_and_update(
+                filter,
+                update,
+                projection=projection,
+                upsert=upsert,
+                return_document=ReturnDocument.AFTER if return_new else ReturnDocument.BEFORE
+            )
+        except PyMongoError as e:
+            raise HTTPException(500, f"更新文档失败: {str(e)}")
+
+    async def _aggregate(self, collection_name: str, pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """实际聚合查询操作"""
+        try:
+            return await self._db[collection_name].aggregate(pipeline).to_list(length=None)
+        except PyMongoError as e:
+            raise HTTPException(500, f"聚合查询失败: {str(e)}")
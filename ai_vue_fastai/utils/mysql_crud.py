@@ -123,6 +123,13 @@ class UserCRUD():
         statement = select(User).where(User.id == id)
         return self.session.exec(statement).first()
 
+    def get_users_by_ids(self, ids: List[int]) -> List[User]:
+        """按ID批量查询用户，一次 IN 查询"""
+        if not ids:
+            return []
+        statement = select(User).where(User.id.in_(ids))
+        return self.session.exec(statement).all()
+
     def get_user_by_email(self, email: str) -> Optional[User]:
         statement = select(User).where(User.email == email)
         return self.session.exec(statement).first()
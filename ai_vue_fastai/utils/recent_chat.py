@@ -0,0 +1,336 @@
+# encoding: UTF-8
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Union
+import asyncio
+from bson import ObjectId
+from pymongo import UpdateOne, UpdateMany
+from init import app
+from config.settings import settings
+from utils.mongodb import MotorDB
+from utils.redis import set_read_cursor, set_read_cursors, get_read_cursor, get_read_cursors
+from utils.group_member import is_member
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="chat_db")
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+    # 未读数按读游标做范围统计，依赖以下索引
+    await mongo.single_db.create_index([("from", 1), ("to", 1), ("_id", 1)])
+    await mongo.group_chat_db.create_index([("to", 1), ("_id", 1)])
+    await mongo.recent_chats_db.create_index([("user_id", 1), ("target_id", 1)])
+    await mongo.recent_chats_db.create_index([("user_id", 1), ("last_message_time", -1)])
+    # “我的群聊”按最近活跃分页
+    await mongo.recent_chats_db.create_index([("user_id", 1), ("is_group", 1), ("last_message_time", -1),
+                                              ("target_id", -1)])
+
+
+def _build_update(last_message_time: Optional[datetime], unread: int,
+                  fields: Optional[Dict[str, Any]], on_insert: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """构建最近聊天的更新语句：时间取最大值，未读数做增量"""
+    update: Dict[str, Any] = {
+        "$max": {"last_message_time": last_message_time or datetime.now()}
+    }
+    if fields:
+        update["$set"] = dict(fields)
+    if unread:
+        update["$inc"] = {"unread_count": unread}
+    if on_insert is not None:
+        if not unread:
+            on_insert = {**on_insert, "unread_count": 0}
+        update["$setOnInsert"] = on_insert
+    return update
+
+
+class RecentChatBatch:
+    """
+    最近聊天批量更新器
+    一条消息引起的所有最近聊天变更先收集起来，最后一次 bulk_write 提交：
+    - unread_count 用 $inc 累加，不再被 0/1 覆盖
+    - last_message_time 用 $max，乱序到达的消息不会把时间改小
+    """
+
+    def __init__(self):
+        self.requests: List[Union[UpdateOne, UpdateMany]] = []
+
+    def touch(self, user_id: int, target_id: Union[int, str],
+              last_message_time: Optional[datetime] = None, unread: int = 0,
+              fields: Optional[Dict[str, Any]] = None, upsert: bool = True):
+        """更新某个用户的一条最近聊天记录"""
+        on_insert = {"user_id": user_id, "target_id": target_id} if upsert else None
+        self.requests.append(UpdateOne(
+            {"user_id": user_id, "target_id": target_id},
+            _build_update(last_message_time, unread, fields, on_insert),
+            upsert=upsert
+        ))
+
+    def touch_many(self, user_ids: Iterable[int], target_id: Union[int, str],
+                   last_message_time: Optional[datetime] = None, unread: int = 0,
+                   fields: Optional[Dict[str, Any]] = None):
+        """群消息：一条语句更新多个成员的记录（记录在建群/加人时已创建，不做 upsert）"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        self.requests.append(UpdateMany(
+            {"user_id": {"$in": user_ids}, "target_id": target_id},
+            _build_update(last_message_time, unread, fields)
+        ))
+
+    async def flush(self) -> int:
+        """提交所有收集到的更新，返回受影响的记录数"""
+        if not self.requests:
+            return 0
+        requests, self.requests = self.requests, []
+        return await mongo.recent_chats_db.bulk_write(requests, ordered=False)
+
+
+def is_fanout_on_read(members_count: Optional[int]) -> bool:
+    """大群不再逐个成员写最近聊天记录，改为读时合并群消息头"""
+    return (members_count or 0) > settings.GROUP_FANOUT_LIMIT
+
+
+def is_group_conversation(target_id: Union[int, str]) -> bool:
+    """群聊的会话ID以 group_ 开头，单聊是对方的用户ID"""
+    return isinstance(target_id, str) and target_id.startswith("group_")
+
+
+def normalize_target_id(target_id: Union[int, str, None]) -> Union[int, str, None]:
+    """客户端传来的会话ID统一类型：群聊为字符串，单聊为整数用户ID，无效时返回 None"""
+    if is_group_conversation(target_id):
+        return target_id
+    try:
+        return int(target_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _conversation_query(user_id: int, target_id: Union[int, str]):
+    """用户在某个会话中收到的消息"""
+    if is_group_conversation(target_id):
+        return mongo.group_chat_db, {"to": target_id, "from": {"$ne": user_id}}
+    return mongo.single_db, {"from": int(target_id), "to": user_id}
+
+
+async def count_unread(user_id: int, target_id: Union[int, str], cursor: Optional[str] = None) -> int:
+    """未读数 = 读游标之后收到的消息数，在 (会话, _id) 索引上做范围统计"""
+    collection, query = _conversation_query(user_id, target_id)
+    query["is_delete"] = {"$ne": -1}
+    if cursor and ObjectId.is_valid(cursor):
+        query["_id"] = {"$gt": ObjectId(cursor)}
+    return await collection.count_documents(query, limit=settings.UNREAD_COUNT_CAP)
+
+
+async def ack_read(user_id: int, target_id: Union[int, str], up_to: str) -> int:
+    """
+    已读确认：把读游标推进到 up_to，并按游标重新计算该会话的未读数
+    返回剩余未读数；会话ID无效或用户不是群成员时不做任何修改
+    """
+    target_id = normalize_target_id(target_id)
+    if target_id is None:
+        return 0
+    if is_group_conversation(target_id) and not await is_member(target_id, user_id):
+        return 0
+    set_read_cursor(user_id, target_id, up_to)
+    unread = await count_unread(user_id, target_id, get_read_cursor(user_id, target_id))
+    await mongo.recent_chats_db.update_one(
+        {"user_id": user_id, "target_id": target_id},
+        {"$set": {"unread_count": unread}}
+    )
+    return unread
+
+
+async def ack_read_batch(user_id: int, acks: List[Dict[str, Any]]):
+    """批量已读确认，acks 形如 [{"target_id": ..., "up_to": 消息ID}, ...]"""
+    await asyncio.gather(*[
+        ack_read(user_id, ack["target_id"], str(ack["up_to"]))
+        for ack in acks if ack.get("target_id") is not None and ack.get("up_to")
+    ])
+
+
+async def mark_conversation_read(user_id: int, target_id: Union[int, str]):
+    """把整个会话标记为已读：读游标推进到会话最新一条消息"""
+    target_id = normalize_target_id(target_id)
+    if target_id is None:
+        return
+    if is_group_conversation(target_id) and not await is_member(target_id, user_id):
+        return
+    collection, query = _conversation_query(user_id, target_id)
+    latest = await collection.find_many(query=query, projection={"_id": 1}, sort=[("_id", -1)], limit=1)
+    if latest:
+        set_read_cursor(user_id, target_id, str(latest[0]["_id"]))
+    await mongo.recent_chats_db.update_one(
+        {"user_id": user_id, "target_id": target_id},
+        {"$set": {"unread_count": 0}}
+    )
+
+
+async def touch_group_head(group_id: str, sender_id: int, message_id: str, last_message: Dict[str, Any],
+                           last_message_time: Optional[datetime] = None):
+    """大群每条消息只更新一条共享的群消息头，并把发送方的读游标推到这条消息"""
+    await mongo.group_head_db.update_one(
+        {"group_id": group_id},
+        {
+            "$set": {"last_message": last_message, "last_message_id": message_id},
+            "$max": {"last_message_time": last_message_time or datetime.now()},
+            "$setOnInsert": {"group_id": group_id}
+        },
+        upsert=True
+    )
+    set_read_cursor(sender_id, group_id, message_id)
+
+
+async def seed_fanout_cursors(group_id: str):
+    """
+    小群切换为读时合并前调用：小群的未读数记在成员的最近聊天里，离线成员没有读游标，
+    按各成员当前的未读数把读游标设到倒数第 unread_count 条消息之前，未读数为 0 时设到最新一条
+    """
+    rows = await mongo.recent_chats_db.find_many(
+        query={"target_id": group_id}, projection={"_id": 0, "user_id": 1, "unread_count": 1}
+    )
+    if not rows:
+        return
+    depths = {row["user_id"]: min(int(row.get("unread_count") or 0), settings.UNREAD_COUNT_CAP) for row in rows}
+    latest = await mongo.group_chat_db.find_many(
+        query={"to": group_id, "is_delete": {"$ne": -1}}, projection={"_id": 1},
+        sort=[("_id", -1)], limit=max(depths.values()) + 1,
+    )
+    by_cursor: Dict[str, List[int]] = {}
+    for user_id, depth in depths.items():
+        # 未读数不少于已有消息数时不设游标，所有消息都计为未读
+        if depth < len(latest):
+            by_cursor.setdefault(str(latest[depth]["_id"]), []).append(user_id)
+    for cursor, user_ids in by_cursor.items():
+        set_read_cursors(user_ids, group_id, cursor)
+
+
+async def _large_group_chats(query: Dict[str, Any], limit: int, projection: Optional[Dict[str, Any]] = None,
+                             before: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """
+    大群的记录不随消息更新，在服务端关联共享的群消息头补齐最后一条消息，
+    按合并后的时间排序，只返回前 limit 条；before 为分页游标条件
+    """
+    pipeline: List[Dict[str, Any]] = [{"$match": {**query, "fanout_on_read": True}}]
+    if projection:
+        pipeline.append({"$project": {**projection, "last_message_time": 1, "last_message": 1}})
+    pipeline += [
+        {"$lookup": {"from": "group_head", "localField": "target_id", "foreignField": "group_id", "as": "head"}},
+        {"$set": {"head": {"$arrayElemAt": ["$head", 0]}}},
+        {"$set": {"last_message_time": {"$max": ["$last_message_time", "$head.last_message_time"]},
+                  "last_message": {"$ifNull": ["$head.last_message", "$last_message"]}}},
+    ]
+    if before:
+        pipeline.append({"$match": before})
+    pipeline += [
+        {"$sort": {"last_message_time": -1, "target_id": -1}},
+        {"$limit": limit},
+        {"$project": {"head": 0}},
+    ]
+    return await mongo.recent_chats_db.aggregate(pipeline)
+
+
+async def _count_large_group_unread(user_id: int, chats: List[Dict[str, Any]]):
+    """大群的未读数按读游标统计，只统计最终返回的这一页"""
+    large_chats = [chat for chat in chats if chat.get("fanout_on_read")]
+    if not large_chats:
+        return
+    group_ids = [chat["target_id"] for chat in large_chats]
+    cursors = get_read_cursors(user_id, group_ids)
+    unread_counts = await asyncio.gather(*[
+        count_unread(user_id, group_id, cursors.get(group_id)) for group_id in group_ids
+    ])
+    for chat, unread in zip(large_chats, unread_counts):
+        chat["unread_count"] = unread
+
+
+async def get_recent_chats_merged(user_id: int, limit: int) -> List[Dict[str, Any]]:
+    """
+    获取最近聊天列表：
+    单聊和小群直接读用户自己的记录，大群关联共享的群消息头，两边各取前 limit 条按时间合并，
+    未读数只为合并后留下的大群按用户的读游标范围统计
+    """
+    sort = [("last_message_time", -1)]  # 按最后消息时间降序排列
+    recent_chats = await mongo.recent_chats_db.find_many(
+        query={"user_id": user_id, "fanout_on_read": {"$ne": True}}, limit=limit, sort=sort
+    )
+    large_chats = await _large_group_chats({"user_id": user_id}, limit)
+    if not large_chats:
+        return recent_chats
+
+    merged = recent_chats + large_chats
+    merged.sort(key=lambda chat: chat["last_message_time"], reverse=True)
+    merged = merged[:limit]
+    await _count_large_group_unread(user_id, merged)
+    return merged
+
+
+# 群摘要字段：每个成员一条固定大小的记录，不包含成员列表
+GROUP_SUMMARY_PROJECTION = {
+    "_id": 0, "target_id": 1, "group_name": 1, "target_photo": 1, "group_owner_id": 1, "members_count": 1,
+    "last_message": 1, "last_message_time": 1, "unread_count": 1, "fanout_on_read": 1,
+}
+
+
+def group_summary_fields(group: Dict[str, Any]) -> Dict[str, Any]:
+    """由群信息生成成员最近聊天中的群摘要字段"""
+    return {
+        "group_owner_id": group.get("creator_id"),
+        "group_name": group.get("name"),
+        "target_username": group.get("name"),
+        "members_count": group.get("members_count"),
+        "target_photo": group.get("group_avatar"),
+        "fanout_on_read": bool(group.get("fanout_on_read")),
+        "is_group": True,
+    }
+
+
+async def update_group_summaries(group_id: str, fields: Dict[str, Any]) -> int:
+    """群名称、人数、头像、解散等变更时，一条语句更新所有成员的群摘要"""
+    return await mongo.recent_chats_db.update_many({"target_id": group_id}, {"$set": fields})
+
+
+async def add_group_summaries(group: Dict[str, Any], user_ids: Iterable[int]) -> int:
+    """新成员入群时创建群摘要，一次批量写；读游标设到当前最新消息，入群前的消息不计入未读"""
+    user_ids = list(user_ids)
+    batch = RecentChatBatch()
+    for user_id in user_ids:
+        batch.touch(user_id, group["group_id"], fields=group_summary_fields(group))
+    latest = await mongo.group_chat_db.find_many(
+        query={"to": group["group_id"]}, projection={"_id": 1}, sort=[("_id", -1)], limit=1
+    )
+    if latest:
+        set_read_cursors(user_ids, group["group_id"], str(latest[0]["_id"]))
+    return await batch.flush()
+
+
+async def remove_group_summaries(group_id: str, user_ids: Iterable[int]) -> int:
+    """成员退群或被移出后删除其群摘要"""
+    return await mongo.recent_chats_db.delete_many({"target_id": group_id, "user_id": {"$in": list(user_ids)}})
+
+
+async def get_group_summaries(user_id: int, limit: int, before_time: Optional[datetime] = None,
+                              before_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    “我的群聊”：按最近活跃倒序分页，游标为上一页最后一条的 (last_message_time, target_id)
+    小群直接走 (user_id, is_group, last_message_time) 索引，大群与共享的群消息头合并
+    """
+    query: Dict[str, Any] = {"user_id": user_id, "is_group": True, "dismissed": {"$ne": True}}
+    before = None
+    if before_time is not None:
+        before = {"$or": [
+            {"last_message_time": {"$lt": before_time}},
+            {"last_message_time": before_time, "target_id": {"$lt": before_id or ""}},
+        ]}
+
+    small = await mongo.recent_chats_db.find_many(
+        query={**query, "fanout_on_read": {"$ne": True}, **(before or {})}, projection=GROUP_SUMMARY_PROJECTION,
+        sort=[("last_message_time", -1), ("target_id", -1)], limit=limit,
+    )
+    # 大群的游标条件作用在合并群消息头之后的时间上，同样只取前 limit 条
+    large = await _large_group_chats(query, limit, projection=GROUP_SUMMARY_PROJECTION, before=before)
+
+    merged = small + large
+    merged.sort(key=lambda chat: (chat["last_message_time"], chat["target_id"]), reverse=True)
+    merged = merged[:limit]
+    await _count_large_group_unread(user_id, merged)
+    return merged
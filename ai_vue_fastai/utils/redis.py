@@ -1,6 +1,6 @@
 import redis
 from config.settings import settings
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 # 初始化 Redis 连接
 redis_client = redis.Redis(
     host=settings.REDIS_HOST,
@@ -72,14 +72,64 @@ def is_user_online(user_id: str) -> bool:
     return redis_client.exists(f"user:online:{user_id}") == 1
 
 
-# 新增：记录消息已读状态
-def mark_message_as_read(message_id: str):
-    """标记消息为已读"""
-    redis_client.set(f"message:read:{message_id}", "1", ex=86400)  # 1天过期
+# 读游标：每个用户一个哈希 read_cursor:{user_id}，字段为会话ID（单聊对方ID/群ID），
+# 值为已读到的最后一条消息ID。占用的内存只和会话数有关，和消息数无关
+_advance_read_cursor = redis_client.register_script("""
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if (not current) or current < ARGV[2] then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+end
+return 0
+""")
 
 
-# 新增：检查消息是否已读
-def is_message_read(message_id: str) -> bool:
-    """检查消息是否已读"""
-    return redis_client.exists(f"message:read:{message_id}") == 1
+def set_read_cursor(user_id: int, conversation_id: str, message_id: str) -> bool:
+    """推进用户在某个会话中的读游标（只前进不后退）"""
+    try:
+        return _advance_read_cursor(keys=[f"read_cursor:{user_id}"],
+                                    args=[str(conversation_id), str(message_id)]) == 1
+    except redis.RedisError as e:
+        print(f"Redis操作失败: {e}")
+        return False
+
+
+def set_read_cursors(user_ids: List[int], conversation_id: str, message_id: str):
+    """群消息：一次推进多个在线成员的读游标"""
+    if not user_ids:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in user_ids:
+            _advance_read_cursor(keys=[f"read_cursor:{user_id}"],
+                                 args=[str(conversation_id), str(message_id)], client=pipe)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"Redis操作失败: {e}")
+
+
+def get_read_cursor(user_id: int, conversation_id: str) -> Optional[str]:
+    """获取用户在某个会话中已读到的最后一条消息ID"""
+    try:
+        return redis_client.hget(f"read_cursor:{user_id}", str(conversation_id))
+    except redis.RedisError as e:
+        print(f"Redis操作失败: {e}")
+        return None
+
+
+def get_read_cursors(user_id: int, conversation_ids: List[str]) -> Dict[str, Optional[str]]:
+    """一次获取用户多个会话的读游标"""
+    if not conversation_ids:
+        return {}
+    fields = [str(conversation_id) for conversation_id in conversation_ids]
+    try:
+        return dict(zip(fields, redis_client.hmget(f"read_cursor:{user_id}", fields)))
+    except redis.RedisError as e:
+        print(f"Redis操作失败: {e}")
+        return {field: None for field in fields}
+
 
+def is_message_read(user_id: int, conversation_id: str, message_id: str) -> bool:
+    """检查消息是否已读：消息ID不大于读游标即为已读"""
+    cursor = get_read_cursor(user_id, conversation_id)
+    return cursor is not None and str(message_id) <= cursor
@@ -0,0 +1,251 @@
+# encoding: UTF-8
+import asyncio
+import math
+import re
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from init import app
+from utils.mongodb import MotorDB
+from utils.log import log_info, log_error
+
+# 初始化MongoDB连接
+mongo = MotorDB(database="article_db")
+
+# 建索引的对象：类型 -> (集合, 文本字段, 时间字段)
+SEARCH_TARGETS = {
+    "moment": ("article", "content", "created_at"),
+    "comment": ("comment", "comment", "created_at"),
+}
+
+# 从最少见的词项取最新的候选文档的上限，常见词不会拖慢查询
+SEARCH_CANDIDATE_LIMIT = 5000
+# 重建索引时每批处理的文档数
+REBUILD_BATCH_SIZE = 500
+
+# 词项中的可见范围：公开内容为 "*"，其余只有作者（评论为所属动态的作者）可以搜到
+PUBLIC_READER = "*"
+
+# 中文按连续的汉字切分，字母数字按单词切分
+_TOKEN_PATTERN = re.compile(r"[一-鿿㐀-䶿]+|[a-z0-9]+")
+_CJK_PATTERN = re.compile(r"[一-鿿㐀-䶿]")
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    await mongo.connect()
+    # 倒排索引：按词项和可见范围取最新的候选文档，按词项和文档计算相关度，按文档、动态删除词项
+    await mongo.search_index_db.create_index([("term", 1), ("kind", 1), ("readers", 1), ("created_at", -1)])
+    await mongo.search_index_db.create_index([("term", 1), ("kind", 1), ("doc_id", 1)])
+    await mongo.search_index_db.create_index([("kind", 1), ("doc_id", 1)])
+    await mongo.search_index_db.create_index([("kind", 1), ("moment_id", 1)])
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    分词：汉字按二元组（单个汉字时取单字），字母数字按小写单词
+    “朋友圈动态” -> ["朋友", "友圈", "圈动", "动态"]
+    """
+    terms: List[str] = []
+    for run in _TOKEN_PATTERN.findall((text or "").lower()):
+        if _CJK_PATTERN.match(run):
+            if len(run) == 1:
+                terms.append(run)
+            else:
+                terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.append(run)
+    return terms
+
+
+def readers_for(visibility: Optional[str], owner_id: Any) -> List[Any]:
+    """公开内容所有人可搜到，其余内容只有作者本人可以搜到"""
+    return [PUBLIC_READER] if visibility == "public" else [owner_id]
+
+
+def _stats_id(kind: str, term: str) -> str:
+    """search_stats 中每个词项一条文档频率记录，term 为空串的记录是该类型的文档总数"""
+    return f"{kind}:{term}"
+
+
+async def _update_stats(kind: str, term_deltas: Counter, doc_delta: int):
+    deltas = {term: delta for term, delta in term_deltas.items() if delta}
+    if doc_delta:
+        deltas[""] = doc_delta
+    if not deltas:
+        return
+    await mongo.search_stats_db.bulk_write([
+        UpdateOne({"_id": _stats_id(kind, term)},
+                  {"$inc": {"df": delta}, "$setOnInsert": {"kind": kind, "term": term}}, upsert=True)
+        for term, delta in deltas.items()
+    ])
+
+
+def _postings(kind: str, doc_id: str, text: str, created_at: Any, readers: List[Any],
+              moment_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    postings = []
+    for term, tf in Counter(tokenize(text)).items():
+        posting = {"term": term, "kind": kind, "doc_id": doc_id, "tf": tf, "created_at": created_at,
+                   "readers": readers}
+        if moment_id is not None:
+            posting["moment_id"] = moment_id
+        postings.append(posting)
+    return postings
+
+
+async def _remove(query: Dict[str, Any]) -> int:
+    """删除匹配的词项并扣减文档频率，返回涉及的文档数"""
+    kind = query["kind"]
+    postings = await mongo.search_index_db.find_many(query=query, projection={"_id": 0, "term": 1, "doc_id": 1})
+    if not postings:
+        return 0
+    await mongo.search_index_db.delete_many(query)
+    doc_count = len({posting["doc_id"] for posting in postings})
+    await _update_stats(kind, Counter({term: -count for term, count in
+                                       Counter(posting["term"] for posting in postings).items()}), -doc_count)
+    return doc_count
+
+
+async def index_document(kind: str, doc_id: Any, text: str, created_at: Optional[datetime], readers: List[Any],
+                         moment_id: Optional[str] = None):
+    """
+    发布动态、评论时写入倒排索引，并维护文档频率（先删除旧词项，重复调用结果一致）
+    readers 为可以搜到该文档的用户（见 readers_for），评论需传所属动态ID，动态删除时一并移除
+    """
+    doc_id = str(doc_id)
+    try:
+        await _remove({"kind": kind, "doc_id": doc_id})
+        postings = _postings(kind, doc_id, text, created_at or datetime.now(), readers, moment_id)
+        if not postings:
+            return
+        await mongo.search_index_db.bulk_write([InsertOne(posting) for posting in postings])
+        await _update_stats(kind, Counter(posting["term"] for posting in postings), 1)
+    except Exception as e:
+        log_error(f"写入搜索索引失败 {kind}:{doc_id}: {str(e)}")
+
+
+async def remove_document(kind: str, doc_id: Any):
+    """删除动态、评论时移除其词项；删除动态时其下评论也不再能被搜到"""
+    try:
+        await _remove({"kind": kind, "doc_id": str(doc_id)})
+        if kind == "moment":
+            await _remove({"kind": "comment", "moment_id": str(doc_id)})
+    except Exception as e:
+        log_error(f"删除搜索索引失败 {kind}:{doc_id}: {str(e)}")
+
+
+async def search(kind: str, query: str, offset: int = 0, limit: int = 10,
+                 viewer_id: Optional[int] = None) -> Tuple[List[str], bool]:
+    """
+    搜索当前用户可见的文档，返回按相关度排序的一页文档ID和是否还有更多
+    文档需包含查询的所有词项，相关度为 Σ tf × log(1 + N / df)，相同时新的在前；
+    候选为最少见词项下最新的 SEARCH_CANDIDATE_LIMIT 篇可见文档，可见范围在分页之前过滤
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return [], False
+
+    # 文档频率和文档总数一次读取，任一词项不存在时没有结果
+    stats = await mongo.search_stats_db.find_many(
+        query={"_id": {"$in": [_stats_id(kind, term) for term in terms + [""]]}},
+        projection={"_id": 0, "term": 1, "df": 1},
+    )
+    df_map = {stat["term"]: stat["df"] for stat in stats}
+    total = max(df_map.pop("", 0), 1)
+    if not all(df_map.get(term, 0) > 0 for term in terms):
+        return [], False
+
+    readers: List[Any] = [PUBLIC_READER] if viewer_id is None else [PUBLIC_READER, viewer_id]
+    rarest = min(terms, key=lambda term: df_map[term])
+    candidates = await mongo.search_index_db.find_many(
+        query={"term": rarest, "kind": kind, "readers": {"$in": readers}},
+        projection={"_id": 0, "doc_id": 1},
+        sort=[("created_at", -1)],
+        limit=SEARCH_CANDIDATE_LIMIT,
+    )
+    candidate_ids = [doc["doc_id"] for doc in candidates]
+    postings = await mongo.search_index_db.find_many(
+        query={"term": {"$in": terms}, "kind": kind, "doc_id": {"$in": candidate_ids}},
+        projection={"_id": 0, "term": 1, "doc_id": 1, "tf": 1, "created_at": 1},
+    )
+
+    matched: Dict[str, Dict[str, Any]] = {}
+    for posting in postings:
+        doc = matched.setdefault(posting["doc_id"], {"terms": 0, "score": 0.0, "created_at": posting.get("created_at")})
+        doc["terms"] += 1
+        doc["score"] += posting["tf"] * math.log(1 + total / df_map[posting["term"]])
+    ranked = sorted(
+        (doc_id for doc_id, doc in matched.items() if doc["terms"] == len(terms)),
+        key=lambda doc_id: (matched[doc_id]["score"], matched[doc_id]["created_at"] or datetime.min, doc_id),
+        reverse=True,
+    )
+    return ranked[offset:offset + limit], len(ranked) > offset + limit
+
+
+async def _rebuild_stats(kind: str, total: int):
+    """按词项重新统计文档频率，在服务端用 $merge 写入 search_stats，total 为索引的文档数"""
+    await mongo.search_stats_db.delete_many({"kind": kind})
+    await mongo.search_index_db.aggregate([
+        {"$match": {"kind": kind}},
+        {"$group": {"_id": "$term", "df": {"$sum": 1}}},
+        {"$project": {"_id": {"$concat": [kind, ":", "$_id"]}, "kind": {"$literal": kind}, "term": "$_id", "df": 1}},
+        {"$merge": {"into": "search_stats", "whenMatched": "replace"}},
+    ])
+    await _update_stats(kind, Counter(), total)
+
+
+async def rebuild_index(kind: str) -> int:
+    """离线重建某类对象的索引，按 _id 分批读取未删除的文档，返回索引的文档数"""
+    collection_name, text_field, time_field = SEARCH_TARGETS[kind]
+    collection = getattr(mongo, f"{collection_name}_db")
+    await mongo.search_index_db.delete_many({"kind": kind})
+    total, last_id = 0, None
+    while True:
+        query: Dict[str, Any] = {"is_delete": {"$ne": -1}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        docs = await collection.find_many(
+            query=query, projection={"_id": 1, text_field: 1, time_field: 1, "visibility": 1, "user_id": 1,
+                                     "moment_id": 1},
+            sort=[("_id", 1)], limit=REBUILD_BATCH_SIZE,
+        )
+        if not docs:
+            break
+        last_id = docs[-1]["_id"]
+        if kind == "comment":
+            # 评论的可见范围取自所属动态，已删除动态下的评论不再索引
+            moment_ids = {doc.get("moment_id") for doc in docs if ObjectId.is_valid(doc.get("moment_id"))}
+            moments = await mongo.article_db.find_many(
+                query={"_id": {"$in": [ObjectId(moment_id) for moment_id in moment_ids]}, "is_delete": 0},
+                projection={"_id": 1, "visibility": 1, "user_id": 1},
+            )
+            moment_map = {str(moment["_id"]): moment for moment in moments}
+            entries = [(doc, moment_map[doc["moment_id"]]) for doc in docs if doc.get("moment_id") in moment_map]
+        else:
+            entries = [(doc, doc) for doc in docs]
+        requests = [
+            InsertOne(posting)
+            for doc, owner in entries
+            for posting in _postings(kind, str(doc["_id"]), doc.get(text_field), doc.get(time_field),
+                                     readers_for(owner.get("visibility"), owner.get("user_id")),
+                                     doc.get("moment_id") if kind == "comment" else None)
+        ]
+        if requests:
+            await mongo.search_index_db.bulk_write(requests)
+        total += sum(1 for doc, _ in entries if tokenize(doc.get(text_field)))
+    await _rebuild_stats(kind, total)
+    return total
+
+
+async def rebuild_all():
+    await mongo.connect()
+    for kind in SEARCH_TARGETS:
+        count = await rebuild_index(kind)
+        log_info(f"重建搜索索引 {kind} {count} 条")
+
+
+if __name__ == "__main__":
+    # 离线重建：python -m utils.search
+    asyncio.run(rebuild_all())
@@ -0,0 +1,49 @@
+# encoding: UTF-8
+from typing import Any, Dict, Union
+from utils.redis import redis_client
+from utils.log import log_info
+
+# 键存在时递增并返回新序号，不存在时返回 -1 由调用方从历史消息初始化；
+# 检查和递增在一次往返中原子完成，Redis被清空或键被淘汰后也不会从 1 重新开始
+_incr_if_exists = redis_client.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+return redis.call('INCR', KEYS[1])
+""")
+
+
+def conversation_key(user_id: int, target_id: Union[int, str]) -> str:
+    """
+    会话的序号键：
+    群聊 seq:group:{group_id}，单聊两个方向共用 seq:single:{小ID}:{大ID}
+    """
+    if isinstance(target_id, str) and target_id.startswith("group_"):
+        return f"seq:group:{target_id}"
+    low, high = sorted((int(user_id), int(target_id)))
+    return f"seq:single:{low}:{high}"
+
+
+async def _seed_from_history(key: str, collection, query: Dict[str, Any]):
+    """Redis中没有序号（首次使用或Redis被清空）时，从已有消息的最大序号继续，保证不回退"""
+    # 归档模块依赖本模块的 conversation_key，在函数内导入避免循环引用
+    from utils.chat_archive import archived_max_seq
+
+    latest = await collection.find_many(query=query, projection={"seq": 1}, sort=[("seq", -1)], limit=1)
+    # 旧消息可能已移到归档文件，取两者中较大的序号
+    start = max(latest[0].get("seq", 0) if latest else 0, await archived_max_seq(key))
+    # 多个进程同时初始化时只有一个能写入
+    if redis_client.set(key, start, nx=True):
+        log_info(f"初始化会话序号 {key} = {start}")
+
+
+async def next_seq(key: str, collection, query: Dict[str, Any]) -> int:
+    """
+    分配会话内单调递增的消息序号（Redis INCR，所有进程共享同一个计数器）
+    collection/query 用于在计数器丢失时从历史消息恢复
+    """
+    seq = _incr_if_exists(keys=[key])
+    if seq == -1:
+        await _seed_from_history(key, collection, query)
+        seq = redis_client.incr(key)
+    return seq
@@ -0,0 +1,51 @@
+# encoding: UTF-8
+import asyncio
+from typing import Any, Dict, List
+from config.settings import settings
+from utils.group_events import publish_group_event, SYSTEM_MESSAGES
+from utils.log import log_error
+
+# 一个批次最多合并的系统消息数，达到后立即发送
+SYSTEM_MESSAGE_BATCH_SIZE = 100
+
+
+class SystemMessageBroadcaster:
+    """
+    群系统消息实时推送
+    同一个群在短时间内的多条系统消息（如一次拉50人，前端逐条发送）合并成一个事件推送，
+    经群事件频道送达所有进程，由各进程推给本进程内在线的群成员
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._pending: Dict[str, List[Dict[str, Any]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    async def add(self, group_id: str, message: Dict[str, Any]):
+        """加入待推送队列，窗口结束或达到批次上限时推送"""
+        pending = self._pending.setdefault(group_id, [])
+        pending.append(message)
+        if len(pending) >= SYSTEM_MESSAGE_BATCH_SIZE:
+            task = self._tasks.pop(group_id, None)
+            if task:
+                task.cancel()
+            await self._flush(group_id)
+        elif group_id not in self._tasks:
+            self._tasks[group_id] = asyncio.create_task(self._flush_later(group_id))
+
+    async def _flush_later(self, group_id: str):
+        await asyncio.sleep(self.window)
+        self._tasks.pop(group_id, None)
+        await self._flush(group_id)
+
+    async def _flush(self, group_id: str):
+        messages = self._pending.pop(group_id, None)
+        if not messages:
+            return
+        try:
+            await publish_group_event(SYSTEM_MESSAGES, group_id, messages=messages)
+        except Exception as e:
+            log_error(f"推送群系统消息失败 {group_id}: {str(e)}")
+
+
+system_messages = SystemMessageBroadcaster(window=settings.GROUP_SYSTEM_MESSAGE_WINDOW)
@@ -0,0 +1,328 @@
+# encoding: UTF-8
+"""
+朋友圈时间线：每个用户一个Redis有序集合，发动态时推送给作者和好友（大V改为读时合并发件箱）
+
+本项目没有好友关系表，“好友”取自单聊的最近聊天记录：与该用户有过单聊的用户即为好友（见 get_contacts）。
+两人第一次单聊时（is_contact 为假）由 reset_contact_timelines 清除双方的好友缓存和已构建的时间线，
+下次读取时按新的好友关系重建。
+"""
+import asyncio
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import redis
+from bson import ObjectId
+from init import app
+from config.settings import settings
+from utils.mongodb import MotorDB
+from utils.redis import redis_client
+from utils.cursor import to_millis, decode_cursor
+from utils.feed_cache import version_key, bump_versions, snapshot_versions
+from utils.log import log_info, log_error
+
+# 初始化MongoDB连接：动态在 article_db，好友关系取自 chat_db 的单聊最近聊天
+article_mongo = MotorDB(database="article_db")
+chat_mongo = MotorDB(database="chat_db")
+
+# 可见范围：public 所有人可见（进入公共时间线），private 仅自己可见，其余（如 friends）仅好友可见
+VISIBILITY_PUBLIC = "public"
+VISIBILITY_PRIVATE = "private"
+
+# 公共时间线，未登录或不传 user_id 时的“广场”
+PUBLIC_TIMELINE_KEY = "timeline:public"
+# 好友数超过 MOMENT_FANOUT_LIMIT 的作者，发动态时不推送给每个好友，读时合并其发件箱
+BIG_AUTHORS_KEY = "timeline:big_authors"
+
+# 时间线分数的格式版本：分数为按UTC解释的创建时间毫秒数（见 utils.cursor.to_millis）。
+# 早期分数是 datetime.timestamp()（按本地时区解释），格式变化后启动时清空旧时间线，读取时按新格式重建
+SCORE_FORMAT = "millis-utc"
+SCORE_FORMAT_KEY = "timeline:score_format"
+# 清空旧时间线时匹配的键；BIG_AUTHORS_KEY 和 SCORE_FORMAT_KEY 不是时间线，保留
+_TIMELINE_PATTERNS = ("timeline:*", "timeline_outbox:*")
+
+# 空集合无法保存在Redis中，用占位成员表示“已加载且为空”
+_EMPTY_MARK = "-"
+
+# 只推送到已存在的时间线，不活跃用户的时间线过期后在下次读取时从MongoDB重建
+_push_if_exists = redis_client.register_script("""
+local cap = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('ZADD', key, ARGV[2], ARGV[3])
+        redis.call('ZREMRANGEBYRANK', key, 0, -cap - 1)
+    end
+end
+return 0
+""")
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    await article_mongo.connect()
+    await chat_mongo.connect()
+    # 重建时间线按作者和时间取最近的动态
+    await article_mongo.article_db.create_index([("user_id", 1), ("is_delete", 1), ("created_at", -1), ("_id", -1)])
+    app.state.timeline_reset = asyncio.create_task(asyncio.to_thread(reset_stale_timelines))
+
+
+def reset_stale_timelines() -> int:
+    """
+    分数格式与 SCORE_FORMAT 不一致时删除所有时间线和发件箱，返回删除的键数
+    GETSET 保证多个进程中只有一个执行删除
+    """
+    try:
+        if redis_client.getset(SCORE_FORMAT_KEY, SCORE_FORMAT) == SCORE_FORMAT:
+            return 0
+        deleted = 0
+        for pattern in _TIMELINE_PATTERNS:
+            batch = []
+            for key in redis_client.scan_iter(match=pattern, count=1000):
+                if key in (BIG_AUTHORS_KEY, SCORE_FORMAT_KEY):
+                    continue
+                batch.append(key)
+                if len(batch) >= 1000:
+                    deleted += redis_client.unlink(*batch)
+                    batch = []
+            if batch:
+                deleted += redis_client.unlink(*batch)
+        log_info(f"时间线分数格式变更为 {SCORE_FORMAT}，删除旧时间线 {deleted} 个")
+        return deleted
+    except redis.RedisError as e:
+        log_error(f"清理旧时间线失败: {str(e)}")
+        return 0
+
+
+def _feed_key(user_id: int) -> str:
+    return f"timeline:{user_id}"
+
+
+def _outbox_key(user_id: int) -> str:
+    return f"timeline_outbox:{user_id}"
+
+
+def _contacts_key(user_id: int) -> str:
+    return f"moment_contacts:{user_id}"
+
+
+def moment_score(created_at: Any) -> int:
+    """时间线的排序分数：动态创建时间的毫秒数，与游标的编码一致"""
+    return to_millis(created_at)
+
+
+async def get_contacts(user_id: int) -> Set[int]:
+    """好友：有过单聊的用户，缓存到Redis"""
+    key = _contacts_key(user_id)
+    try:
+        cached = redis_client.smembers(key)
+        if cached:
+            return {int(contact) for contact in cached if contact != _EMPTY_MARK}
+    except redis.RedisError as e:
+        log_error(f"读取好友缓存失败 {user_id}: {str(e)}")
+
+    chats = await chat_mongo.recent_chats_db.find_many(
+        query={"user_id": user_id, "target_id": {"$type": "number"}},
+        projection={"_id": 0, "target_id": 1},
+    )
+    contacts = {int(chat["target_id"]) for chat in chats if chat["target_id"] != user_id}
+    try:
+        pipe = redis_client.pipeline()
+        pipe.sadd(key, *(contacts or [_EMPTY_MARK]))
+        pipe.expire(key, settings.MOMENT_CONTACTS_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        log_error(f"写入好友缓存失败 {user_id}: {str(e)}")
+    return contacts
+
+
+async def is_contact(user_id: int, target_id: int) -> bool:
+    """单聊消息写入最近聊天之前调用，判断两人是否已经是好友"""
+    return user_id == target_id or target_id in await get_contacts(user_id)
+
+
+def reset_contact_timelines(user_id: int, target_id: int):
+    """
+    两人第一次单聊、最近聊天写入之后调用：清除双方的好友缓存和时间线，
+    下次读取时按新的好友关系重建，包含新好友的动态
+    """
+    try:
+        redis_client.unlink(_contacts_key(user_id), _contacts_key(target_id),
+                            _feed_key(user_id), _feed_key(target_id))
+    except redis.RedisError as e:
+        log_error(f"清除好友时间线失败 {user_id}-{target_id}: {str(e)}")
+
+
+def _big_authors(user_ids: Iterable[int]) -> Set[int]:
+    """筛出其中走读扩散的大V作者"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.sismember(BIG_AUTHORS_KEY, user_id)
+        return {user_id for user_id, flag in zip(user_ids, pipe.execute()) if flag}
+    except redis.RedisError as e:
+        log_error(f"读取大V作者失败: {str(e)}")
+        return set()
+
+
+async def push_moment(moment: Dict[str, Any]):
+    """
+    发布动态时写扩散：按可见范围推送到作者、好友和公共时间线
+    好友数超过 MOMENT_FANOUT_LIMIT 的作者只写发件箱，由好友读取时合并
+    """
+    author_id = moment["user_id"]
+    moment_id = str(moment["_id"])
+    score = moment_score(moment.get("created_at"))
+    visibility = moment.get("visibility") or VISIBILITY_PUBLIC
+    cap = settings.MOMENT_TIMELINE_SIZE
+
+    keys = [_feed_key(author_id)]
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        if visibility != VISIBILITY_PRIVATE:
+            contacts = await get_contacts(author_id)
+            # 发件箱保存作者所有非私密动态，用于大V的读扩散
+            pipe.zadd(_outbox_key(author_id), {moment_id: score})
+            pipe.zremrangebyrank(_outbox_key(author_id), 0, -cap - 1)
+            if len(contacts) > settings.MOMENT_FANOUT_LIMIT:
+                pipe.sadd(BIG_AUTHORS_KEY, author_id)
+            else:
+                pipe.srem(BIG_AUTHORS_KEY, author_id)
+                keys.extend(_feed_key(contact) for contact in contacts)
+            if visibility == VISIBILITY_PUBLIC:
+                keys.append(PUBLIC_TIMELINE_KEY)
+        _push_if_exists(keys=keys, args=[cap, score, moment_id], client=pipe)
+        pipe.execute()
+    except redis.RedisError as e:
+        log_error(f"推送动态到时间线失败 {moment_id}: {str(e)}")
+    if visibility != VISIBILITY_PRIVATE:
+        keys.append(_outbox_key(author_id))
+    bump_versions(*[version_key("timeline", key) for key in keys])
+
+
+async def remove_moment(moment: Dict[str, Any]):
+    """删除动态时从作者、好友、发件箱和公共时间线中移除"""
+    author_id = moment["user_id"]
+    moment_id = str(moment["_id"])
+    contacts = await get_contacts(author_id)
+    keys = [_feed_key(author_id), _outbox_key(author_id), PUBLIC_TIMELINE_KEY]
+    keys.extend(_feed_key(contact) for contact in contacts)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrem(key, moment_id)
+        pipe.execute()
+    except redis.RedisError as e:
+        log_error(f"从时间线移除动态失败 {moment_id}: {str(e)}")
+    bump_versions(version_key("moment", moment_id), *[version_key("timeline", key) for key in keys])
+
+
+async def _load_timeline(key: str, query: Dict[str, Any]):
+    """时间线不存在时从MongoDB取最近 MOMENT_TIMELINE_SIZE 条动态重建"""
+    docs = await article_mongo.article_db.find_many(
+        query={**query, "is_delete": 0},
+        projection={"_id": 1, "created_at": 1},
+        sort=[("created_at", -1), ("_id", -1)],
+        limit=settings.MOMENT_TIMELINE_SIZE,
+    )
+    mapping = {str(doc["_id"]): moment_score(doc.get("created_at")) for doc in docs} or {_EMPTY_MARK: 0}
+    try:
+        pipe = redis_client.pipeline()
+        pipe.delete(key)
+        pipe.zadd(key, mapping)
+        pipe.expire(key, settings.MOMENT_TIMELINE_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        log_error(f"重建时间线失败 {key}: {str(e)}")
+
+
+async def _ensure_feed(user_id: int) -> List[int]:
+    """确保用户的时间线已加载，返回需要读时合并的大V好友"""
+    contacts = await get_contacts(user_id)
+    big_authors = _big_authors(contacts)
+    key = _feed_key(user_id)
+    if not redis_client.exists(key):
+        # 自己的全部动态 + 非大V好友的非私密动态
+        friends = [contact for contact in contacts if contact not in big_authors]
+        await _load_timeline(key, {"$or": [
+            {"user_id": user_id},
+            {"user_id": {"$in": friends}, "visibility": {"$ne": VISIBILITY_PRIVATE}},
+        ]})
+    for author_id in big_authors:
+        if not redis_client.exists(_outbox_key(author_id)):
+            await _load_timeline(_outbox_key(author_id),
+                                 {"user_id": author_id, "visibility": {"$ne": VISIBILITY_PRIVATE}})
+    return list(big_authors)
+
+
+def _page(keys: List[str], limit: int, cursor: Optional[str]) -> List[Tuple[str, int]]:
+    """
+    从多个时间线中取下一页，按 (分数, 动态ID) 倒序合并，返回 (动态ID, 分数)
+    cursor 编码了上一页最后一条的 (创建时间, ID)，分数相同的条目按ID继续往后取
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    max_score, last_id = "+inf", None
+    if cursor:
+        millis, object_id = decode_cursor(cursor)
+        max_score, last_id = millis, str(object_id)
+
+    for key in keys:
+        if last_id:
+            pipe.zcount(key, max_score, max_score)
+        pipe.expire(key, settings.MOMENT_TIMELINE_TTL)
+    results = pipe.execute()
+    ties = results[::2] if last_id else [0] * len(keys)
+    for key, tie in zip(keys, ties):
+        pipe.zrevrangebyscore(key, max_score, "-inf", start=0, num=limit + tie, withscores=True)
+
+    entries: Dict[str, float] = {}
+    for items in pipe.execute():
+        for member, score in items:
+            if member == _EMPTY_MARK:
+                continue
+            if last_id and score == max_score and member >= last_id:
+                continue
+            entries[member] = score
+    ordered = sorted(entries.items(), key=lambda item: (item[1], item[0]), reverse=True)
+    return [(member, int(score)) for member, score in ordered[:limit]]
+
+
+async def read_timeline(user_id: Optional[int], limit: int,
+                        cursor: Optional[str] = None) -> Tuple[List[Tuple[str, ObjectId]], Dict[str, Optional[str]]]:
+    """
+    读取时间线中的下一页动态ID，同时返回读取前各时间线的版本号，供响应缓存记录依赖
+    传 user_id 时为好友时间线（合并大V好友的发件箱），否则为公共时间线
+    """
+    keys: List[str] = []
+    versions: Dict[str, Optional[str]] = {}
+    try:
+        if user_id is None:
+            keys = [PUBLIC_TIMELINE_KEY]
+            if not redis_client.exists(PUBLIC_TIMELINE_KEY):
+                await _load_timeline(PUBLIC_TIMELINE_KEY, {"visibility": VISIBILITY_PUBLIC})
+        else:
+            big_authors = await _ensure_feed(user_id)
+            keys = [_feed_key(user_id)] + [_outbox_key(author_id) for author_id in big_authors]
+        versions = snapshot_versions(version_key("timeline", key) for key in keys)
+        ids = [(moment_id, ObjectId(moment_id)) for moment_id, _ in _page(keys, limit, cursor)
+               if ObjectId.is_valid(moment_id)]
+        return ids, versions
+    except redis.RedisError as e:
+        log_error(f"读取时间线失败 {user_id}: {str(e)}")
+        return [], versions
+
+
+async def get_timeline_moments(user_id: Optional[int], limit: int,
+                               cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Optional[str]]]:
+    """
+    一次ZREVRANGE取ID，一次 $in 批量取动态，按时间线顺序返回
+    同时返回这一页依赖的版本号（时间线和各条动态），均在读取对应数据之前获取
+    """
+    ids, versions = await read_timeline(user_id, limit, cursor)
+    if not ids:
+        return [], versions
+    versions.update(snapshot_versions(version_key("moment", moment_id) for moment_id, _ in ids))
+    docs = await article_mongo.article_db.find_many(
+        query={"_id": {"$in": [object_id for _, object_id in ids]}, "is_delete": 0}
+    )
+    doc_map = {str(doc["_id"]): doc for doc in docs}
+    return [doc_map[moment_id] for moment_id, _ in ids if moment_id in doc_map], versions
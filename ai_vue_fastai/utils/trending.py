@@ -0,0 +1,98 @@
+# encoding: UTF-8
+import math
+import time
+from datetime import datetime
+from typing import List, Optional
+import redis
+from config.settings import settings
+from utils.redis import redis_client
+from utils.log import log_error
+
+# 热门动态排行，成员为动态ID
+TRENDING_KEY = "trending:moments"
+
+# 各类事件的权重
+EVENT_WEIGHTS = {
+    "create": 1.0,
+    "like": 1.0,
+    "comment": 3.0,
+    "share": 5.0,
+}
+
+# 衰减到初始权重的 2^-20 以下的动态移出排行
+_PRUNE_HALF_LIVES = 20
+
+# 分数为 log2(Σ 权重 × 2^(事件时间/半衰期))。
+# 所有动态随时间按同一比例衰减，排序只取决于这个值，因此不需要定时重算每个动态的分数；
+# 用对数保存避免指数随时间溢出，事件到达时在脚本中原子地做对数加减
+_apply_event = redis_client.register_script("""
+local current = redis.call('ZSCORE', KEYS[1], ARGV[1])
+local add = tonumber(ARGV[2])
+local sign = tonumber(ARGV[3])
+local create = ARGV[4] == '1'
+local new
+if not current then
+    if not (create and sign > 0) then
+        return 0
+    end
+    new = add
+else
+    current = tonumber(current)
+    if sign > 0 then
+        local hi = math.max(current, add)
+        local lo = math.min(current, add)
+        new = hi + math.log(1 + 2 ^ (lo - hi)) / math.log(2)
+    else
+        if add >= current then
+            redis.call('ZREM', KEYS[1], ARGV[1])
+            return 0
+        end
+        new = current + math.log(1 - 2 ^ (add - current)) / math.log(2)
+    end
+end
+redis.call('ZADD', KEYS[1], new, ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[5])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[6]) - 1)
+return 1
+""")
+
+
+def _now_exponent() -> float:
+    return time.time() / settings.TRENDING_HALF_LIFE
+
+
+def record_event(moment_id: str, event: str, sign: int = 1, occurred_at: Optional[datetime] = None):
+    """
+    记录一次互动，增量更新动态的热度
+    只有发布时（create）会把动态加入排行，其余事件只更新已在排行中的公开动态；sign 为 -1 时撤销（如取消点赞），
+    撤销时 occurred_at 传原事件的时间，减去的是当时加上的那一份，而不是按当前时间计算的更大的值
+    """
+    weight = EVENT_WEIGHTS.get(event)
+    if not weight:
+        return
+    now = _now_exponent()
+    at = occurred_at.timestamp() / settings.TRENDING_HALF_LIFE if occurred_at else now
+    try:
+        _apply_event(keys=[TRENDING_KEY], args=[
+            str(moment_id), at + math.log2(weight), 1 if sign > 0 else -1, 1 if event == "create" else 0,
+            now - _PRUNE_HALF_LIVES, settings.TRENDING_SIZE,
+        ])
+    except redis.RedisError as e:
+        log_error(f"更新热门排行失败 {moment_id}: {str(e)}")
+
+
+def remove_trending(moment_id: str):
+    """动态删除后移出排行"""
+    try:
+        redis_client.zrem(TRENDING_KEY, str(moment_id))
+    except redis.RedisError as e:
+        log_error(f"移出热门排行失败 {moment_id}: {str(e)}")
+
+
+def get_trending_ids(offset: int, limit: int) -> List[str]:
+    """按热度从高到低取一页动态ID"""
+    try:
+        return redis_client.zrevrange(TRENDING_KEY, offset, offset + limit - 1)
+    except redis.RedisError as e:
+        log_error(f"读取热门排行失败: {str(e)}")
+        return []
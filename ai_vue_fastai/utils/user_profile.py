@@ -0,0 +1,72 @@
+# encoding: UTF-8
+import json
+from typing import Any, Dict, Iterable
+import redis
+from sqlmodel import Session
+from utils.mysql_crud import UserCRUD
+from utils.redis import redis_client
+from utils.log import log_error
+
+# 用户信息缓存时间（秒）
+PROFILE_CACHE_TTL = 3600
+
+
+def _profile_key(user_id: int) -> str:
+    # 与登录、修改资料时写入的缓存键一致
+    return f"{user_id}_info"
+
+
+def _profile_from_user(user) -> Dict[str, Any]:
+    return {
+        "username": user.username or "",
+        "phone": user.phone,
+        "id": user.id,
+        "email": user.email or "",
+        "photo": user.photo or ""
+    }
+
+
+def cache_user_profile(user):
+    """用户资料（如头像）变更后刷新缓存"""
+    try:
+        redis_client.set(_profile_key(user.id), json.dumps(_profile_from_user(user)), ex=PROFILE_CACHE_TTL)
+    except redis.RedisError as e:
+        log_error(f"写入用户缓存失败: {str(e)}")
+
+
+def get_user_profiles(user_ids: Iterable[int], session: Session) -> Dict[int, Dict[str, Any]]:
+    """
+    批量获取用户信息：一次Redis MGET，未命中的用户一次MySQL IN查询并回填缓存
+    返回 {用户ID: 用户信息}，不存在的用户不在结果中
+    """
+    user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    if not user_ids:
+        return {}
+
+    profiles: Dict[int, Dict[str, Any]] = {}
+    try:
+        cached = redis_client.mget([_profile_key(user_id) for user_id in user_ids])
+    except redis.RedisError as e:
+        log_error(f"批量读取用户缓存失败: {str(e)}")
+        cached = [None] * len(user_ids)
+
+    for user_id, data in zip(user_ids, cached):
+        if not data:
+            continue
+        try:
+            profiles[user_id] = json.loads(data)
+        except json.JSONDecodeError:
+            log_error(f"Failed to parse cached data for user {user_id}")
+
+    missing = [user_id for user_id in user_ids if user_id not in profiles]
+    if missing:
+        users = UserCRUD(session).get_users_by_ids(missing)
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for user in users:
+                profiles[user.id] = _profile_from_user(user)
+                pipe.set(_profile_key(user.id), json.dumps(profiles[user.id]), ex=PROFILE_CACHE_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            log_error(f"回填用户缓存失败: {str(e)}")
+    return profiles
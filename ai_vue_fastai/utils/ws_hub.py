@@ -0,0 +1,56 @@
+# encoding: UTF-8
+import json
+from typing import Any, Dict, Set, Union
+from fastapi import WebSocket
+from utils.log import log_error
+
+
+class ConnectionHub:
+    """
+    多路复用连接管理：每个用户一条WebSocket，承载所有单聊和群聊会话
+    会话ID与最近聊天的 target_id 一致：单聊是对方用户ID，群聊是 group_ 开头的群ID
+    """
+
+    def __init__(self):
+        self.sockets: Dict[int, WebSocket] = {}
+        self.subscriptions: Dict[int, Set[str]] = {}
+
+    def connect(self, user_id: int, websocket: WebSocket):
+        self.sockets[user_id] = websocket
+        self.subscriptions.setdefault(user_id, set())
+
+    def disconnect(self, user_id: int, websocket: WebSocket):
+        # 同一用户重连时旧连接的断开不能把新连接删掉
+        if self.sockets.get(user_id) is websocket:
+            self.sockets.pop(user_id, None)
+            self.subscriptions.pop(user_id, None)
+
+    def subscribe(self, user_id: int, conversation_id: Union[int, str]):
+        self.subscriptions.setdefault(user_id, set()).add(str(conversation_id))
+
+    def unsubscribe(self, user_id: int, conversation_id: Union[int, str]):
+        self.subscriptions.get(user_id, set()).discard(str(conversation_id))
+
+    def is_subscribed(self, user_id: int, conversation_id: Union[int, str]) -> bool:
+        return str(conversation_id) in self.subscriptions.get(user_id, ())
+
+    async def send_frame(self, user_id: int, frame: Dict[str, Any]) -> bool:
+        """向用户的多路复用连接发送一帧"""
+        websocket = self.sockets.get(user_id)
+        if not websocket:
+            return False
+        try:
+            await websocket.send_text(json.dumps(frame, default=str))
+            return True
+        except Exception as e:
+            log_error(f"发送消息到用户 {user_id} 失败: {str(e)}")
+            return False
+
+    async def send(self, user_id: int, conversation_id: Union[int, str], data: Dict[str, Any]) -> bool:
+        """用户订阅了该会话时推送一条消息"""
+        if not self.is_subscribed(user_id, conversation_id):
+            return False
+        return await self.send_frame(user_id, {"op": "message", "conv": conversation_id, "data": data})
+
+
+hub = ConnectionHub()
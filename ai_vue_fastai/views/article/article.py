@@ -1,6 +1,6 @@
 # encoding: UTF-8
 from typing import List, Optional,Dict, Any
-from fastapi import HTTPException, APIRouter, Depends, Query, UploadFile, File, Form,Request
+from fastapi import HTTPException, APIRouter, BackgroundTasks, Depends, Query, UploadFile, File, Form,Request
 from pydantic import BaseModel
 from bson import ObjectId
 from init import app
@@ -8,12 +8,22 @@ from utils.mongodb import MotorDB
 from utils.mysql_crud import UserCRUD
 from sqlmodel import Session
 from utils.database import get_session
+from utils.get_current_user import get_current_user_id, get_optional_user_id
 import os
 from config.settings import settings
 import uuid
 from datetime import datetime
 from fastapi.responses import JSONResponse
 from utils.log import log_info
+from utils.timeline import push_moment, remove_moment, get_timeline_moments
+from utils.moment_comments import load_comments, REPLY_PREVIEW_COUNT
+from utils.cursor import encode_cursor, cursor_query
+from utils.like_service import toggle_like, get_liked
+from utils.author_snapshot import author_snapshot, snapshot_of
+from utils.feed_cache import (get_cached, set_cached, snapshot_versions, etag_response, version_key,
+                              bump_versions)
+from utils.trending import record_event, remove_trending, get_trending_ids
+from utils.search import index_document, remove_document, search, readers_for
 # 初始化MongoDB连接
 mongo = MotorDB(database="article_db")
 # collection 是article
@@ -24,6 +34,8 @@ router = APIRouter(tags=["朋友圈信息"])
 @app.on_event("startup")
 async def startup_db_client():
     await mongo.connect()
+    # 每个用户对每条动态只计一次转发
+    await mongo.share_db.create_index([("moment_id", 1), ("user_id", 1)], unique=True)
 
 
 # 数据模型
@@ -63,10 +75,13 @@ class MomentResponse(BaseModel):
     stats: Optional[Stats] = None
     visibility: Optional[str] = None
     is_delete: int
-    like_users: List[int] = []
+    # 当前用户是否点过赞；点赞用户列表不再随动态返回
+    is_liked: bool = False
     user: UserInfo
     created_at: datetime
     updated_at: Optional[datetime] = None
+    # 分页游标：取下一页时把本页最后一条的 cursor 传回
+    cursor: Optional[str] = None
 
     class Config:
         json_encoders = {
@@ -75,8 +90,18 @@ class MomentResponse(BaseModel):
 
 class DetailMomentResponse(MomentResponse):
     comments: List[Dict] = []
-    like_users: List[int] = []
     stats: Optional[Stats] = None
+    # 评论下一页游标，为空表示没有更多评论
+    comment_cursor: Optional[str] = None
+
+# 搜索结果，has_more 为 true 时用 offset + limit 继续请求下一页
+class SearchMomentsResponse(BaseModel):
+    items: List[DetailMomentResponse]
+    has_more: bool
+
+class SearchCommentsResponse(BaseModel):
+    items: List[Dict]
+    has_more: bool
 
 class DeleteMomentRequest(BaseModel):
     moment_id: str
@@ -96,6 +121,13 @@ class CommentResponseMode(SuccessResponseModel):
     comment_user_name: str
     comment_user_id: int
 
+class ShareMomentRequest(BaseModel):
+    moment_id: str
+    user_id: int
+
+class ShareResponseModel(SuccessResponseModel):
+    shares_count: int
+
 class CommentRequest(BaseModel):
     comment_user_id: int
     comment: str
@@ -106,6 +138,7 @@ class CommentRequest(BaseModel):
 @router.post("/moments", response_model=SuccessResponseModel)
 async def create_moment(
     request: CreateMomentRequest,
+    background_tasks: BackgroundTasks,
     session: Session = Depends(get_session)
 ):
     # 验证用户
@@ -120,18 +153,15 @@ async def create_moment(
     # 验证media数据结构
     # 自动通过Pydantic验证media结构
     media_data = [item.dict() for item in request.media]
-    # 构建用户信息
-    user_dict = {
-        "username": user.username,
-        "photo": user.photo
-    }
+    # 构建用户信息：作者快照，资料变更时由后台任务同步
+    user_dict = author_snapshot(user)
 
     # 创建动态文档
+    now = datetime.now()
     moment_data = {
         "user_id": request.user_id,
         "content": request.content,
         "media": media_data,
-        "like_users":[],
         "stats": {
             "likes": 0,
             "comments": 0,
@@ -140,8 +170,8 @@ async def create_moment(
         "visibility": request.visibility,
         "is_delete": 0,
         "user": user_dict,
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat()
+        "created_at": now,
+        "updated_at": now
     }
 
     try:
@@ -152,6 +182,13 @@ async def create_moment(
                 status_code=400,
                 detail="动态创建失败"
             )
+        # 按可见范围推送到作者、好友和公共时间线，公开动态进入热门排行
+        await push_moment({**moment_data, "_id": inserted_id})
+        # 分词和倒排索引写入在响应返回后执行
+        background_tasks.add_task(index_document, "moment", inserted_id, request.content, now,
+                                  readers_for(request.visibility, request.user_id))
+        if request.visibility == "public":
+            record_event(inserted_id, "create")
         result = {
             "msg": "success",
             "status_code": 200
@@ -168,54 +205,156 @@ async def create_moment(
 
 @router.get("/moments", response_model=List[DetailMomentResponse])
 async def get_moments(
-        last_id: Optional[str] = Query(None),
+        request: Request,
+        user_id: Optional[int] = Query(None, description="兼容旧参数，只能是当前登录用户"),
+        public: bool = Query(False, description="为 true 时返回公共动态"),
+        cursor: Optional[str] = Query(None, description="上一页最后一条的 cursor"),
         limit: int = Query(10, gt=0, le=50),
+        current_user_id: Optional[int] = Depends(get_optional_user_id),
         session: Session = Depends(get_session)
 ):
+    """登录用户返回自己的好友时间线，未登录或 public=true 时返回公共动态"""
+    if user_id is not None and user_id != current_user_id:
+        raise HTTPException(status_code=403, detail="只能查看自己的时间线")
+    # 好友时间线只按token中的用户读取，公共时间线 timeline_user 为 None；是否点赞始终按当前用户返回
+    timeline_user = None if public else current_user_id
     try:
-        query = {"is_delete": 0}
-        if last_id:
-            # 确保 last_id 是有效的 ObjectId
-            if not ObjectId.is_valid(last_id):
-                raise HTTPException(status_code=400, detail="无效的last_id格式")
-
-            last_moment = await mongo.article_db.find_one({"_id": ObjectId(last_id)})
-            if not last_moment:
-                raise HTTPException(status_code=400, detail="无效的last_id")
-            query["created_at"] = {"$lt": last_moment["created_at"]}
-        sort = [("created_at", -1)]
-
-        moments = await mongo.article_db.find_many(
-            query=query,
-            sort=sort,
-            limit=limit
-        )
+        # 未变化的页面直接返回缓存，客户端带 If-None-Match 时返回 304；页面中带有点赞状态，按查看者分开缓存
+        cache_name = f"moments:{timeline_user}:{current_user_id}:{cursor}:{limit}"
+        cached = get_cached(cache_name)
+        if cached:
+            return etag_response(request, cached)
+        # 时间线中取一页动态ID，再一次 $in 取出动态
+        moments, versions = await get_timeline_moments(timeline_user, limit, cursor)
+        liked = await get_liked(current_user_id, {"moment": [str(moment["_id"]) for moment in moments]})
 
-        crud = UserCRUD(session)
         moments_list = []
         for moment in moments:
-            user = crud.get_user_by_user_id(moment["user_id"])
-            if user:
-                user_dict = {
-                    "username": user.username,
-                    "photo": user.photo
-                }
-                moment["user"] = user_dict
-            else:
-                moment["user"] = {
-                    "username": "未知用户",
-                    "photo": ""
-                }
+            # 作者信息直接使用快照，不再逐条查询MySQL
+            moment["user"] = snapshot_of(moment)
+            moment["cursor"] = encode_cursor(moment["created_at"], moment["_id"])
             moment["id"] = str(moment.pop("_id"))
+            moment["is_liked"] = ("moment", moment["id"]) in liked
             log_info(f"moment: {moment}")
-            moments_list.append(moment)
-        return moments_list
+            moments_list.append(DetailMomentResponse(**moment))
+        return etag_response(request, set_cached(cache_name, moments_list, versions))
 
+    except HTTPException as he:
+        raise he
     except TypeError as e:
         raise HTTPException(status_code=400, detail=f"参数类型错误: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
 
+@router.get("/moments/trending", response_model=List[DetailMomentResponse])
+async def get_trending_moments(
+        offset: int = Query(0, ge=0),
+        limit: int = Query(10, gt=0, le=50),
+        viewer_id: Optional[int] = Depends(get_optional_user_id),
+):
+    """热门动态：从预先维护的热度排行中取一页，不在查询时排序动态集合"""
+    try:
+        moment_ids = [moment_id for moment_id in get_trending_ids(offset, limit) if ObjectId.is_valid(moment_id)]
+        if not moment_ids:
+            return []
+        docs = await mongo.article_db.find_many(
+            query={"_id": {"$in": [ObjectId(moment_id) for moment_id in moment_ids]}, "is_delete": 0}
+        )
+        doc_map = {str(doc["_id"]): doc for doc in docs}
+        liked = await get_liked(viewer_id, {"moment": list(doc_map)})
+
+        moments_list = []
+        for moment_id in moment_ids:
+            moment = doc_map.get(moment_id)
+            if not moment:
+                continue
+            moment["user"] = snapshot_of(moment)
+            moment["id"] = str(moment.pop("_id"))
+            moment["is_liked"] = ("moment", moment_id) in liked
+            moments_list.append(moment)
+        return moments_list
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
+
+@router.get("/search/moments", response_model=SearchMomentsResponse)
+async def search_moments(
+        q: str = Query(..., min_length=1, max_length=100, description="搜索内容"),
+        offset: int = Query(0, ge=0),
+        limit: int = Query(10, gt=0, le=50),
+        viewer_id: Optional[int] = Depends(get_optional_user_id),
+):
+    """按内容搜索动态，结果按相关度排序；登录用户还能搜到自己的非公开动态"""
+    try:
+        # 可见范围在索引中过滤后再分页，这里的查询只排除刚被删除、索引尚未移除的动态
+        moment_ids, has_more = await search("moment", q, offset, limit, viewer_id)
+        if not moment_ids:
+            return {"items": [], "has_more": has_more}
+        visible = [{"visibility": "public"}]
+        if viewer_id is not None:
+            visible.append({"user_id": viewer_id})
+        docs = await mongo.article_db.find_many(
+            query={"_id": {"$in": [ObjectId(moment_id) for moment_id in moment_ids]}, "is_delete": 0, "$or": visible}
+        )
+        doc_map = {str(doc["_id"]): doc for doc in docs}
+        liked = await get_liked(viewer_id, {"moment": list(doc_map)})
+
+        moments_list = []
+        for moment_id in moment_ids:
+            moment = doc_map.get(moment_id)
+            if not moment:
+                continue
+            moment["user"] = snapshot_of(moment)
+            moment["id"] = str(moment.pop("_id"))
+            moment["is_liked"] = ("moment", moment_id) in liked
+            moments_list.append(moment)
+        return {"items": moments_list, "has_more": has_more}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
+
+@router.get("/search/comments", response_model=SearchCommentsResponse)
+async def search_comments(
+        q: str = Query(..., min_length=1, max_length=100, description="搜索内容"),
+        offset: int = Query(0, ge=0),
+        limit: int = Query(10, gt=0, le=50),
+        viewer_id: Optional[int] = Depends(get_optional_user_id),
+):
+    """按内容搜索评论，只返回可见动态下的评论，结果按相关度排序"""
+    try:
+        comment_ids, has_more = await search("comment", q, offset, limit, viewer_id)
+        if not comment_ids:
+            return {"items": [], "has_more": has_more}
+        comments = await mongo.comment_db.find_many(
+            query={"_id": {"$in": [ObjectId(comment_id) for comment_id in comment_ids]}, "is_delete": {"$ne": -1}}
+        )
+        visible = [{"visibility": "public"}]
+        if viewer_id is not None:
+            visible.append({"user_id": viewer_id})
+        moment_ids = {comment["moment_id"] for comment in comments if ObjectId.is_valid(comment.get("moment_id"))}
+        moments = await mongo.article_db.find_many(
+            query={"_id": {"$in": [ObjectId(moment_id) for moment_id in moment_ids]}, "is_delete": 0, "$or": visible},
+            projection={"_id": 1}
+        )
+        visible_moments = {str(moment["_id"]) for moment in moments}
+        comment_map = {str(comment["_id"]): comment for comment in comments if comment.get("moment_id") in visible_moments}
+
+        comments_list = []
+        for comment_id in comment_ids:
+            comment = comment_map.get(comment_id)
+            if not comment:
+                continue
+            comment["_id"] = comment_id
+            comment["comment_id"] = comment_id
+            comments_list.append(comment)
+        return {"items": comments_list, "has_more": has_more}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
+
 @router.post("/upload/media")
 async def upload_media(file: UploadFile = File(...)):
     try:
@@ -290,21 +429,26 @@ async def upload_media(file: UploadFile = File(...)):
 @router.post("/delete/moment", response_model=SuccessResponseModel)
 async def delete_moment(
     request: DeleteMomentRequest,
+    background_tasks: BackgroundTasks,
     session: Session = Depends(get_session),
 ):
     try:
         # 将 moment_id 转换为 ObjectId 类型
         moment_object_id = ObjectId(request.moment_id)
         # 更新动态文档，将 is_delete 字段设置为 -1
-        result = await mongo.article_db.update_one(
+        moment = await mongo.article_db.find_one_and_update(
             {"_id": moment_object_id},
-            {"$set": {"is_delete": -1, "updated_at": datetime.now().isoformat()}}
+            {"$set": {"is_delete": -1, "updated_at": datetime.now()}},
+            projection={"_id": 1, "user_id": 1}
         )
-        if result == 0:
+        if not moment:
             raise HTTPException(
                 status_code=404,
                 detail="未找到该动态"
             )
+        await remove_moment(moment)
+        remove_trending(request.moment_id)
+        background_tasks.add_task(remove_document, "moment", request.moment_id)
 
         result = {
             "msg": "success",
@@ -327,70 +471,73 @@ async def delete_moment(
 @router.post("/like_moment",response_model=LikeResponseModel)
 async def like_moment(request: LikeMomentRequest):
     try:
-        # 使用原子操作确保数据一致性
-        update_operation = {
-            "$set": {"updated_at": datetime.now().isoformat()},
-            "$inc": {"stats.likes": 1 if request.is_like else -1}
-        }
-
-        # 插入到Like表中
-        like_dict = {
-            "moment_id": request.moment_id,
-            "user_id": request.user_id,
-            "type": "moment",
-            "create_dt": datetime.now().isoformat(),
-
-        }
-        # 先查看点赞表中是否存在：
-        # like_result = await mongo.like_db.find_one(
-        #     {"moment_id": request.moment_id, "user_id": request.user_id}
-        # )
-        # is_like = 0
-        # if like_result:
-        #     is_like = like_result.get("is_like")
-        if request.is_like :
-            update_operation["$addToSet"] = {"like_users": request.user_id}
-            like_dict["is_like"] = 1
-            await mongo.like_db.insert(like_dict)
-        else:
-            update_operation["$pull"] = {"like_users": request.user_id}
-            #取消点赞
-            result =  await mongo.like_db.find_one({"moment_id": request.moment_id, "user_id":request.user_id, "type": "moment"})
-            await mongo.like_db.update_one({"_id": result.get("_id")}, {"$set": {"is_like": 0}})
-
-
-
-
-        result = await mongo.article_db.update_one(
-            {"_id": ObjectId(request.moment_id)},
-            update_operation
-        )
-
-        # 返回完整状态
-        updated = await mongo.article_db.find_one(
-            {"_id": ObjectId(request.moment_id)}
-        )
+        # 幂等：重复点赞/重复取消不会改变点赞数
+        likes_count = await toggle_like("moment", request.moment_id, request.user_id, request.is_like)
         return {
             "msg": "success",
             "status_code": 200,
             "user_id": request.user_id,
             "is_liked": request.is_like,
-            "likes_count": updated["stats"]["likes"]
+            "likes_count": likes_count
         }
+    except HTTPException as he:
+        return JSONResponse(
+            status_code=he.status_code,
+            content={"success": False, "msg": he.detail}
+        )
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"success": False, "msg": str(e)}
         )
 
+@router.post("/share_moment", response_model=ShareResponseModel)
+async def share_moment(request: ShareMomentRequest, current_user_id: int = Depends(get_current_user_id)):
+    """
+    记录一次转发，更新转发数和热度
+    转发记录按 (动态, 用户) 去重，同一用户重复转发只在第一次计数，不能靠重复提交刷热度
+    """
+    if request.user_id != current_user_id:
+        raise HTTPException(status_code=403, detail="用户ID不匹配")
+    if not ObjectId.is_valid(request.moment_id):
+        raise HTTPException(status_code=400, detail="无效的moment_id格式")
+    moment = await mongo.article_db.find_one({"_id": ObjectId(request.moment_id), "is_delete": 0},
+                                             projection={"_id": 0, "stats.shares": 1})
+    if not moment:
+        raise HTTPException(status_code=404, detail="动态不存在")
+    try:
+        previous = await mongo.share_db.find_one_and_update(
+            {"moment_id": request.moment_id, "user_id": current_user_id},
+            {"$setOnInsert": {"moment_id": request.moment_id, "user_id": current_user_id,
+                              "create_dt": datetime.now()}},
+            upsert=True, return_new=False, projection={"_id": 1}
+        )
+    except HTTPException:
+        # 并发的重复转发撞上唯一索引，视为已转发
+        previous = {}
+    if previous is None:
+        moment = await mongo.article_db.find_one_and_update(
+            {"_id": ObjectId(request.moment_id)},
+            {"$inc": {"stats.shares": 1}},
+            projection={"_id": 0, "stats.shares": 1}
+        ) or moment
+        bump_versions(version_key("moment", request.moment_id))
+        record_event(request.moment_id, "share")
+    return {
+        "msg": "success",
+        "status_code": 200,
+        "shares_count": (moment.get("stats") or {}).get("shares", 0)
+    }
+
 @router.post("/post_comment",response_model=CommentResponseMode)
-async def post_moment(request: CommentRequest, session: Session = Depends(get_session)):
+async def post_moment(request: CommentRequest, background_tasks: BackgroundTasks,
+                      session: Session = Depends(get_session)):
     try:
         comment_user_id = request.comment_user_id
         comment = request.comment
         moment_id = request.moment_id
         comment_user_name = request.comment_user_name
-        created_dt = datetime.now().isoformat()
+        created_dt = datetime.now()
         # 验证用户
         crud = UserCRUD(session)
         user = crud.get_user_by_user_id(comment_user_id)
@@ -406,8 +553,8 @@ async def post_moment(request: CommentRequest, session: Session = Depends(get_se
             "comment": comment,
             "created_at": created_dt,
             "comment_user_name": user.username,
+            "comment_user_photo": user.photo or "",
             "is_delete": 0,
-            "like_users":[],
             "stats": {
                 "likes": 0,
                 "comments": 0,
@@ -415,7 +562,7 @@ async def post_moment(request: CommentRequest, session: Session = Depends(get_se
             },
             "comment_user_id": comment_user_id
         }
-        await mongo.comment_db.insert(comment_data)
+        comment_id = await mongo.comment_db.insert(comment_data)
 
         # 更新article_db
         update_operation = {
@@ -428,10 +575,15 @@ async def post_moment(request: CommentRequest, session: Session = Depends(get_se
             {"_id": ObjectId(moment_id)},
             update_operation
         )
+        bump_versions(version_key("moment", moment_id))
+        record_event(moment_id, "comment")
         # 获取更新后的文章信息
         updated = await mongo.article_db.find_one(
             {"_id": ObjectId(moment_id)}
         )
+        # 评论的可见范围跟随所属动态，索引写入在响应返回后执行
+        background_tasks.add_task(index_document, "comment", comment_id, comment, created_dt,
+                                  readers_for(updated.get("visibility"), updated.get("user_id")), moment_id=moment_id)
         return {
             "msg": "success",
             "status_code": 200,
@@ -449,61 +601,47 @@ async def post_moment(request: CommentRequest, session: Session = Depends(get_se
 
 @router.get("/moment", response_model=DetailMomentResponse)
 async def get_moment_by_id(
+        request: Request,
         moment_id: str = Query(..., description="动态的唯一标识ID"),
+        comment_cursor: Optional[str] = Query(None, description="评论游标，上一页返回的 comment_cursor"),
+        comment_limit: int = Query(20, gt=0, le=100),
+        reply_limit: int = Query(REPLY_PREVIEW_COUNT, gt=0, le=20, description="每条评论附带的回复数"),
+        viewer_id: Optional[int] = Depends(get_optional_user_id),
         session: Session = Depends(get_session)
 ):
     """
     通过moment_id获取单个动态详情
+    评论按游标分页，每条评论附带前几条回复，更多回复通过 /moment/replies 加载
     """
     try:
         # 验证moment_id格式
         if not ObjectId.is_valid(moment_id):
             raise HTTPException(status_code=400, detail="无效的moment_id格式")
+        cache_name = f"moment:{moment_id}:{viewer_id}:{comment_cursor}:{comment_limit}:{reply_limit}"
+        cached = get_cached(cache_name)
+        if cached:
+            return etag_response(request, cached)
         # 转换ObjectId
         obj_id = ObjectId(moment_id)
-        crud = UserCRUD(session)
+        # 先记下动态的版本号再查询：动态本身、评论、回复及其点赞的变化都会递增动态的版本号，
+        # 查询期间发生的变化会使这条缓存失效
+        versions = snapshot_versions([version_key("moment", moment_id)])
         # 查询数据库
         moment = await mongo.article_db.find_one({"_id": obj_id, "is_delete": 0})
         if not moment:
             raise HTTPException(status_code=404, detail="动态不存在")
-        #加上user的信息，因为user有可能会更新
-        # 先获取user_id
-        user_id = moment.get("user_id")
-        user_dic = crud.get_user_by_user_id(user_id) or {}
-        log_info(f"user_dic = {user_dic}")
-        user = {
-            "username": user_dic.username,
-            "photo": user_dic.photo
-        }
-        moment["user"] = user
-        #查找comment的评论
-        comments = await mongo.comment_db.find_many({"moment_id": moment_id, "is_delete": {"$ne": -1}})
-
-        # 处理ObjecID
-        if comments:
-           comments = [{**{k: str(v) if k == '_id' else v for k, v in comment.items()}, 'comment_id': str(comment['_id'])} for comment in comments]
-
-
-        for comment in comments:
-            # 用户名称从数据库取
-            user = crud.get_user_by_user_id(comment.get("comment_user_id"))
-            comment["comment_user_name"] = user.username
-            comment["comment_user_photo"] = user.photo
-            # 获取reply
-            comment_id = str(comment.get("_id"))
-            reply = await mongo.reply_db.find_many({"comment_id": comment_id, "is_delete": 0}) or []
-            # reply = comment.get("reply") or []
-            for r in reply:
-                r["_id"] = str(r.get("_id"))
-                reply_user_id = r.get("reply_user_id")
-                reply_user = crud.get_user_by_user_id(reply_user_id) or {}
-                r["reply_user_photo"] = reply_user.photo
-            comment["reply"] = reply
-
+        # 作者信息使用快照，用户修改资料后由后台任务同步
+        moment["user"] = snapshot_of(moment)
+        # 一页评论和回复：评论、回复、点赞状态各一次批量查询
+        comments, next_cursor = await load_comments(moment_id, after=comment_cursor,
+                                                    limit=comment_limit, reply_limit=reply_limit,
+                                                    viewer_id=viewer_id)
+        moment["is_liked"] = bool(await get_liked(viewer_id, {"moment": [moment_id]}))
         moment["comments"] = comments
+        moment["comment_cursor"] = next_cursor
         moment["id"] = str(moment.pop("_id"))
 
-        return moment
+        return etag_response(request, set_cached(cache_name, DetailMomentResponse(**moment), versions))
 
     except HTTPException as he:
         raise he  # 传递已处理的HTTP异常
@@ -514,31 +652,23 @@ async def get_moment_by_id(
 @router.get("/liked_moments", response_model=List[DetailMomentResponse])
 async def get_liked_moments(
         user_id: int = Query(...),  # 新增user_id参数，必需项
-        last_id: Optional[str] = Query(None),
+        cursor: Optional[str] = Query(None, description="上一页最后一条的 cursor"),
         limit: int = Query(10, gt=0, le=50),
         session: Session = Depends(get_session)
 ):
     try:
-        # 构建点赞查询条件
+        # 构建点赞查询条件，游标为点赞记录的 (create_dt, _id)
         like_query = {
             "user_id": user_id,
-            "type": "moment"  # 限定类型为moment
+            "type": "moment",  # 限定类型为moment
+            "is_like": 1,  # 取消点赞的记录保留但不再列出
+            **cursor_query("create_dt", cursor)
         }
-        # 如果有last_id，添加时间限制条件
-        if last_id:
-            # 确保last_id是有效的ObjectId
-            if not ObjectId.is_valid(last_id):
-                raise HTTPException(status_code=400, detail="无效的last_id格式")
-
-            last_like = await mongo.like_db.find_one({"_id": ObjectId(last_id)})
-            if not last_like:
-                raise HTTPException(status_code=400, detail="无效的last_id")
-            like_query["create_dt"] = {"$lt": last_like["create_dt"]}
         # 从点赞表中查询用户点赞的动态ID
         # 按创建时间倒序排列，获取最新的点赞记录
         like_records = await mongo.like_db.find_many(
             query=like_query,
-            sort=[("create_dt", -1)],
+            sort=[("create_dt", -1), ("_id", -1)],
             limit=limit,
             projection={"moment_id": 1, "create_dt": 1}  # 只需要target_id和created_at字段
         )
@@ -549,31 +679,21 @@ async def get_liked_moments(
 
         # 从文章表中查询这些动态的详细信息
         # 使用$in操作符查询多个ID
-        # 按点赞时间倒序排列，保持与点赞记录一致的顺序
-        moments = await mongo.article_db.find_many(
-            query={"_id": {"$in": moment_ids},"is_delete": 0},
-            limit=limit,
-            sort=[("created_at", -1)]
+        docs = await mongo.article_db.find_many(
+            query={"_id": {"$in": moment_ids},"is_delete": 0}
         )
-        crud = UserCRUD(session)
+        # 按点赞时间倒序排列，保持与点赞记录一致的顺序，游标取自点赞记录
+        doc_map = {doc["_id"]: doc for doc in docs}
+        moments = []
+        for record in like_records:
+            moment = doc_map.get(ObjectId(record["moment_id"]))
+            if moment:
+                moments.append({**moment, "cursor": encode_cursor(record["create_dt"], record["_id"]),
+                                "is_liked": True})
         moments_list = []
-        # 处理每个动态，添加用户信息
+        # 处理每个动态，作者信息直接使用快照
         for moment in moments:
-            user_id = moment.get("user_id")
-            user_dic = crud.get_user_by_user_id(user_id) or {}
-            if user_dic:
-                user_dict = {
-                    "username": user_dic.username,
-                    "photo": user_dic.photo,
-                    "user_id": moment["user_id"]
-                }
-                moment["user"] = user_dict
-            else:
-                moment["user"] = {
-                    "username": "未知用户",
-                    "photo": "",
-                    "user_id": moment["user_id"]
-                }
+            moment["user"] = snapshot_of(moment)
             moment["id"] = str(moment.pop("_id"))
             moments_list.append(moment)
 
@@ -583,6 +703,8 @@ async def get_liked_moments(
             #     moment["liked_at"] = like_record["created_at"]  # 添加点赞时间信息
 
         return moments_list
+    except HTTPException as he:
+        raise he
     except TypeError as e:
         raise HTTPException(status_code=400, detail=f"参数类型错误: {str(e)}")
     except Exception as e:
@@ -592,48 +714,35 @@ async def get_liked_moments(
 @router.get("/user_moments", response_model=List[DetailMomentResponse])
 async def get_user_moments(
         user_id: int = Query(...),  # 新增user_id参数，必需项
-        last_id: Optional[str] = Query(None),
+        viewer_id: Optional[int] = Depends(get_optional_user_id),
+        cursor: Optional[str] = Query(None, description="上一页最后一条的 cursor"),
         limit: int = Query(10, gt=0, le=50),
         session: Session = Depends(get_session)
 ):
     try:
-        query = {"user_id":user_id, "is_delete": 0}
-        if last_id:
-            # 确保 last_id 是有效的 ObjectId
-            if not ObjectId.is_valid(last_id):
-                raise HTTPException(status_code=400, detail="无效的last_id格式")
-
-            last_moment = await mongo.article_db.find_one({"_id": ObjectId(last_id)})
-            if not last_moment:
-                raise HTTPException(status_code=400, detail="无效的last_id")
-            query["created_at"] = {"$lt": last_moment["created_at"]}
-        sort = [("created_at", -1)]
+        # 游标编码了上一页最后一条的 (created_at, _id)，下一页一次查询
+        query = {"user_id":user_id, "is_delete": 0, **cursor_query("created_at", cursor)}
+        sort = [("created_at", -1), ("_id", -1)]
 
         moments = await mongo.article_db.find_many(
             query=query,
             sort=sort,
             limit=limit
         )
+        liked = await get_liked(viewer_id, {"moment": [str(moment["_id"]) for moment in moments]})
 
-        crud = UserCRUD(session)
         moments_list = []
         for moment in moments:
-            user = crud.get_user_by_user_id(moment["user_id"])
-            if user:
-                user_dict = {
-                    "username": user.username,
-                    "photo": user.photo
-                }
-                moment["user"] = user_dict
-            else:
-                moment["user"] = {
-                    "username": "未知用户",
-                    "photo": ""
-                }
+            # 作者信息直接使用快照，不再逐条查询MySQL
+            moment["user"] = snapshot_of(moment)
+            moment["cursor"] = encode_cursor(moment["created_at"], moment["_id"])
             moment["id"] = str(moment.pop("_id"))
+            moment["is_liked"] = ("moment", moment["id"]) in liked
 
             moments_list.append(moment)
         return moments_list
+    except HTTPException as he:
+        raise he
     except TypeError as e:
         raise HTTPException(status_code=400, detail=f"参数类型错误: {str(e)}")
     except Exception as e:
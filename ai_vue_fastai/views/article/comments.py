@@ -1,6 +1,6 @@
 # encoding: UTF-8
 from typing import List, Optional,Dict, Any
-from fastapi import HTTPException, APIRouter, Depends, Query, UploadFile, File, Form,Request
+from fastapi import HTTPException, APIRouter, BackgroundTasks, Depends, Query, UploadFile, File, Form,Request
 from pydantic import BaseModel
 from bson import ObjectId
 from init import app
@@ -8,11 +8,16 @@ from utils.mongodb import MotorDB
 from utils.mysql_crud import UserCRUD
 from sqlmodel import Session
 from utils.database import get_session
+from utils.get_current_user import get_optional_user_id
 import os
 from config.settings import settings
 import uuid
 from datetime import datetime
 from fastapi.responses import JSONResponse
+from utils.moment_comments import load_replies
+from utils.like_service import toggle_like, owning_moment_versions
+from utils.feed_cache import version_key, bump_versions
+from utils.search import remove_document
 
 # 初始化MongoDB连接
 mongo = MotorDB(database="article_db")
@@ -25,6 +30,8 @@ async def startup_db_client():
 
 class DetailReplyResponse(BaseModel):
     replies: List[Dict] = []
+    # 下一页游标，为空表示没有更多回复
+    reply_cursor: Optional[str] = None
 
 class ReplyRequest(BaseModel):
     reply_user_id: int
@@ -56,45 +63,29 @@ class LikeReplyRequest(BaseModel):
     reply_id: str
     is_like: bool
 
+@router.get("/moment/replies", response_model=DetailReplyResponse)
+async def get_replies(
+        comment_id: str = Query(..., description="评论ID"),
+        reply_cursor: Optional[str] = Query(None, description="回复游标，上一页返回的 reply_cursor"),
+        limit: int = Query(20, gt=0, le=100),
+        viewer_id: Optional[int] = Depends(get_optional_user_id),
+        session: Session = Depends(get_session)
+):
+    """评论下的回复分页"""
+    try:
+        replies, next_cursor = await load_replies(comment_id, after=reply_cursor, limit=limit,
+                                                  viewer_id=viewer_id)
+        return {"replies": replies, "reply_cursor": next_cursor}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
+
 @router.post("/like_comment",response_model=LikeResponseModel)
 async def like_moment(request: LikeCommentRequest):
         try:
-            # 使用原子操作确保数据一致性
-            update_operation = {
-                "$set": {"updated_at": datetime.now().isoformat()},
-                "$inc": {"stats.likes": 1 if request.is_like else -1}
-            }
-
-            # 插入到Like表中
-            like_dict = {
-                "comment_id": request.comment_id,
-                "user_id": request.user_id,
-                "type": "comment",
-                "create_dt": datetime.now().isoformat(),
-
-            }
-
-            if request.is_like:
-                update_operation["$addToSet"] = {"like_users": request.user_id}
-                like_dict["is_like"] = 1
-                await mongo.like_db.insert(like_dict)
-            else:
-                update_operation["$pull"] = {"like_users": request.user_id}
-                # 取消点赞
-                result = await mongo.like_db.find_one(
-                    {"comment_id": request.comment_id, "user_id": request.user_id, "type": "comment"})
-                await mongo.like_db.update_one({"_id": result.get("_id")}, {"$set": {"is_like": 0}})
-
-            result = await mongo.comment_db.update_one(
-                {"_id": ObjectId(request.comment_id)},
-                update_operation
-            )
-
-            # 返回完整状态
-            updated = await mongo.comment_db.find_one(
-                {"_id": ObjectId(request.comment_id)}
-            )
-            likes_count = updated.get("stats", {}).get("likes", 0) if updated else 0
+            # 幂等：重复点赞/重复取消不会改变点赞数
+            likes_count = await toggle_like("comment", request.comment_id, request.user_id, request.is_like)
             return {
                 "msg": "success",
                 "status_code": 200,
@@ -102,6 +93,10 @@ async def like_moment(request: LikeCommentRequest):
                 "is_liked": request.is_like,
                 "likes_count":likes_count
             }
+        except HTTPException as he:
+            return JSONResponse(
+                status_code=he.status_code,
+                content={"success": False, "msg": he.detail})
         except Exception as e:
             return JSONResponse(
                 status_code=500,
@@ -121,7 +116,7 @@ async def post_moment(request: ReplyRequest, session: Session = Depends(get_sess
         reply_comment = request.reply_comment
         reply_user_name = request.reply_user_name
         comment_id = request.comment_id
-        created_dt = datetime.now().isoformat()
+        created_dt = datetime.now()
         # 验证用户
         crud = UserCRUD(session)
         user = crud.get_user_by_user_id(reply_user_id)
@@ -135,7 +130,8 @@ async def post_moment(request: ReplyRequest, session: Session = Depends(get_sess
         reply_data = {
                 "reply_comment": reply_comment,
                 "reply_user_id": reply_user_id,
-                 "reply_user_name": reply_user_name,
+                 "reply_user_name": user.username,
+                 "reply_user_photo": user.photo or "",
                  "created_dt": created_dt,
                  "is_delete": 0
         }
@@ -154,6 +150,8 @@ async def post_moment(request: ReplyRequest, session: Session = Depends(get_sess
         reply_data["user_id"] = user_id
 
         await mongo.reply_db.insert(reply_data)
+        # 动态详情中带有回复预览，所属动态的详情缓存一并失效
+        bump_versions(version_key("comment", comment_id), version_key("moment", comment_dic.get("moment_id")))
 
         # result = await mongo.comment_db.update_one(
         #     {"_id": ObjectId(comment_id)},
@@ -182,6 +180,7 @@ class DeleteCommentRequest(BaseModel):
 @router.post("/delete/comment", response_model=SuccessResponseModel)
 async def delete_moment(
     request: DeleteCommentRequest,
+    background_tasks: BackgroundTasks,
     session: Session = Depends(get_session),
 ):
     try:
@@ -191,13 +190,16 @@ async def delete_moment(
         # 更新动态文档，将 is_delete 字段设置为 -1
         result = await mongo.comment_db.update_one(
             {"_id": moment_object_id},
-            {"$set": {"is_delete": -1, "updated_at": datetime.now().isoformat()}}
+            {"$set": {"is_delete": -1, "updated_at": datetime.now()}}
         )
         if result == 0:
             raise HTTPException(
                 status_code=404,
                 detail="未找到该动态"
             )
+        bump_versions(version_key("comment", request.comment_id),
+                      *await owning_moment_versions([("comment", request.comment_id)]))
+        background_tasks.add_task(remove_document, "comment", request.comment_id)
 
         result = {
             "msg": "success",
@@ -232,13 +234,15 @@ async def delete_reply(
         # 更新动态文档，将 is_delete 字段设置为 -1
         result = await mongo.reply_db.update_one(
             {"_id": obj_reply_id},
-            {"$set": {"is_delete": -1, "updated_at": datetime.now().isoformat()}}
+            {"$set": {"is_delete": -1, "updated_at": datetime.now()}}
         )
         if result == 0:
             raise HTTPException(
                 status_code=404,
                 detail="未找到该动态"
             )
+        bump_versions(version_key("reply", request.reply_id),
+                      *await owning_moment_versions([("reply", request.reply_id)]))
 
         result = {
             "msg": "success",
@@ -261,42 +265,8 @@ async def delete_reply(
 @router.post("/like_reply",response_model=LikeResponseModel)
 async def like_reply(request: LikeReplyRequest):
         try:
-            # 使用原子操作确保数据一致性
-            update_operation = {
-                "$set": {"updated_at": datetime.now().isoformat()},
-                "$inc": {"stats.likes": 1 if request.is_like else -1}
-            }
-
-            # 插入到Like表中
-            like_dict = {
-                "reply_id": request.reply_id,
-                "user_id": request.user_id,
-                "type": "reply",
-                "create_dt": datetime.now().isoformat(),
-
-            }
-
-            if request.is_like:
-                update_operation["$addToSet"] = {"like_users": request.user_id}
-                like_dict["is_like"] = 1
-                await mongo.like_db.insert(like_dict)
-            else:
-                update_operation["$pull"] = {"like_users": request.user_id}
-                # 取消点赞
-                result = await mongo.like_db.find_one(
-                    {"reply_id": request.reply_id, "user_id": request.user_id, "type": "reply"})
-                await mongo.like_db.update_one({"_id": result.get("_id")}, {"$set": {"is_like": 0}})
-
-            result = await mongo.reply_db.update_one(
-                {"_id": ObjectId(request.reply_id)},
-                update_operation
-            )
-
-            # 返回完整状态
-            updated = await mongo.reply_db.find_one(
-                {"_id": ObjectId(request.reply_id)}
-            )
-            likes_count = updated.get("stats", {}).get("likes", 0) if updated else 0
+            # 幂等：重复点赞/重复取消不会改变点赞数
+            likes_count = await toggle_like("reply", request.reply_id, request.user_id, request.is_like)
             return {
                 "msg": "success",
                 "status_code": 200,
@@ -304,6 +274,10 @@ async def like_reply(request: LikeReplyRequest):
                 "is_liked": request.is_like,
                 "likes_count":likes_count
             }
+        except HTTPException as he:
+            return JSONResponse(
+                status_code=he.status_code,
+                content={"success": False, "msg": he.detail})
         except Exception as e:
             return JSONResponse(
                 status_code=500,
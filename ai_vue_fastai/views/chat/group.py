@@ -9,11 +9,27 @@ from init import app
 from utils.log import log_info,log_error
 from datetime import datetime
 import shortuuid
+from bson import ObjectId
+from pymongo import UpdateOne
+from config.settings import settings
 from utils.mysql_crud import UserCRUD
 from sqlmodel import Session
 from utils.database import get_session
 from utils.redis import get_code,set_code,get_websocket_connection
 from utils.get_current_user import get_current_user_id
+from utils.recent_chat import (is_fanout_on_read, RecentChatBatch, get_group_summaries,
+                               update_group_summaries, add_group_summaries, remove_group_summaries,
+                               seed_fanout_cursors)
+from utils.group_cache import group_cache
+from utils.group_member import (add_members, remove_members, get_member_ids,
+                                page_member_ids, init_members)
+from utils.user_profile import get_user_profiles
+from utils.group_avatar import get_avatar_members, ensure_group_avatar, refresh_group_avatar
+from utils.system_message import system_messages
+from utils.group_mute import get_mute_flags, set_mute
+from utils.group_events import (publish_group_event, MEMBERS_ADDED, MEMBERS_REMOVED,
+                                GROUP_RENAMED, GROUP_DISMISSED)
+from utils.sequence import conversation_key, next_seq
 
 # 初始化MongoDB连接
 mongo = MotorDB(database="chat_db")
@@ -47,14 +63,16 @@ class SuccessModel(BaseModel):
     data: dict = None
 
 class GroupChatMode(BaseModel):
-    creator_id: int
+    creator_id: Optional[int] = None
     group_id: str
-    members: List[int]
-    created_at: datetime
+    members: Optional[List[int]] = None
+    created_at: Optional[datetime] = None
     name: str
     members_count: int
     unread_count: int = 0
     photo: Optional[str] =None
+    last_message: Optional[dict] = None
+    last_message_time: Optional[datetime] = None
 
 class GroupInfoResponse(BaseModel):
     creator_id: int
@@ -63,12 +81,82 @@ class GroupInfoResponse(BaseModel):
     create_time: datetime
     group_name: str
     avatar_members: List[str]
+    group_avatar: Optional[str] = None
     members_count: int
     unread_count: int = 0
     photo: Optional[str] =None
 
+# 建群写库失败时的重试次数，每一步都是 upsert，重试不会产生重复数据
+GROUP_CREATE_RETRIES = 3
+
+
+def _build_group(name: str, creator_id: int, members: List[int]) -> Dict:
+    """生成群组文档，成员单独保存在 group_member 中"""
+    # 确保创建者在成员列表中，并放在第一位
+    members = list(dict.fromkeys([creator_id] + list(members)))
+    return {
+        "_id": ObjectId(),
+        "group_id": f"group_{shortuuid.ShortUUID().random(length=8)}",
+        "name": name,
+        "creator_id": creator_id,
+        "members": members,
+        "members_count": len(members),
+        "created_at": datetime.utcnow(),
+        "photo": None,
+        "delete": 0, # -1 表示群已经删除
+        # 大群改为读时合并最近聊天
+        "fanout_on_read": is_fanout_on_read(len(members)),
+        "description": None
+    }
+
+
+def _validate_members(groups: List[Dict], session: Session):
+    """所有群的成员一次 IN 查询校验是否存在"""
+    user_ids = {user_id for group in groups for user_id in group["members"]}
+    found = {user.id for user in UserCRUD(session).get_users_by_ids(list(user_ids))}
+    missing = sorted(user_ids - found)
+    if missing:
+        raise HTTPException(status_code=400, detail=f"用户不存在: {missing}")
+
+
+async def _save_groups(groups: List[Dict]):
+    """
+    批量写入群组：群文档、群成员、成员的最近聊天各一次 bulk_write
+    全部使用 upsert，中途失败时整体重试是幂等的
+    """
+    for attempt in range(1, GROUP_CREATE_RETRIES + 1):
+        try:
+            await mongo.group_db.bulk_write([
+                UpdateOne({"group_id": group["group_id"]},
+                          {"$setOnInsert": {k: v for k, v in group.items() if k != "members"}},
+                          upsert=True)
+                for group in groups
+            ])
+            await init_members((group["group_id"], group["creator_id"], group["members"]) for group in groups)
+
+            # 群组添加到成员的最近聊天
+            batch = RecentChatBatch()
+            for group in groups:
+                for user_id in group["members"]:
+                    batch.touch(user_id, group["group_id"], last_message_time=group["created_at"], fields={
+                        "group_owner_id": group["creator_id"],
+                        "insert_id": str(group["_id"]),
+                        "group_name": group["name"],
+                        "members_count": group["members_count"],
+                        "target_photo": None,
+                        "fanout_on_read": group["fanout_on_read"],
+                        "is_group": True
+                    })
+            await batch.flush()
+            return
+        except HTTPException as e:
+            if attempt == GROUP_CREATE_RETRIES:
+                raise
+            log_error(f"建群写入失败，第 {attempt} 次重试: {e.detail}")
+
+
 @router.post("/group/create", response_model=SuccessModel)
-async def create_group(group_data: GroupCreateRequest):
+async def create_group(group_data: GroupCreateRequest, session: Session = Depends(get_session)):
     """
     创建群组
     参数:
@@ -76,140 +164,119 @@ async def create_group(group_data: GroupCreateRequest):
     - members: 成员ID列表 (包含创建者)
     """
     try:
-        # 生成唯一的群组ID
-        group_id = f"group_{shortuuid.ShortUUID().random(length=8)}"
-
-        # 确保创建者在成员列表中
-        if group_data.user_id not in group_data.members:
-            group_data.members.append(group_data.user_id)
-
-        # 创建群组文档
-        group = {
-            "group_id": group_id,
-            "name": group_data.name,
-            "creator_id": group_data.user_id,
-            "members": group_data.members,
-            "members_count": len(group_data.members),
-            "created_at": datetime.utcnow(),
-            "photo": None,
-            "delete": 0, # -1 表示群已经删除
-            "description": None
-        }
+        group = _build_group(group_data.name, group_data.user_id, group_data.members)
+        _validate_members([group], session)
 
         # 保存到数据库
-        inserted_id= await mongo.group_db.insert(group)
-
-        # 群组添加大最近聊天
-        for user_id in group_data.members:
-            recent_chat = {
-                "group_owner_id": group_data.user_id,
-                "target_id": group_id,
-                "insert_id": inserted_id,
-                "group_members": group_data.members,
-                "group_name": group_data.name,
-                "user_id": user_id,
-                "members_count": len(group_data.members),
-                "target_photo": None,
-                "last_message_time": datetime.utcnow(),
-                "unread_count": 0,
-                "is_group": True
-            }
-            await mongo.recent_chats_db.insert(recent_chat)
+        await _save_groups([group])
+        await refresh_group_avatar(group["group_id"], session)
         return SuccessModel(
             msg="群组创建成功",
             data={
-                "group_id": group_id,
-                "target_id": group_id,
-                "name": group_data.name,
-                "members_count": len(group_data.members),
-                "members": group_data.members
+                "group_id": group["group_id"],
+                "target_id": group["group_id"],
+                "name": group["name"],
+                "members_count": group["members_count"],
+                "members": group["members"]
             }
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"创建群组失败: {str(e)}"
         )
 
+
+class BulkGroupCreateRequest(BaseModel):
+    groups: List[GroupCreateRequest]
+
+
+@router.post("/group/bulk-create", response_model=SuccessModel)
+async def bulk_create_groups(
+        request: BulkGroupCreateRequest,
+        current_user_id: int = Depends(get_current_user_id),
+        session: Session = Depends(get_session),
+):
+    """
+    批量创建群组（数据迁移、压测使用，GROUP_BULK_CREATE_ENABLED 开启时可用）
+    所有群的成员一次校验，群文档、成员、最近聊天各一次批量写入
+    """
+    try:
+        # 可以指定任意用户为群主，线上环境关闭
+        if not settings.GROUP_BULK_CREATE_ENABLED:
+            raise HTTPException(status_code=403, detail="批量建群接口未开放")
+        if not request.groups:
+            raise HTTPException(status_code=400, detail="群组列表不能为空")
+        if len(request.groups) > settings.GROUP_BULK_CREATE_LIMIT:
+            raise HTTPException(status_code=400,
+                                detail=f"一次最多创建 {settings.GROUP_BULK_CREATE_LIMIT} 个群组")
+
+        groups = [_build_group(item.name, item.user_id, item.members) for item in request.groups]
+        _validate_members(groups, session)
+        await _save_groups(groups)
+
+        log_info(f"批量创建群组 - 操作者: {current_user_id}, 数量: {len(groups)}")
+        return SuccessModel(
+            msg=f"成功创建 {len(groups)} 个群组",
+            data={"group_ids": [group["group_id"] for group in groups]}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        log_error(f"批量创建群组失败: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"批量创建群组失败: {str(e)}"
+        )
+
 @router.get('/group/get-joined-groups/{user_id}', response_model=List[GroupChatMode])
 async def get_joined_groups(
         user_id: int,
         limit: int = Query(10, gt=0, le=50),
+        before_time: Optional[datetime] = Query(None, description="上一页最后一个群的 last_message_time"),
+        before_id: Optional[str] = Query(None, description="上一页最后一个群的 group_id"),
 ):
-    """获取用户加入的群聊列表（简化版）"""
+    """获取用户加入的群聊列表：按最近活跃分页，每个群一条固定大小的摘要，不返回成员列表"""
     try:
-        # 1. 从group_members表查询用户加入的所有群ID
-        member_query = {"members": {"$in": [user_id]}, "delete": 0}
-        group_member_docs = await mongo.group_db.find_many(member_query)
-        # print(f"group_members: {group_member_docs}")
-        log_info(f"group_members: {group_member_docs}")
-        if not group_member_docs:
-            return []  # 没有加入任何群聊
-
-        # 3. 补充target_id字段（与群ID一致，方便前端统一处理）
-        for doc in group_member_docs:
-            # doc["target_id"] = doc["_id"]  # 前端可通过target_id识别聊天对象
-            doc["_id"] = str(doc["_id"])  # ObjectId转字符串
-
-        return group_member_docs
+        summaries = await get_group_summaries(user_id, limit, before_time=before_time, before_id=before_id)
+        log_info(f"用户 {user_id} 的群聊列表返回 {len(summaries)} 个")
+        return [
+            {
+                "group_id": chat["target_id"],
+                "name": chat.get("group_name") or "",
+                "creator_id": chat.get("group_owner_id"),
+                "members_count": chat.get("members_count") or 0,
+                "photo": chat.get("target_photo"),
+                "unread_count": chat.get("unread_count", 0),
+                "last_message": chat.get("last_message"),
+                "last_message_time": chat.get("last_message_time"),
+            }
+            for chat in summaries
+        ]
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取群聊列表失败: {str(e)}")
 
 @router.get("/group/get-group-avatar/{group_id}",response_model=List[str])
 async def get_group_avatar(group_id:str,session: Session = Depends(get_session)):
+    """群主在前的前9个成员头像（组合头像见群信息中的 group_avatar）"""
     try:
-        # 1. 获取群信息，包括成员列表和创建者ID
-        group = await mongo.group_db.find_one({"group_id": group_id})
+        # 1. 获取群信息
+        group = await group_cache.get(group_id)
         if not group:
             raise HTTPException(
                 status_code=404,
                 detail="群组不存在"
             )
 
-        creator_id = group.get("creator_id")
-        members = group.get("members", [])
-
-        # 2. 确保创建者在第一位
-        unique_members = list(dict.fromkeys(members))  # 去重
-        if creator_id in unique_members:
-            # 将创建者移到列表首位
-            unique_members.remove(creator_id)
-            unique_members.insert(0, creator_id)
-
-        # 3. 限制最多返回9个成员
-        selected_members = unique_members[:9]
-        log_info(f"select_members: {selected_members}")
-        avatar = []
-
-        for user_id in selected_members:
-            user_dic = None
-            photo = None
-            crud = UserCRUD(session)
-            key = f"{user_id}_info"
-
-            # 检查缓存
-            cached_data = get_code(key)
-            if cached_data:
-                try:
-                    user_dic = json.loads(cached_data)
-                    log_info(f"user_dic from cache: {user_dic}")
-                    photo = user_dic.get("photo")
-                except json.JSONDecodeError:
-                    log_error(f"Failed to parse cached data for user {user_id}")
-
-            # 如果缓存中没有或解析失败，从数据库获取
-            if not photo:
-                user = crud.get_user_by_user_id(user_id)
-                log_info(f"user from DB: {user}")
-                if user and user.photo:
-                    photo = user.photo
-                else:
-                    photo = ''  # 或者设置默认头像路径
-            avatar.append(photo)
-        log_info(f"avatar : {avatar}")
+        # 2. 批量获取前9个成员的头像
+        _, avatar = await get_avatar_members(group, session)
         return avatar
 
+    except HTTPException:
+        raise
     except Exception as e:
         log_info(f"获取群头像失败: {str(e)}")
         raise HTTPException(
@@ -221,19 +288,23 @@ async def get_group_avatar(group_id:str,session: Session = Depends(get_session))
 async def get_group_info(group_id: str,session: Session = Depends(get_session)):
     try:
         # 从MongoDB获取群信息
-        group = await mongo.group_db.find_one({"group_id": group_id})
+        group = await group_cache.get(group_id)
         if not group:
             raise HTTPException(
                 status_code=404,
                 detail="群组不存在"
             )
-        # 获取成员数量
-        members = group.get("members", [])
-        avatar_members = await get_group_avatar(group_id, session)        # 构建返回的群信息对象
+        # 获取成员列表
+        members = sorted(await get_member_ids(group_id))
+        # 组合头像在成员变更时生成并保存在群信息中，这里直接读取；尚未生成过的旧群补生成一次
+        group_avatar, avatar_members = group.get("group_avatar"), group.get("avatar_members")
+        if not group_avatar or avatar_members is None:
+            group_avatar, avatar_members = await ensure_group_avatar(group, session)
+        # 构建返回的群信息对象
         group_info = {
             "group_id": group.get("group_id"),
             "group_name": group.get("name"),
-            "group_avatar": group.get("group_avatar"),
+            "group_avatar": group_avatar,
             "creator_id": group.get("creator_id"),
             "avatar_members": avatar_members,
             "group_members": members,
@@ -253,7 +324,7 @@ async def get_group_info(group_id: str,session: Session = Depends(get_session)):
 # 首先创建成员信息模型
 class MemberInfo(BaseModel):
     id: int
-    username: str
+    username: Optional[str] = None
     photo: Optional[str] = None
 
 class GroupMembersResponse(BaseModel):
@@ -262,72 +333,68 @@ class GroupMembersResponse(BaseModel):
     group_name: str
     creator_id: int
     members_count: int
+    next_cursor: Optional[int] = None  # 下一页的 after 参数，为空表示没有更多成员
+    has_more: bool = False
 
+# 成员列表可选返回的字段，id 总是返回
+MEMBER_FIELDS = ("username", "photo")
 
-@router.get("/group/{group_id}/members", response_model=GroupMembersResponse)
-async def get_group_members(group_id: str, session: Session = Depends(get_session)):
+
+@router.get("/group/{group_id}/members", response_model=GroupMembersResponse, response_model_exclude_unset=True)
+async def get_group_members(
+        group_id: str,
+        after: Optional[int] = Query(None, description="上一页返回的 next_cursor"),
+        limit: int = Query(100, gt=0, le=500),
+        fields: Optional[str] = Query(None, description="返回的成员字段，逗号分隔，如 username,photo"),
+        session: Session = Depends(get_session),
+):
+    """
+    分页获取群成员
+    第一页群主排在最前，其余成员按用户ID排序；成员资料批量获取（一次Redis MGET + 一次MySQL IN查询）
+    """
     try:
-        # 从MongoDB获取群信息
-        group = await mongo.group_db.find_one({"group_id": group_id})
+        # 从缓存获取群信息
+        group = await group_cache.get(group_id)
         if not group:
             raise HTTPException(
                 status_code=404,
                 detail="群组不存在"
             )
 
-        # 获取成员ID列表
-        member_ids = group.get("members", [])
+        selected_fields = MEMBER_FIELDS
+        if fields:
+            selected_fields = tuple(field for field in MEMBER_FIELDS if field in fields.split(","))
 
-        # 获取成员详细信息（使用缓存）
+        # 群主单独放在第一页最前面，分页范围中排除群主
+        creator_id = group.get("creator_id")
+        member_ids = await page_member_ids(group_id, after=after, limit=limit + 1, exclude=creator_id)
+        has_more = len(member_ids) > limit
+        member_ids = member_ids[:limit]
+        next_cursor = member_ids[-1] if has_more else None
+        if after is None and creator_id is not None:
+            member_ids.insert(0, creator_id)
+
+        # 批量获取成员资料
+        profiles = get_user_profiles(member_ids, session) if selected_fields else {}
         members_info = []
-        crud = UserCRUD(session)
-
         for user_id in member_ids:
-            user_info = None
-            photo = None
-
-            # 检查缓存
-            key = f"{user_id}_info"
-            cached_data = get_code(key)
-            if cached_data:
-                try:
-                    user_info = json.loads(cached_data)
-                    photo = user_info.get("photo")
-                except json.JSONDecodeError:
-                    log_error(f"Failed to parse cached data for user {user_id}")
-
-            # 如果缓存中没有，从数据库获取
-            if not user_info:
-                user = crud.get_user_by_user_id(user_id)
-                if user:
-                    user_info = {
-                        "id": user.id,
-                        "username": user.username,
-                        "photo": user.photo
-                    }
-                    # 缓存用户信息
-                    set_code(key, json.dumps(user_info), expire=3600)  # 缓存1小时
-                else:
-                    user_info = {
-                        "id": user_id,
-                        "username": f"用户{user_id}",
-                        "photo": None
-                    }
-
-            members_info.append(user_info)
-
-        # 构建返回的响应对象
-        response_data = {
-            "group_members": members_info,
-            "group_id": group.get("group_id"),
-            "group_name": group.get("name"),
-            "creator_id": group.get("creator_id"),
-            "members_count": group.get("members_count", len(member_ids))
-        }
-
-        log_info(f"返回群成员数据: {response_data}")
-        return response_data
+            profile = profiles.get(user_id) or {"username": f"用户{user_id}", "photo": None}
+            member = MemberInfo(id=user_id, **{field: profile.get(field) for field in selected_fields})
+            members_info.append(member)
+
+        log_info(f"返回群成员 - 群ID: {group_id}, 本页 {len(members_info)} 人, 还有更多: {has_more}")
+        return GroupMembersResponse(
+            group_members=members_info,
+            group_id=group.get("group_id"),
+            group_name=group.get("name"),
+            creator_id=creator_id,
+            members_count=group.get("members_count", 0),
+            next_cursor=next_cursor,
+            has_more=has_more,
+        )
 
+    except HTTPException:
+        raise
     except Exception as e:
         log_error(f"获取群成员失败: {str(e)}")
         raise HTTPException(
@@ -350,6 +417,31 @@ class MuteRequest(BaseModel):
     muted: bool
     user_id: int
 
+@router.get('/group/get-mute-status/{user_id}', response_model=Dict[str, bool])
+async def get_mute_statuses(
+        user_id: int,
+        group_ids: Optional[str] = Query(None, description="群ID，逗号分隔；不传时返回用户加入的所有群"),
+        current_user_id: int = Depends(get_current_user_id),
+):
+    """
+    批量获取当前用户在多个群的免打扰状态，一次查询，返回 {群ID: 是否免打扰}
+    用户取自token，路径中的 user_id 为兼容旧客户端保留，必须与当前用户一致
+    """
+    try:
+        if user_id != current_user_id:
+            raise HTTPException(status_code=403, detail="只能查询自己的免打扰状态")
+        ids = [group_id for group_id in group_ids.split(",") if group_id] if group_ids else None
+        return await get_mute_flags(current_user_id, ids)
+    except HTTPException:
+        raise
+    except Exception as e:
+        log_error(f"批量获取免打扰状态失败: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"获取免打扰状态失败: {str(e)}"
+        )
+
+
 @router.get("/group/{group_id}/mute-status", response_model=MuteStatusResponse)
 async def get_group_mute_status(
         group_id: str,
@@ -363,7 +455,7 @@ async def get_group_mute_status(
         log_info(f"获取免打扰状态 - 用户ID: {user_id}, 群ID: {group_id}")
 
         # 验证群组是否存在
-        group = await mongo.group_db.find_one({"group_id": group_id})
+        group = await group_cache.get(group_id)
         if not group:
             raise HTTPException(
                 status_code=404,
@@ -371,38 +463,14 @@ async def get_group_mute_status(
             )
 
         # 验证用户是否是群成员
-        if user_id not in group.get("members", []):
+        if not await group_cache.is_member(group_id, user_id):
             raise HTTPException(
                 status_code=403,
                 detail="用户不是群成员"
             )
 
-        # 查询免打扰状态
-        mute_status = await mongo.group_mute_db.find_one({
-            "user_id": user_id,
-            "group_id": group_id
-        })
-
-        # 如果没有记录，默认为打开状态 (muted=0)
-        if not mute_status:
-            log_info(f"为用户 {user_id} 在群 {group_id} 创建默认免打扰记录")
-
-            # 创建默认记录
-            default_mute_data = {
-                "user_id": user_id,
-                "group_id": group_id,
-                "muted": False,  # 默认为打开状态
-                "create_dt": datetime.utcnow()
-            }
-
-            # 插入数据库
-            await mongo.group_mute_db.insert_one(default_mute_data)
-
-            # 设置默认值
-            muted_value = False
-        else:
-            # 如果有记录，使用数据库中的值
-            muted_value = mute_status.get("muted", False)
+        # 查询免打扰状态，没有记录时默认为打开状态，不再写入默认记录
+        muted_value = (await get_mute_flags(user_id, [group_id]))[group_id]
 
         log_info(f"用户 {user_id} 在群 {group_id} 的免打扰状态: {muted_value}")
 
@@ -434,7 +502,7 @@ async def set_group_mute_status(
         log_info(f"设置免打扰状态 - 用户ID: {user_id}, 群ID: {group_id}, 状态: {muted}")
 
         # 验证群组是否存在
-        group = await mongo.group_db.find_one({"group_id": group_id})
+        group = await group_cache.get(group_id)
         if not group:
             raise HTTPException(
                 status_code=404,
@@ -442,25 +510,14 @@ async def set_group_mute_status(
             )
 
         # 验证用户是否是群成员
-        if user_id not in group.get("members", []):
+        if not await group_cache.is_member(group_id, user_id):
             raise HTTPException(
                 status_code=403,
                 detail="用户不是群成员"
             )
 
-        # 更新或插入免打扰状态
-        mute_data = {
-            "user_id": user_id,
-            "group_id": group_id,
-            "muted": muted,
-            "create_dt": datetime.utcnow()
-        }
-
-        await mongo.group_mute_db.update_one(
-            {"user_id": user_id, "group_id": group_id},
-            {"$set": mute_data},
-            upsert=True
-        )
+        # 更新或插入免打扰状态，同时清除该群的免打扰成员缓存
+        await set_mute(user_id, group_id, muted)
 
         log_info(f"成功设置用户 {user_id} 在群 {group_id} 的免打扰状态为: {muted}")
 
@@ -509,14 +566,14 @@ async def update_group_name(
             )
 
         # 验证群组是否存在
-        group = await mongo.group_db.find_one({"group_id": group_id})
+        group = await group_cache.get(group_id)
         if not group:
             raise HTTPException(
                 status_code=404,
                 detail="群组不存在"
             )
 
-        if current_user_id not in group.get("members"):
+        if not await group_cache.is_member(group_id, current_user_id):
             raise HTTPException(
                 status_code=403,
                 detail="群不存在该成员"
@@ -538,10 +595,14 @@ async def update_group_name(
                 detail="更新群名称失败"
             )
 
+        group_cache.invalidate(group_id)
+        await update_group_summaries(group_id, {"group_name": new_name, "target_username": new_name})
+        await publish_group_event(GROUP_RENAMED, group_id, name=new_name)
+        names = _usernames([current_user_id], session)
+        await notify_group(group_id, current_user_id, names[current_user_id], "rename",
+                           f"{names[current_user_id]} 修改群名为“{new_name}”", group_name=new_name)
         log_info(f"成功更新群名称 - 群ID: {group_id}, 新名称: {new_name}")
 
-        # 如果需要，可以在这里发送群通知，告知所有成员群名称已更改
-
         return UpdateGroupNameResponse(
             success=True,
             message="群名称修改成功",
@@ -584,7 +645,7 @@ async def remove_group_member(
         log_info(f"移除群成员 - 群ID: {group_id}, 要移除的用户ID: {user_id_to_remove}, 操作者: {current_user_id}")
 
         # 验证群组是否存在
-        group = await mongo.group_db.find_one({"group_id": group_id})
+        group = await group_cache.get(group_id)
         if not group:
             raise HTTPException(
                 status_code=404,
@@ -599,8 +660,7 @@ async def remove_group_member(
             )
 
         # 检查要移除的用户是否在群中
-        members = group.get("members", [])
-        if user_id_to_remove not in members:
+        if not await group_cache.is_member(group_id, user_id_to_remove):
             raise HTTPException(
                 status_code=404,
                 detail="该用户不在群组中"
@@ -620,16 +680,21 @@ async def remove_group_member(
                 detail="不能移除群主"
             )
 
-        # 更新群组成员列表
-        updated_members = [member for member in members if member != user_id_to_remove]
-
-        update_result =  await mongo.group_db.update_one(
+        # 更新群组成员
+        removed = await remove_members(group_id, [user_id_to_remove])
+        if not removed:
+            # 并发请求已将其移出
+            raise HTTPException(
+                status_code=404,
+                detail="该用户不在群组中"
+            )
+        update_result = await mongo.group_db.find_one_and_update(
                     {"group_id": group_id},
                     {
-                        "$pull": {"members": user_id_to_remove},  # 从数组中移除指定成员
-                        "$inc": {"members_count": -1},  # 成员数量减1
+                        "$inc": {"members_count": -removed},  # 成员数量减1
                         "$set": {"update_dt": datetime.utcnow()}
-                    }
+                    },
+                    projection={"members_count": 1}
                 )
 
         if not update_result:
@@ -639,11 +704,18 @@ async def remove_group_member(
                 detail="移除成员失败"
             )
 
+        group_cache.invalidate(group_id)
+        await remove_group_summaries(group_id, [user_id_to_remove])
+        await update_group_summaries(group_id, {"members_count": update_result.get("members_count")})
+        # 通知在线连接更新成员集合
+        await publish_group_event(MEMBERS_REMOVED, group_id, user_ids=[user_id_to_remove])
+        await refresh_group_avatar(group_id, session)
+        names = _usernames([current_user_id, user_id_to_remove], session)
+        await notify_group(group_id, current_user_id, names[current_user_id], "remove_member",
+                           f"{names[current_user_id]} 将 {names[user_id_to_remove]} 移出了群聊",
+                           group_name=group.get("name", ""), user_ids=[user_id_to_remove])
         log_info(f"成功移除群成员 - 群ID: {group_id}, 被移除用户ID: {user_id_to_remove}")
 
-        # 发送系统通知（可选）
-        # await send_group_notification(group_id, f"用户 {user_id_to_remove} 已被移出群聊")
-
         return RemoveMemberResponse(
             success=True,
             message="成员移除成功",
@@ -683,7 +755,7 @@ async def exit_group(
         log_info(f"退出群聊 - 群ID: {group_id}, 用户ID: {current_user_id}")
 
         # 验证群组是否存在
-        group = await mongo.group_db.find_one({"group_id": group_id})
+        group = await group_cache.get(group_id)
         if not group:
             raise HTTPException(
                 status_code=404,
@@ -691,8 +763,7 @@ async def exit_group(
             )
 
         # 检查用户是否在群中
-        members = group.get("members", [])
-        if current_user_id not in members:
+        if not await group_cache.is_member(group_id, current_user_id):
             raise HTTPException(
                 status_code=404,
                 detail="您不在该群组中"
@@ -705,14 +776,21 @@ async def exit_group(
                 detail="群主不能直接退出群聊，请先转让群主或解散群"
             )
 
-        # 使用原子操作更新群组成员和计数
-        update_result = await mongo.group_db.update_one(
+        # 更新群组成员和计数
+        removed = await remove_members(group_id, [current_user_id])
+        if not removed:
+            # 并发请求已将其移出
+            raise HTTPException(
+                status_code=404,
+                detail="您不在该群组中"
+            )
+        update_result = await mongo.group_db.find_one_and_update(
             {"group_id": group_id},
             {
-                "$pull": {"members": current_user_id},
-                "$inc": {"members_count": -1},
+                "$inc": {"members_count": -removed},
                 "$set": {"update_dt": datetime.utcnow()}
-            }
+            },
+            projection={"members_count": 1}
         )
 
         if not update_result:
@@ -722,11 +800,18 @@ async def exit_group(
                 detail="退出群聊失败"
             )
 
+        group_cache.invalidate(group_id)
+        await remove_group_summaries(group_id, [current_user_id])
+        await update_group_summaries(group_id, {"members_count": update_result.get("members_count")})
+        # 通知在线连接更新成员集合
+        await publish_group_event(MEMBERS_REMOVED, group_id, user_ids=[current_user_id])
+        await refresh_group_avatar(group_id, session)
+        names = _usernames([current_user_id], session)
+        await notify_group(group_id, current_user_id, names[current_user_id], "exit",
+                           f"{names[current_user_id]} 退出了群聊",
+                           group_name=group.get("name", ""), user_ids=[current_user_id])
         log_info(f"成功退出群聊 - 群ID: {group_id}, 用户ID: {current_user_id}")
 
-        # 发送系统通知（可选）
-        # await send_group_notification(group_id, f"用户 {current_user_id} 已退出群聊")
-
         return ExitGroupResponse(
             success=True,
             message="已成功退出群聊",
@@ -766,7 +851,7 @@ async def dismiss_group(
         log_info(f"解散群聊 - 群ID: {group_id}, 操作者: {current_user_id}")
 
         # 验证群组是否存在
-        group = await mongo.group_db.find_one({"group_id": group_id})
+        group = await group_cache.get(group_id)
         if not group:
             raise HTTPException(
                 status_code=404,
@@ -806,6 +891,13 @@ async def dismiss_group(
                 detail="解散群聊失败"
             )
 
+        group_cache.invalidate(group_id)
+        await update_group_summaries(group_id, {"dismissed": True})
+        await publish_group_event(GROUP_DISMISSED, group_id)
+        names = _usernames([current_user_id], session)
+        await notify_group(group_id, current_user_id, names[current_user_id], "dismiss",
+                           f"{names[current_user_id]} 解散了群聊",
+                           group_name=group.get("name", ""))
         log_info(f"成功解散群聊 - 群ID: {group_id}")
 
         # 可选：发送解散通知给所有成员
@@ -856,8 +948,8 @@ async def add_group_members(
         log_info(f"添加群成员 - 群ID: {group_id}, 操作者: {current_user_id}, 要添加的用户: {user_ids}")
 
         # 验证群组是否存在且未被删除
-        group = await mongo.group_db.find_one({"group_id": group_id, "delete": 0})
-        if not group:
+        group = await group_cache.get(group_id)
+        if not group or group.get("delete") != 0:
             raise HTTPException(
                 status_code=404,
                 detail="群组不存在或已被解散"
@@ -873,38 +965,61 @@ async def add_group_members(
             user_info_list.append(user)
 
 
-        # 更新群组成员
-        update_result = await mongo.group_db.update_one(
-            {"group_id": group_id},
-            {
-                "$push": {
-                    "members": {
-                        "$each": user_ids  # 添加多个用户ID到members数组
-                    }
+        # 更新群组成员，已在群中的用户不会重复添加
+        added = await add_members(group_id, [user.id for user in user_info_list])
+        if added:
+            update_result = await mongo.group_db.find_one_and_update(
+                {"group_id": group_id},
+                {
+                    "$inc": {"members_count": len(added)},  # 增加成员数量
+                    "$set": {"update_dt": datetime.utcnow()}
                 },
-                "$inc": {"members_count": len(user_ids)},  # 增加成员数量
-                "$set": {"update_dt": datetime.utcnow()}
-            }
-        )
-
-        if not update_result:
-            log_error(f"添加群成员失败 - 群ID: {group_id}")
-            raise HTTPException(
-                status_code=500,
-                detail="添加成员失败"
+                projection={"members_count": 1}
             )
 
-        log_info(f"成功添加群成员 - 群ID: {group_id}, 添加了 {len(user_info_list)} 个成员")
+            if not update_result:
+                log_error(f"添加群成员失败 - 群ID: {group_id}")
+                raise HTTPException(
+                    status_code=500,
+                    detail="添加成员失败"
+                )
+
+            # 人数超过阈值后切换为读时合并
+            summary = {**group, "members_count": update_result.get("members_count")}
+            if not group.get("fanout_on_read") and is_fanout_on_read(summary["members_count"]):
+                summary["fanout_on_read"] = True
+                # 切换前按成员当前的未读数补齐读游标，切换后未读数不会变成整个群的历史消息数
+                await seed_fanout_cursors(group_id)
+                await mongo.group_db.update_one({"group_id": group_id}, {"$set": {"fanout_on_read": True}})
+
+            # 新成员创建群摘要，其他成员的群摘要更新人数
+            await add_group_summaries(summary, added)
+            await update_group_summaries(group_id, {"members_count": summary["members_count"],
+                                                    "fanout_on_read": bool(summary.get("fanout_on_read"))})
+
+        log_info(f"成功添加群成员 - 群ID: {group_id}, 添加了 {len(added)} 个成员")
+
+        group_cache.invalidate(group_id)
+        # 通知在线连接更新成员集合，新成员立即能收到消息
+        await publish_group_event(MEMBERS_ADDED, group_id, user_ids=added)
+        if added:
+            await refresh_group_avatar(group_id, session)
+            # 一次加入的所有成员合并为一条系统消息
+            names = _usernames([current_user_id, *added], session)
+            await notify_group(group_id, current_user_id, names[current_user_id], "add_members",
+                               f"{names[current_user_id]} 邀请 {'、'.join(names[user_id] for user_id in added)} 加入了群聊",
+                               group_name=group.get("name", ""), user_ids=added)
 
         # 发送通知给被添加的用户
         for user in user_info_list:
-            # 这里可以添加发送通知的逻辑
-            log_info(f"用户 {user.username} 被添加到群 {group_id}")
+            if user.id in added:
+                # 这里可以添加发送通知的逻辑
+                log_info(f"用户 {user.username} 被添加到群 {group_id}")
 
 
         return BaseResponse(
             success=True,
-            message=f"成功添加 {len(user_info_list)} 个成员到群聊"
+            message=f"成功添加 {len(added)} 个成员到群聊"
         )
 
     except HTTPException:
@@ -917,6 +1032,59 @@ async def add_group_members(
         )
 
 
+async def emit_system_message(group_id: str, from_id: int, from_username: str, action: str, content: str,
+                              message_id: Optional[int] = None, group_name: str = "", **extra) -> dict:
+    """
+    保存一条群系统消息并实时推送给在线成员
+    系统消息和聊天消息共用群内序号，字段与聊天消息一致，历史记录中一并返回，序号不会出现缺口；
+    短时间内的多条系统消息合并为一次推送
+    """
+    system_message = {
+        "id": message_id or int(datetime.now().timestamp() * 1000),
+        "type": "system_message",
+        "to": group_id,
+        "content": content,
+        "from": from_id,
+        "from_username": from_username,
+        "message_type": "system",
+        "action": action,
+        "time": datetime.now().isoformat(),
+        "is_system": True,
+        "text": content,
+        "media": "",
+        "from_photo": "",
+        "group_name": group_name,
+        "is_delete": 0,
+        **extra,
+    }
+    system_message["seq"] = await next_seq(conversation_key(from_id, group_id),
+                                           mongo.group_chat_db, {"to": group_id})
+    inserted_id = await mongo.group_chat_db.insert(system_message)
+    system_message.pop("_id", None)
+    await system_messages.add(group_id, to_notification({**system_message, "_id": inserted_id}))
+    return system_message
+
+
+def _usernames(user_ids: List[int], session: Session) -> Dict[int, str]:
+    """系统消息中显示的用户名，查不到时显示用户ID"""
+    try:
+        profiles = get_user_profiles(user_ids, session)
+    except Exception as e:
+        log_error(f"获取用户信息失败: {str(e)}")
+        profiles = {}
+    return {user_id: (profiles.get(user_id) or {}).get("username") or str(user_id) for user_id in user_ids}
+
+
+async def notify_group(group_id: str, from_id: int, from_username: str, action: str, content: str,
+                       group_name: str = "", **extra):
+    """服务端产生的群变更（改名、加人、移除、退群、解散）作为系统消息推送，推送失败不影响操作本身"""
+    try:
+        await emit_system_message(group_id, from_id, from_username, action, content,
+                                  group_name=group_name, **extra)
+    except Exception as e:
+        log_error(f"发送群系统消息失败 {group_id}: {str(e)}")
+
+
 @router.post("/group/system-message")
 async def receive_system_message(
         message_data: dict,
@@ -937,32 +1105,20 @@ async def receive_system_message(
         # 验证用户是否是群成员
 
 
-        if not is_group_member(group_id, current_user_id):
+        if not await is_group_member(group_id, current_user_id):
             raise HTTPException(status_code=403, detail="不是群成员")
 
         # 验证发送者ID是否匹配当前用户
         if message_data["from"] != current_user_id:
             raise HTTPException(status_code=403, detail="发送者ID不匹配")
 
-        # 构建完整的系统消息
-        system_message = {
-            "id": message_data.get("id", int(datetime.now().timestamp() * 1000)),
-            "type": "system_message",
-            "to": group_id,
-            "content": message_data["content"],
-            "from": current_user_id,
-            "from_username": message_data["from_username"],
-            "message_type": "system",
-            "action": message_data["action"],
-            "time": datetime.now().isoformat(),
-            "is_system": True
-        }
-
+        system_message = await emit_system_message(
+            group_id, current_user_id, message_data["from_username"], message_data["action"],
+            message_data["content"], message_id=message_data.get("id"),
+            group_name=message_data.get("group_name", ""),
+        )
         log_info(f"接收系统消息: {system_message}")
 
-        # 处理系统消息（广播、存储等）
-        await mongo.group_chat_db.insert_one(system_message)
-
         return {
             "status": "success",
             "message": "系统消息发送成功",
@@ -976,32 +1132,6 @@ async def receive_system_message(
         log_error(f"处理系统消息失败: {str(e)}")
         raise HTTPException(status_code=500, detail="处理系统消息失败")
 
-# active_connections: Dict[str, WebSocket] = {}
-# async def broadcast_system_message(message: dict, group_id: str):
-#     """
-#     广播系统消息给所有在线群成员
-#     """
-#     try:
-#         members = await get_group_members(group_id)
-#         broadcast_count = 0
-#
-#         for member_id in members:
-#             connection_key = f"{member_id}-{group_id}"
-#             connection_key = get_websocket_connection(str(member_id), group_id)
-#             active_connections[connection_key] = websocket
-#             if connection_key in active_connections:
-#                 try:
-#                     await active_connections[connection_key].send_text(json.dumps(message))
-#                     broadcast_count += 1
-#                 except Exception as e:
-#                     log_error(f"向用户 {member_id} 广播失败: {str(e)}")
-#
-#         log_info(f"系统消息广播给 {broadcast_count} 个在线成员")
-#
-#     except Exception as e:
-#         log_error(f"广播系统消息失败: {str(e)}")
-
-
 class NotificationMessage(BaseModel):
     id: str
     type: Optional[str] = None
@@ -1014,22 +1144,34 @@ class NotificationMessage(BaseModel):
     created_at: Optional[Union[datetime, str]] = None
     action: Optional[str] = None
     is_system: Optional[bool] = None
+    seq: Optional[int] = None
+
+
+def to_notification(msg: dict) -> dict:
+    """系统消息转换为前端需要的格式，轮询接口和实时推送共用"""
+    # 处理MongoDB的_id字段
+    msg["id"] = str(msg.pop("_id"))
+
+    # 确保字段名与前端期望一致
+    if "from" in msg:
+        msg["from_id"] = msg["from"]
+
+    if "time" in msg:
+        msg["created_at"] = msg["time"]
+    return msg
 
 async def is_group_member(group_id: str, user_id: int) -> bool:
     """检查用户是否是群组成员"""
     try:
-        # 从group_db中查询群组信息
-        group = await mongo.group_db.find_one({"group_id": group_id, "delete": 0})
+        # 从群信息缓存中查询群组信息
+        group = await group_cache.get(group_id)
 
-        if not group:
+        if not group or group.get("delete") != 0:
             # 群组不存在
             return False
 
-        # 检查members字段中是否存在该用户ID
-        if user_id in group["members"]:
-            return True
-
-        return False
+        # 检查缓存的成员集合中是否存在该用户ID
+        return await group_cache.is_member(group_id, user_id)
 
     except Exception as e:
         print(f"检查群组成员身份时出错: {e}")
@@ -1041,8 +1183,9 @@ async def get_system_notification(
         current_user_id: int = Depends(get_current_user_id),
         limit: int = Query(100, gt=0, le=1000),  # 限制返回的消息数量，默认100条，最大1000条
         before_time: datetime = Query(None),  # 分页参数：获取某个时间之前的消息
+        after_seq: Optional[int] = Query(None),  # 断线重连后只补拉该序号之后的消息
 ):
-    """获取群组的系统通知消息"""
+    """获取群组的系统通知消息（在线时通过群聊连接实时推送，这里用于首次加载和断线补拉）"""
     log_info(f"打印系统消息的信息： {group_id}, {current_user_id}")
     # 验证用户是否有权限访问该群组的通知
     # 首先检查用户是否是该群组的成员
@@ -1069,25 +1212,17 @@ async def get_system_notification(
     # 按时间降序排序（最新消息在前）
     sort = [("time", 1)]
 
+    # 按序号补拉缺失的消息
+    if after_seq is not None:
+        query["seq"] = {"$gt": after_seq}
+        sort = [("seq", 1)]
+
     # 查询数据库
     messages_list = await mongo.group_chat_db.find_many(query=query, limit=limit, sort=sort)
 
-    log_info(f"群消息： {messages_list}")
     # 转换为前端需要的格式
-    messages = []
-    for msg in messages_list:
-        # 处理MongoDB的_id字段
-        msg["id"] = str(msg.pop("_id"))
-
-        # 确保字段名与前端期望一致
-        if "from" in msg:
-            msg["from_id"] = msg["from"]
-
-        if "time" in msg:
-            msg["created_at"] = msg["time"]
-        log_info(f"群消息通知： {msg}")
-        messages.append(msg)
-    log_info(f"群消息通知列表： {messages}")
+    messages = [to_notification(msg) for msg in messages_list]
+    log_info(f"群系统消息 - 群ID: {group_id}, 返回 {len(messages)} 条")
     # 不需要反转列表，因为已经是按时间降序排列（最新消息在前）
     # 这样前端可以直接显示，最新的通知在最上面
 
@@ -15,9 +15,20 @@ from enum import Enum
 from datetime import datetime
 from utils.redis import (store_websocket_connection,
                             remove_websocket_connection,
+                            set_read_cursor,
+                            set_read_cursors,
                              )
 from utils.get_current_user import get_current_user_id
 from views.chat.single_chat import add_recent_chat
+from utils.sequence import conversation_key, next_seq
+from utils.chat_archive import fill_from_archive
+from utils.ws_hub import hub
+from utils.group_cache import group_cache
+from utils.group_events import (live_members, track_live_group, on_group_event, MEMBERS_REMOVED,
+                                GROUP_DISMISSED, SYSTEM_MESSAGES)
+from utils.group_member import get_member_ids
+from utils.group_mute import get_muted_members
+from utils.recent_chat import RecentChatBatch, touch_group_head, ack_read, ack_read_batch, group_summary_fields
 
 # 初始化MongoDB连接
 mongo = MotorDB(database="chat_db")
@@ -25,12 +36,174 @@ mongo = MotorDB(database="chat_db")
 @app.on_event("startup")
 async def startup_db_client():
     await mongo.connect()
+    # 按会话序号拉取缺失区间
+    await mongo.group_chat_db.create_index([("to", 1), ("seq", 1)])
 
 router = APIRouter(tags=["聊天"])
 
 active_connections: Dict[str, WebSocket] = {}
 
 
+def is_viewing(member_id: int, group_id: str) -> bool:
+    """成员是否正停留在群聊中（单会话连接或多路复用连接已订阅）"""
+    return f"{str(member_id)}-{group_id}" in active_connections or hub.is_subscribed(member_id, group_id)
+
+
+async def deliver(member_id: int, group_id: str, msg: dict) -> bool:
+    """把群消息推送给在线成员"""
+    member_key = f"{str(member_id)}-{group_id}"
+    if member_key in active_connections:
+        await active_connections[member_key].send_text(json.dumps(msg))
+        return True
+    return await hub.send(member_id, group_id, msg)
+
+
+async def handle_group_message(user_id: int, group: dict, message: dict, session: Session) -> dict:
+    """处理一条群消息：存储、广播、更新最近聊天和读游标，单会话连接和多路复用连接共用"""
+    group_id = group.get("group_id")
+    # 获取群名称和头像
+    group_name = group.get("name", "未知群组")
+
+    # 获取发送者信息
+    crud = UserCRUD(session)
+    sender = crud.get_user_by_user_id(user_id)
+    sender_username = sender.username if sender else "未知用户"
+    sender_photo = sender.photo if sender else ""
+
+    # 构建要广播的消息
+    msg = {
+        "id": message.get("id", datetime.now().microsecond),
+        "text": message.get("text") or "",
+        "from": user_id,
+        "to": group_id,
+        "media": message.get("media") or '',
+        "from_username": sender_username,
+        "from_photo": sender_photo,
+        "group_name": group_name,
+        "is_delete": 0,
+        "message_type": "text",
+        "time": message.get("time", datetime.now().isoformat())
+    }
+
+    # 先存储消息到MongoDB,如果有文本信息或媒体文件，成员拿到的是真实的消息ID，可用于已读确认
+    stored = bool(message.get("text") or message.get("media"))
+    if stored:
+        # 群内单调递增的序号，客户端据此排序并发现缺失的消息
+        msg["seq"] = await next_seq(conversation_key(user_id, group_id), mongo.group_chat_db,
+                                    {"to": group_id})
+        inserted_id = await mongo.group_chat_db.insert(msg)
+        msg.pop("_id", None)
+        msg["id"] = str(inserted_id)  # 使用MongoDB生成的ID
+
+    # 广播消息给所有群成员，优先使用随群变更事件增量更新的成员集合
+    members = live_members.members(group_id)
+    if members is None:
+        members = await get_member_ids(group_id)
+    online_count = 0
+    online_members = []
+    offline_members = []
+
+    for member_id in members:
+        if member_id == user_id:  # 不发送给自己
+            continue
+
+        if is_viewing(member_id, group_id):
+            online_members.append(member_id)
+            if message.get("text"):
+                # 成员在线，发送消息
+                try:
+                    if await deliver(member_id, group_id, msg):
+                        online_count += 1
+                except Exception as e:
+                    log_error(f"发送消息到用户 {member_id} 失败: {str(e)}")
+        else:
+            # 成员离线，记录离线成员
+            offline_members.append(member_id)
+
+    log_info(f"消息已广播给 {online_count} 个在线成员，{len(offline_members)} 个成员离线")
+
+    if stored:
+        # 在线成员正停留在群聊中，读游标直接推进到这条消息
+        set_read_cursors(online_members, group_id, msg["id"])
+        now = datetime.now()
+        # 最后一条消息的预览，用于最近聊天和“我的群聊”列表
+        last_message = {
+            "from": user_id,
+            "from_username": sender_username,
+            "text": msg["text"],
+            "media": msg["media"],
+        }
+        if group.get("fanout_on_read"):
+            # 大群只更新共享的群消息头，成员的最近聊天在读取时合并
+            await touch_group_head(group_id, user_id, msg["id"], last_message, last_message_time=now)
+        else:
+            # 发送方、在线成员、离线成员的最近聊天记录合并成一次批量写
+            batch = RecentChatBatch()
+            batch.touch(user_id, group_id, last_message_time=now, fields={
+                **group_summary_fields(group),
+                "last_message": last_message,
+            })
+            preview = {"last_message": last_message}
+            batch.touch_many(online_members, group_id, last_message_time=now, fields=preview)
+            # 离线成员未读数加1，开启免打扰的成员只更新时间
+            muted = await get_muted_members(group_id)
+            batch.touch_many([member_id for member_id in offline_members if member_id not in muted],
+                             group_id, last_message_time=now, unread=1, fields=preview)
+            batch.touch_many([member_id for member_id in offline_members if member_id in muted],
+                             group_id, last_message_time=now, fields=preview)
+            await batch.flush()
+            set_read_cursor(user_id, group_id, msg["id"])
+    return msg
+
+
+@on_group_event
+async def notify_removed_members(event: dict):
+    """被移出群或群解散时，通知本进程内这些成员的在线连接，并取消多路复用订阅"""
+    if event["type"] not in (MEMBERS_REMOVED, GROUP_DISMISSED):
+        return
+    group_id = event["group_id"]
+    user_ids = event.get("user_ids") or []
+    if event["type"] == GROUP_DISMISSED:
+        user_ids = [int(key.split("-", 1)[0]) for key in list(active_connections)
+                    if key.split("-", 1)[1] == group_id]
+        user_ids += [user_id for user_id in list(hub.subscriptions) if hub.is_subscribed(user_id, group_id)]
+    notice = {"type": event["type"], "group_id": group_id}
+    for user_id in set(user_ids):
+        member_key = f"{str(user_id)}-{group_id}"
+        if member_key in active_connections:
+            try:
+                await active_connections[member_key].send_text(json.dumps(notice))
+            except Exception as e:
+                log_error(f"通知用户 {user_id} 失败: {str(e)}")
+        if hub.is_subscribed(user_id, group_id):
+            await hub.send_frame(user_id, {"op": "event", "conv": group_id, "data": notice})
+            hub.unsubscribe(user_id, group_id)
+            live_members.release(group_id)
+
+
+@on_group_event
+async def deliver_system_messages(event: dict):
+    """群系统消息实时推送给本进程内正停留在群聊中的成员，合并后的多条消息作为一帧发送"""
+    if event["type"] != SYSTEM_MESSAGES:
+        return
+    group_id = event["group_id"]
+    members = live_members.members(group_id)
+    if not members:
+        return
+    messages = event.get("messages") or []
+    if len(messages) == 1:
+        frame = messages[0]
+    else:
+        frame = {"type": "system_message_batch", "to": group_id, "messages": messages}
+    for member_id in list(members):
+        if not is_viewing(member_id, group_id):
+            continue
+        try:
+            await deliver(member_id, group_id, frame)
+        except Exception as e:
+            log_error(f"推送系统消息到用户 {member_id} 失败: {str(e)}")
+
+
 @router.websocket("/{group_id}/{user_id}")
 async def group_chat_websocket(websocket: WebSocket, user_id: int, group_id: str,
                                session: Session = Depends(get_session)):
@@ -43,16 +216,17 @@ async def group_chat_websocket(websocket: WebSocket, user_id: int, group_id: str
     active_connections[connection_key] = websocket
     log_info(f"用户 {user_id} 加入群聊 {group_id}")
 
+    tracked = False
     try:
         # 获取群信息，检查用户是否是群成员
-        group = await mongo.group_db.find_one({"group_id": group_id})
-        if not group or user_id not in group.get("members", []):
+        group = await group_cache.get(group_id)
+        if not group or not await group_cache.is_member(group_id, user_id):
             await websocket.send_text(json.dumps({"error": "不是群成员"}))
             await websocket.close()
             return
-
-        # 获取群名称和头像
-        group_name = group.get("name", "未知群组")
+        # 登记在线群的成员集合，之后由群变更事件增量维护
+        await track_live_group(group_id)
+        tracked = True
 
         while True:
             # 接收消息
@@ -60,87 +234,24 @@ async def group_chat_websocket(websocket: WebSocket, user_id: int, group_id: str
             message = json.loads(data)
             log_info(f"收到来自用户 {user_id} 发送到群 {group_id} 的消息: {message}")
 
-            # 获取发送者信息
-            crud = UserCRUD(session)
-            sender = crud.get_user_by_user_id(user_id)
-            sender_username = sender.username if sender else "未知用户"
-            sender_photo = sender.photo if sender else ""
-
-            # 构建要广播的消息
-            msg = {
-                "id": message.get("id", datetime.now().microsecond),
-                "text": message.get("text") or "",
-                "from": user_id,
-                "to": group_id,
-                "media": message.get("media") or '',
-                "from_username": sender_username,
-                "from_photo": sender_photo,
-                "group_name": group_name,
-                "is_delete": 0,
-                "message_type": "text",
-                "time": message.get("time", datetime.now().isoformat())
-            }
-
-            # 广播消息给所有群成员
-            members = group.get("members", [])
-            online_count = 0
-            offline_members = []
-
-            for member_id in members:
-                if member_id == user_id:  # 不发送给自己
-                    continue
-
-                member_key = f"{str(member_id)}-{group_id}"
-                if member_key in active_connections and message.get("text"):
-                    # 成员在线，发送消息
-                    member_socket = active_connections[member_key]
-                    try:
-                        await member_socket.send_text(json.dumps(msg))
-                        online_count += 1
-                    except Exception as e:
-                        log_error(f"发送消息到用户 {member_id} 失败: {str(e)}")
-                else:
-                    # 成员离线，记录离线成员
-                    offline_members.append(member_id)
-
-                # 更新接收方的最近聊天记录和未读计数
-                if member_key not in active_connections:  # 如果接收方离线
-                    receiver_recent_chat = RecentChat(
-                        user_id=user_id,
-                        target_id=group_id,
-                        group_owner_id=group.get("creator_id"),
-                        target_username=group_name,
-                        group_name=group_name,
-                        group_members=members,
-                        is_group=True,
-                        members_count=group.get("members_count"),
-                        last_message_time=datetime.now(),
-                        unread_count=0  # 发送方的未读计数为0
-                    )
-                    await add_recent_chat(receiver_recent_chat)
-
-            log_info(f"消息已广播给 {online_count} 个在线成员，{len(offline_members)} 个成员离线")
-
-            # 存储消息到MongoDB,如果有文本信息或媒体文件
-            print(f"{message}")
-            # 存储消息到MongoDB,如果有文本信息或媒体文件
-            if message.get("text") or message.get("media"):
-                inserted_id = await mongo.group_chat_db.insert(msg)
-                msg["id"] = str(inserted_id)  # 使用MongoDB生成的ID
-                # 更新最近聊天记录
-                recent_chat = RecentChat(
-                    user_id=user_id,
-                    target_id=group_id,
-                    group_owner_id = group.get("creator_id"),
-                    target_username=group_name,
-                    group_name= group_name,
-                    group_members = members,
-                    is_group = True,
-                    members_count= group.get("members_count"),
-                    last_message_time=datetime.now(),
-                    unread_count=0  # 发送方的未读计数为0
-                )
-                await add_recent_chat(recent_chat)
+            # 已读确认：{"type": "ack", "up_to": 消息ID}，
+            # 或批量 {"type": "ack", "acks": [{"target_id": ..., "up_to": ...}]}
+            if message.get("type") == "ack":
+                if message.get("acks"):
+                    await ack_read_batch(user_id, message["acks"])
+                elif message.get("up_to"):
+                    await ack_read(user_id, group_id, str(message["up_to"]))
+                continue
+
+            # 被移出群或群已解散后不能再发消息
+            if not live_members.is_member(group_id, user_id):
+                await websocket.send_text(json.dumps({"error": "不是群成员"}))
+                await websocket.close()
+                raise WebSocketDisconnect(code=1008)
+
+            # 群名称等信息走缓存，收到群变更事件后本地缓存已失效
+            group = await group_cache.get(group_id) or group
+            await handle_group_message(user_id, group, message, session)
 
     except WebSocketDisconnect:
         # 连接断开
@@ -157,6 +268,9 @@ async def group_chat_websocket(websocket: WebSocket, user_id: int, group_id: str
             del active_connections[connection_key]
         remove_websocket_connection(str(user_id), group_id)
         await websocket.close()
+    finally:
+        if tracked:
+            live_members.release(group_id)
 
 
 # 新增数据模型
@@ -179,43 +293,36 @@ class RecentChat(BaseModel):
 async def add_recent_chat(recent_chat: RecentChat):
     """添加或更新最近聊天记录"""
 
-    query = {"user_id": recent_chat.user_id, "target_id": recent_chat.target_id}
-    if not recent_chat.is_group:
-        update = {
-            "$set": {
-                "target_username": recent_chat.target_username,
-                "target_photo": recent_chat.target_photo,
-                "last_message_time": recent_chat.last_message_time,
-                "unread_count": recent_chat.unread_count
-            },
-            "$setOnInsert": {"user_id": recent_chat.user_id, "target_id": recent_chat.target_id}
-        }
-    else:
-        update = {
-            "$set": {
-                "target_username": recent_chat.target_username,
-                "target_photo": recent_chat.target_photo,
-                "is_group":recent_chat.is_group,
-                "last_message_time": recent_chat.last_message_time,
-                "unread_count": recent_chat.unread_count
-            },
-            "$setOnInsert": {"user_id": recent_chat.user_id, "target_id": recent_chat.target_id}
-        }
-    await mongo.recent_chats_db.update_one(query, update, upsert=False)
+    fields = {
+        "target_username": recent_chat.target_username,
+        "target_photo": recent_chat.target_photo,
+    }
+    if recent_chat.is_group:
+        fields["is_group"] = recent_chat.is_group
+    # unread_count 作为增量累加，不再覆盖已有的未读数
+    batch = RecentChatBatch()
+    batch.touch(recent_chat.user_id, recent_chat.target_id,
+                last_message_time=recent_chat.last_message_time,
+                unread=recent_chat.unread_count, fields=fields, upsert=False)
+    await batch.flush()
     return {"message": "最近聊天记录已更新"}
 
 class Message(BaseModel):
     created_at: datetime
     from_id: int
-    group_name: str
+    group_name: str = ""
     from_username: str
-    from_photo: str
+    from_photo: str = ""
     to: str
     text: str
     id: str
-    media: Union[str, List[Dict[str, Any]]]
+    media: Union[str, List[Dict[str, Any]]] = ""
     is_delete: int
+    seq: Optional[int] = None
     time: datetime
+    # 系统消息（入群、改名等）
+    is_system: Optional[bool] = None
+    action: Optional[str] = None
 
 @router.get("/history/{user_id}/{target_id}", response_model=List[Message])
 async def get_chat_history(
@@ -223,6 +330,8 @@ async def get_chat_history(
         target_id: str,
         limit: int = Query(100, gt=0, le=1000),  # 限制返回的消息数量，默认100条，最大1000条
         before_time: datetime = Query(None),  # 分页参数：获取某个时间之前的消息
+        after_seq: Optional[int] = Query(None, ge=0),  # 补齐缺失区间：获取该序号之后的消息
+        before_seq: Optional[int] = Query(None, gt=0),  # 补齐缺失区间：获取该序号之前的消息
 ):
     """获取两个用户之间的聊天历史记录"""
 
@@ -240,8 +349,23 @@ async def get_chat_history(
     if before_time:
         query["time"] = {"$lt": before_time}
     sort = [("time", -1)]
+
+    # 按序号区间拉取：客户端发现序号不连续时只补齐缺失的部分
+    if after_seq is not None or before_seq is not None:
+        seq_range = {}
+        if after_seq is not None:
+            seq_range["$gt"] = after_seq
+        if before_seq is not None:
+            seq_range["$lt"] = before_seq
+        query["seq"] = seq_range
+        # 只给了 after_seq 时从缺口开头往后取，否则取最靠近 before_seq 的一段
+        sort = [("seq", 1)] if before_seq is None else [("seq", -1)]
     # 查询数据库并按时间降序排序（最新消息在前）
     messages_list = await mongo.group_chat_db.find_many(query=query, limit=limit, sort=sort)
+    # 热数据不够一页时，更早的消息从归档文件中补齐
+    messages_list = await fill_from_archive(messages_list, user_id, target_id, limit, sort,
+                                            before_time=before_time, after_seq=after_seq,
+                                            before_seq=before_seq)
 
     # 转换为列表并反转（使消息按时间升序排列）
     messages = []
@@ -254,7 +378,8 @@ async def get_chat_history(
         messages.append(msg)
 
     # 反转列表，使消息按时间升序排列（最早的消息在前）
-    messages.reverse()
+    if sort[0][1] == -1:
+        messages.reverse()
 
     return messages
 
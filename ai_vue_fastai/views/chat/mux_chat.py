@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query, status
+import json
+from typing import Any, Optional
+from sqlmodel import Session
+from utils.database import get_session
+from utils.log import log_info, log_error
+from utils.get_current_user import get_websocket_user_id
+from utils.redis import store_websocket_connection, remove_websocket_connection
+from utils.recent_chat import ack_read, is_group_conversation, normalize_target_id
+from utils.ws_hub import hub
+from utils.group_cache import group_cache
+from utils.group_events import live_members, track_live_group
+from views.chat.single_chat import handle_single_message
+from views.chat.group_chat import handle_group_message
+
+router = APIRouter(tags=["聊天"])
+
+# 一个用户一条连接，用固定字段记录在 ws_connections:{user_id} 中
+MUX_CONNECTION_FIELD = "mux"
+# batch 帧中不能再嵌套 batch
+MAX_BATCH_DEPTH = 1
+
+
+async def handle_frame(user_id: int, frame: dict, session: Session, depth: int = 0):
+    """
+    处理一帧多路复用协议：
+    - {"op": "subscribe", "conv": 会话ID}
+    - {"op": "unsubscribe", "conv": 会话ID}
+    - {"op": "send", "conv": 会话ID, "data": {"text": ..., "media": ..., "time": ...}}
+    - {"op": "ack", "conv": 会话ID, "up_to": 消息ID}
+    - {"op": "batch", "frames": [上述任意帧, ...]}
+    """
+    if not isinstance(frame, dict):
+        await hub.send_frame(user_id, {"op": "error", "msg": "消息格式错误"})
+        return
+    op = frame.get("op")
+    if op == "batch":
+        if depth >= MAX_BATCH_DEPTH or not isinstance(frame.get("frames") or [], list):
+            await hub.send_frame(user_id, {"op": "error", "msg": "batch 帧格式错误"})
+            return
+        for sub_frame in frame.get("frames") or []:
+            await handle_frame_safely(user_id, sub_frame, session, depth + 1)
+        return
+
+    if frame.get("conv") is None:
+        await hub.send_frame(user_id, {"op": "error", "msg": "缺少会话ID"})
+        return
+    # 会话ID：群聊是 group_ 开头的群ID，单聊是对方用户ID；无效的会话ID只回错误帧，不影响其他会话
+    conv = normalize_target_id(frame["conv"])
+    if conv is None:
+        await hub.send_frame(user_id, {"op": "error", "conv": frame["conv"], "msg": "无效的会话ID"})
+        return
+
+    if op == "subscribe":
+        if is_group_conversation(conv):
+            # 群聊订阅时校验成员身份
+            group = await group_cache.get(conv)
+            if not group or not await group_cache.is_member(conv, user_id):
+                await hub.send_frame(user_id, {"op": "error", "conv": conv, "msg": "不是群成员"})
+                return
+            if not hub.is_subscribed(user_id, conv):
+                # 登记在线群的成员集合，之后由群变更事件增量维护
+                await track_live_group(conv)
+        hub.subscribe(user_id, conv)
+        await hub.send_frame(user_id, {"op": "subscribed", "conv": conv})
+
+    elif op == "unsubscribe":
+        if is_group_conversation(conv) and hub.is_subscribed(user_id, conv):
+            live_members.release(conv)
+        hub.unsubscribe(user_id, conv)
+        await hub.send_frame(user_id, {"op": "unsubscribed", "conv": conv})
+
+    elif op == "send":
+        data = frame.get("data") or {}
+        if is_group_conversation(conv):
+            if not hub.is_subscribed(user_id, conv):
+                await hub.send_frame(user_id, {"op": "error", "conv": conv, "msg": "请先订阅该群聊"})
+                return
+            # 被移出群或群已解散后不能再发消息
+            if not live_members.is_member(conv, user_id):
+                await hub.send_frame(user_id, {"op": "error", "conv": conv, "msg": "不是群成员"})
+                return
+            # 群信息走缓存，群名称、成员变更后自动生效
+            group = await group_cache.get(conv)
+            if not group or group.get("delete") == -1:
+                await hub.send_frame(user_id, {"op": "error", "conv": conv, "msg": "群组不存在或已被解散"})
+                return
+            msg = await handle_group_message(user_id, group, data, session)
+        else:
+            msg = await handle_single_message(user_id, conv, data, session)
+        # 回执里带上服务端生成的消息ID和序号
+        await hub.send_frame(user_id, {"op": "sent", "conv": conv, "client_id": data.get("id"),
+                                       "id": msg.get("id"), "seq": msg.get("seq")})
+
+    elif op == "ack":
+        if frame.get("up_to"):
+            await ack_read(user_id, conv, str(frame["up_to"]))
+
+    else:
+        await hub.send_frame(user_id, {"op": "error", "msg": f"未知操作: {op}"})
+
+
+async def handle_frame_safely(user_id: int, frame: Any, session: Session, depth: int = 0):
+    """处理一帧，出错时只给该会话回错误帧，连接和其他会话不受影响"""
+    conv = frame.get("conv") if isinstance(frame, dict) else None
+    try:
+        await handle_frame(user_id, frame, session, depth)
+    except WebSocketDisconnect:
+        raise
+    except HTTPException as e:
+        await hub.send_frame(user_id, {"op": "error", "conv": conv, "msg": e.detail})
+    except Exception as e:
+        log_error(f"处理多路复用帧失败 用户 {user_id}: {str(e)}")
+        await hub.send_frame(user_id, {"op": "error", "conv": conv, "msg": "处理失败"})
+
+
+@router.websocket("/{user_id}")
+async def mux_websocket(websocket: WebSocket, user_id: int, token: Optional[str] = Query(None),
+                        session: Session = Depends(get_session)):
+    """
+    多路复用连接：一个用户一条WebSocket承载所有单聊和群聊
+    握手时校验查询参数中的token，token中的用户必须与路径中的用户一致
+    """
+    if await get_websocket_user_id(token) != user_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    connection_key = f"{user_id}-{MUX_CONNECTION_FIELD}"
+
+    # 存储连接信息到Redis，整条连接只写一次
+    store_websocket_connection(user_id, MUX_CONNECTION_FIELD, connection_key)
+    hub.connect(user_id, websocket)
+    log_info(f"用户 {user_id} 建立多路复用连接")
+
+    try:
+        while True:
+            data = await websocket.receive_text()
+            try:
+                frame = json.loads(data)
+            except json.JSONDecodeError:
+                await hub.send_frame(user_id, {"op": "error", "msg": "消息格式错误"})
+                continue
+            await handle_frame_safely(user_id, frame, session)
+
+    except WebSocketDisconnect:
+        log_info(f"用户 {user_id} 断开多路复用连接")
+    except Exception as e:
+        log_error(f"WebSocket异常: {str(e)}")
+        await websocket.close()
+    finally:
+        if hub.sockets.get(user_id) is websocket:
+            for conv in hub.subscriptions.get(user_id, ()):
+                if is_group_conversation(conv):
+                    live_members.release(conv)
+        hub.disconnect(user_id, websocket)
+        remove_websocket_connection(user_id, MUX_CONNECTION_FIELD)
@@ -18,11 +18,16 @@ from datetime import datetime
 from utils.redis import (store_websocket_connection,
                             remove_websocket_connection,
                             is_user_online,
-                            mark_message_as_read,
-                            is_message_read,
+                            set_read_cursor,
 get_websocket_connection, get_all_websocket_connections
                              )
 from utils.encryption import generate_key_from_uuid, encrypt
+from utils.sequence import conversation_key, next_seq
+from utils.chat_archive import fill_from_archive
+from utils.timeline import is_contact, reset_contact_timelines
+from utils.ws_hub import hub
+from utils.recent_chat import (RecentChatBatch, get_recent_chats_merged, ack_read, ack_read_batch,
+                               mark_conversation_read)
 import  re
 
 # 初始化MongoDB连接
@@ -31,11 +36,97 @@ mongo = MotorDB(database="chat_db")
 @app.on_event("startup")
 async def startup_db_client():
     await mongo.connect()
+    # 按会话序号拉取缺失区间
+    await mongo.single_db.create_index([("from", 1), ("to", 1), ("seq", 1)])
 
 router = APIRouter(tags=["聊天"])
 
 active_connections: Dict[str, WebSocket] = {}
 
+
+def is_viewing(user_id: int, target_id: int) -> bool:
+    """用户是否正停留在与 target_id 的会话中（单会话连接或多路复用连接已订阅）"""
+    return f"{user_id}-{target_id}" in active_connections or hub.is_subscribed(user_id, target_id)
+
+
+async def deliver(user_id: int, target_id: int, msg: dict) -> bool:
+    """把与 target_id 会话中的消息推送给 user_id"""
+    connection_key = f"{user_id}-{target_id}"
+    if connection_key in active_connections:
+        await active_connections[connection_key].send_text(json.dumps(msg))
+        return True
+    return await hub.send(user_id, target_id, msg)
+
+
+async def handle_single_message(user_id: int, target_id: int, message: dict, session: Session) -> dict:
+    """处理一条单聊消息：存储、转发、更新最近聊天和读游标，单会话连接和多路复用连接共用"""
+    # 先校验接收方存在，再存储消息
+    crud = UserCRUD(session)
+    target_user = crud.get_user_by_user_id(target_id)
+    if not target_user:
+        raise HTTPException(status_code=404, detail="目标用户不存在")
+    # 构建要发送的消息
+    msg = {
+        "id": message.get("id", datetime.now().microsecond),
+        "text": message.get("text") or "",
+        "from": user_id,
+        "to": target_id,
+        "media": message.get("media") or '',
+        "fromUsername": message.get("fromUsername") or '',  # 发送者用户名
+        "fromPhoto": message.get("fromPhoto") or '',  # 发送者头像
+        "is_delete": 0,
+        "time": message.get("time", datetime.now().isoformat())
+    }
+
+    # 先存储消息到MongoDB,如果有文本信息或媒体文件，接收方拿到的是真实的消息ID，可用于已读确认
+    stored = bool(message.get("text") or message.get("media"))
+    if stored:
+        # 会话内单调递增的序号，客户端据此排序并发现缺失的消息
+        msg["seq"] = await next_seq(conversation_key(user_id, target_id), mongo.single_db, {
+            "$or": [{"from": user_id, "to": target_id}, {"from": target_id, "to": user_id}]
+        })
+        inserted_id = await mongo.single_db.insert(msg)
+        msg.pop("_id", None)
+        msg["id"] = str(inserted_id)  # 使用MongoDB生成的ID
+
+    # 转发消息给目标用户
+    target_online = is_viewing(target_id, user_id)
+    if target_online and message.get("text"):
+        # 目标用户在线，直接发送消息
+        await deliver(target_id, user_id, msg)
+
+        # 对方正停留在该会话，读游标直接推进到这条消息
+        if stored:
+            set_read_cursor(target_id, user_id, msg["id"])
+    else:
+        # 目标用户离线，记录离线消息（可选）
+        log_info(f"目标用户 {target_id} 离线，消息将存储为离线消息")
+
+    if stored:
+        # 第一次单聊的两人成为好友，最近聊天写入后重建双方的朋友圈时间线
+        new_contact = not await is_contact(user_id, target_id)
+        now = datetime.now()
+        # 发送方和接收方的最近聊天记录合并成一次批量写
+        batch = RecentChatBatch()
+        batch.touch(user_id, target_id, last_message_time=now, fields={
+            "target_username": target_user.username or '',
+            "target_photo": target_user.photo or '',
+        })
+        # 接收方离线时未读数加1
+        batch.touch(target_id, user_id, last_message_time=now,
+                    unread=0 if target_online else 1,
+                    fields={
+                        "target_username": msg["fromUsername"],
+                        "target_photo": msg["fromPhoto"],
+                    })
+        await batch.flush()
+        if new_contact:
+            reset_contact_timelines(user_id, target_id)
+        # 发送方发出消息即视为已读到这里
+        set_read_cursor(user_id, target_id, msg["id"])
+    return msg
+
+
 @router.websocket("/{user_id}/{target_id}")
 async def chat_websocket(websocket: WebSocket, user_id: int , target_id: int,session: Session = Depends(get_session)):
     # 建立连接
@@ -55,62 +146,16 @@ async def chat_websocket(websocket: WebSocket, user_id: int , target_id: int,ses
             message = json.loads(data)
             log_info(f"收到消息 from {user_id} to {target_id}: {message}")
 
-            # 构建要发送的消息
-            msg = {
-                "id": message.get("id", datetime.now().microsecond),
-                "text": message.get("text") or "",
-                "from": user_id,
-                "to": target_id,
-                "media": message.get("media") or '',
-                "fromUsername": message.get("fromUsername") or '',  # 发送者用户名
-                "fromPhoto": message.get("fromPhoto") or '',  # 发送者头像
-                "is_delete": 0,
-                "time": message.get("time", datetime.now().isoformat())
-            }
-
-            # 转发消息给目标用户
-            target_key = f"{target_id}-{user_id}"
-            if target_key in active_connections and message.get("text"):
-                # 目标用户在线，直接发送消息
-                target_socket = active_connections[target_key]
-                await target_socket.send_text(json.dumps(msg))
-
-                # 标记消息为已读（如果需要）
-                if "message_id" in message:  # 如果客户端发送了原始消息ID
-                    mark_message_as_read(str(message["message_id"]))
-            else:
-                # 目标用户离线，记录离线消息（可选）
-                log_info(f"目标用户 {target_id} 离线，消息将存储为离线消息")
-
-            crud = UserCRUD(session)
-            print(f"{message}")
-            # 存储消息到MongoDB,如果有文本信息或媒体文件
-            if message.get("text") or message.get("media"):
-                inserted_id = await mongo.single_db.insert(msg)
-                msg["id"] = str(inserted_id)  # 使用MongoDB生成的ID
-                user = crud.get_user_by_user_id(target_id)
-                # 更新最近聊天记录
-                recent_chat = RecentChat(
-                    user_id=user_id,
-                    target_id=target_id,
-                    target_username=user.username or '',
-                    target_photo=user.photo or '',
-                    last_message_time=datetime.now(),
-                    unread_count=0  # 发送方的未读计数为0
-                )
-                await add_recent_chat(recent_chat)
-
-                # 更新接收方的最近聊天记录和未读计数
-                if target_key not in active_connections:  # 如果接收方离线
-                    receiver_recent_chat = RecentChat(
-                        user_id=target_id,
-                        target_id=user_id,
-                        target_username= user.username or '',
-                        target_photo= user.photo or '',
-                        last_message_time=datetime.now(),
-                        unread_count=1  # 离线时增加未读计数
-                    )
-                    await add_recent_chat(receiver_recent_chat)
+            # 已读确认：{"type": "ack", "up_to": 消息ID}，
+            # 或批量 {"type": "ack", "acks": [{"target_id": ..., "up_to": ...}]}
+            if message.get("type") == "ack":
+                if message.get("acks"):
+                    await ack_read_batch(user_id, message["acks"])
+                elif message.get("up_to"):
+                    await ack_read(user_id, target_id, str(message["up_to"]))
+                continue
+
+            await handle_single_message(user_id, target_id, message, session)
 
     except WebSocketDisconnect:
         # 连接断开
@@ -132,6 +177,7 @@ class Message(BaseModel):
     fromUsername: Optional[str] = None
     fromPhoto: Optional[str] = None
     is_delete: int = 0
+    seq: Optional[int] = None
     time: datetime
     created_at: datetime
 
@@ -141,6 +187,8 @@ async def get_chat_history(
         target_id: int,
         limit: int = Query(100, gt=0, le=1000),  # 限制返回的消息数量，默认100条，最大1000条
         before_time: datetime = Query(None),  # 分页参数：获取某个时间之前的消息
+        after_seq: Optional[int] = Query(None, ge=0),  # 补齐缺失区间：获取该序号之后的消息
+        before_seq: Optional[int] = Query(None, gt=0),  # 补齐缺失区间：获取该序号之前的消息
 ):
     """获取两个用户之间的聊天历史记录"""
 
@@ -161,8 +209,23 @@ async def get_chat_history(
     if before_time:
         query["time"] = {"$lt": before_time}
     sort = [("time", -1)]
+
+    # 按序号区间拉取：客户端发现序号不连续时只补齐缺失的部分
+    if after_seq is not None or before_seq is not None:
+        seq_range = {}
+        if after_seq is not None:
+            seq_range["$gt"] = after_seq
+        if before_seq is not None:
+            seq_range["$lt"] = before_seq
+        query["seq"] = seq_range
+        # 只给了 after_seq 时从缺口开头往后取，否则取最靠近 before_seq 的一段
+        sort = [("seq", 1)] if before_seq is None else [("seq", -1)]
     # 查询数据库并按时间降序排序（最新消息在前）
     messages_list = await mongo.single_db.find_many(query=query, limit=limit, sort=sort)
+    # 热数据不够一页时，更早的消息从归档文件中补齐
+    messages_list = await fill_from_archive(messages_list, user_id, target_id, limit, sort,
+                                            before_time=before_time, after_seq=after_seq,
+                                            before_seq=before_seq)
 
     # 转换为列表并反转（使消息按时间升序排列）
     messages = []
@@ -176,7 +239,8 @@ async def get_chat_history(
         messages.append(msg)
 
     # 反转列表，使消息按时间升序排列（最早的消息在前）
-    messages.reverse()
+    if sort[0][1] == -1:
+        messages.reverse()
 
     # 加密整个消息列表
 
@@ -204,29 +268,18 @@ class RecentChat(BaseModel):
 async def add_recent_chat(recent_chat: RecentChat):
     """添加或更新最近聊天记录"""
 
-    query = {"user_id": recent_chat.user_id, "target_id": recent_chat.target_id}
-    if not recent_chat.is_group:
-        update = {
-            "$set": {
-                "target_username": recent_chat.target_username,
-                "target_photo": recent_chat.target_photo,
-                "last_message_time": recent_chat.last_message_time,
-                "unread_count": recent_chat.unread_count
-            },
-            "$setOnInsert": {"user_id": recent_chat.user_id, "target_id": recent_chat.target_id}
-        }
-    else:
-        update = {
-            "$set": {
-                "target_username": recent_chat.target_username,
-                "target_photo": recent_chat.target_photo,
-                "is_group":recent_chat.is_group,
-                "last_message_time": recent_chat.last_message_time,
-                "unread_count": recent_chat.unread_count
-            },
-            "$setOnInsert": {"user_id": recent_chat.user_id, "target_id": recent_chat.target_id}
-        }
-    await mongo.recent_chats_db.update_one(query, update, upsert=True)
+    fields = {
+        "target_username": recent_chat.target_username,
+        "target_photo": recent_chat.target_photo,
+    }
+    if recent_chat.is_group:
+        fields["is_group"] = recent_chat.is_group
+    # unread_count 作为增量累加，不再覆盖已有的未读数
+    batch = RecentChatBatch()
+    batch.touch(recent_chat.user_id, recent_chat.target_id,
+                last_message_time=recent_chat.last_message_time,
+                unread=recent_chat.unread_count, fields=fields)
+    await batch.flush()
     return {"message": "最近聊天记录已更新"}
 
 
@@ -234,17 +287,15 @@ async def add_recent_chat(recent_chat: RecentChat):
 @router.get("/recent-chats/{user_id}", response_model=List[RecentChat])
 async def get_recent_chats(user_id: int, limit: int = Query(10, gt=0, le=50)):
     """获取用户的最近聊天列表"""
-    query = {"user_id": user_id}
-    sort = [("last_message_time", -1)]  # 按最后消息时间降序排列
-    recent_chats = await mongo.recent_chats_db.find_many(query=query, limit=limit, sort=sort)
+    # 大群的最后消息和未读数在读取时从群消息头合并
+    recent_chats = await get_recent_chats_merged(user_id, limit)
     return recent_chats
 
 @router.post("/recent-chats/{user_id}/clear-unread/{target_id}")
 async def clear_unread_count(user_id: int, target_id: Union[int,str]):
     """清除与特定用户的未读消息计数"""
-    query = {"user_id": user_id, "target_id": target_id}
-    update = {"$set": {"unread_count": 0}}
-    await mongo.recent_chats_db.update_one(query, update)
+    # 读游标推进到会话最新一条消息，未读计数清零
+    await mark_conversation_read(user_id, target_id)
     return {"message": "未读计数已清除"}
 
 
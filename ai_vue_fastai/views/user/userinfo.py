@@ -1,5 +1,5 @@
 # main.py
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
 from typing import Optional, List
 from pydantic import BaseModel, Field
 from utils.redis import set_code, get_code, set_userinfo_to_redis
@@ -14,6 +14,9 @@ from utils.mysql_model import User, SexEnum, UserPublic, UserUpdate, UserInfo
 from utils.mysql_crud import UserCRUD
 from sqlmodel import Session
 import json
+from utils.user_profile import cache_user_profile
+from utils.author_snapshot import propagate_author_profile
+from utils.group_avatar import refresh_user_group_avatars
 
 router = APIRouter(tags=["用户信息"])
 
@@ -181,6 +184,7 @@ async def get_user_info(
 @router.put("/info")
 async def update_user_info(
         request: UserUpdate,
+        background_tasks: BackgroundTasks,
         session: Session = Depends(get_session)
 ):
     try:
@@ -205,6 +209,10 @@ async def update_user_info(
 
         if not updated_user:
             raise HTTPException(status_code=404, detail="用户不存在")
+        # 刷新缓存的用户资料，群成员列表中立即显示新的用户名
+        cache_user_profile(updated_user)
+        # 异步同步动态、评论、回复中的作者快照
+        background_tasks.add_task(propagate_author_profile, updated_user.id, updated_user.username, updated_user.photo)
         return {"message": "更新成功", "code": 200}
     except Exception as e:
         log_error(f"更新失败: {str(e)}")
@@ -247,6 +255,7 @@ async def save_qrcode(
 @router.post("/upload-avatar")
 async def upload_avatar(
         request: SaveAvatarRequest,
+        background_tasks: BackgroundTasks,
         session: Session = Depends(get_session)
 ):
     try:
@@ -268,6 +277,12 @@ async def upload_avatar(
 
         if not updated_user:
             raise HTTPException(status_code=404, detail="用户不存在")
+        # 刷新缓存的用户资料，群组合头像据此重新生成
+        cache_user_profile(updated_user)
+        # 异步同步动态、评论、回复中的作者快照
+        background_tasks.add_task(propagate_author_profile, updated_user.id, updated_user.username, updated_user.photo)
+        # 异步重新生成该用户所在群的组合头像
+        background_tasks.add_task(refresh_user_group_avatars, updated_user.id)
 
         return {
             "message": "头像上传成功",